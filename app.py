@@ -1,15 +1,39 @@
+import contextlib
+import hmac
 import json
 import os
 import logging
-import random
-
-import requests
+import queue
+import threading
 import time
 import openai
+import requests
 from flask import Flask, Response, request, jsonify, send_from_directory
 from dotenv import load_dotenv
 from opencensus.ext.azure.log_exporter import AzureLogHandler
 
+from backend import jsonutil
+from backend.balancer import OUTCOME_CANCELLED, OUTCOME_ERROR, OUTCOME_SUCCESS, OUTCOME_THROTTLED, RegionBalancer
+from backend.breaker import RegionBreakers
+from backend.cache import AnswerCache, AnswerRecorder, cache_key, replay_answer
+from backend.conversations import (CONVERSATION_STORE_HEADER, ConversationConflict, ConversationStore,
+                                   is_valid_conversation_id)
+from backend.hedging import Hedger
+from backend.history import HistoryCompactor
+from backend.logs import LOG_FORMAT, LogPipeline
+from backend.metrics import FAILOVER_INTERRUPTED, UpstreamMetrics
+from backend.ratelimit import TOKENS_PER_MESSAGE, DeploymentLimiters, parse_retry_after
+from backend.resume import Splice, StreamInterrupted, StreamResume, continuation_messages
+from backend.semantic_cache import SemanticCache
+from backend.settings import REGION_ENV_SUFFIXES, Settings, build_request_templates
+from backend.sse import READ_SIZE as SSE_READ_SIZE, is_done, iter_events
+from backend.streaming import (FORMAT_SNAPSHOT, STREAM_FORMAT_HEADER, StreamBatching, StreamDisconnects, StreamProgress,
+                               create_assembler, format_frame, join_frames, negotiate_stream_format)
+from backend.tokens import RegionTokenBudgets, TokenCounter
+from backend.tracing import NO_TRACE, Tracing
+from backend.transcripts import TranscriptRecorder
+from backend.upstream import Cancellation, UpstreamStalled, UpstreamTimeouts, get_session_pool, iter_chunks, timeout_phase
+
 load_dotenv()
 
 app = Flask(__name__, static_folder="static")
@@ -17,19 +41,26 @@ app = Flask(__name__, static_folder="static")
 # -----------------------------------------------------------------------------
 # Logging set up
 # -----------------------------------------------------------------------------
-logging.basicConfig(level=logging.DEBUG, format="%(asctime)s - %(levelname)s - %(message)s")
+# every record goes through a queue to a background thread, see backend/logs.py
+log_pipeline = LogPipeline.from_env()
+logger = logging.getLogger(__name__)
 
 c_handler = logging.StreamHandler()
-c_handler.setLevel(logging.DEBUG)
+c_handler.setFormatter(logging.Formatter(LOG_FORMAT))
+log_handlers = [c_handler]
 
-logger = logging.getLogger(__name__)
-logger.addHandler(c_handler)
-
-if 'APPLICATIONINSIGHTS_CONNECTION_STRING' in os.environ and 'APPLICATIONINSIGHTS_INSTRUMENTATION_KEY' in os.environ:
-    logger.info("APPLICATIONINSIGHTS_CONNECTION_STRING and _INSTRUMENTATION_KEY defined, setting AzureLogHandler")
+azure_logging = 'APPLICATIONINSIGHTS_CONNECTION_STRING' in os.environ and 'APPLICATIONINSIGHTS_INSTRUMENTATION_KEY' in os.environ
+if azure_logging:
     connection_string = os.getenv('APPLICATIONINSIGHTS_CONNECTION_STRING')
     instrumentation_key = os.getenv('APPLICATIONINSIGHTS_INSTRUMENTATION_KEY')
-    logger.addHandler(AzureLogHandler(connection_string=connection_string, instrumentation_key=instrumentation_key))
+    azure_handler = AzureLogHandler(connection_string=connection_string, instrumentation_key=instrumentation_key)
+    # only the records of the app, not those of the libraries
+    azure_handler.addFilter(logging.Filter(logger.name))
+    log_handlers.append(azure_handler)
+log_pipeline.install(log_handlers, summary_logger=logger)
+
+if azure_logging:
+    logger.info("APPLICATIONINSIGHTS_CONNECTION_STRING and _INSTRUMENTATION_KEY defined, setting AzureLogHandler")
 else:
     logger.info("APPLICATIONINSIGHTS_CONNECTION_STRING and _INSTRUMENTATION_KEY defined not defined, AzureLogHandler will not be initialized")
 
@@ -53,219 +84,726 @@ def assets(path):
 
 
 # -----------------------------------------------------------------------------
-# ACS Integration Settings
+# Settings
+# -----------------------------------------------------------------------------
+# validated once at startup; the upstream request of every region is pre-rendered from it
+settings = Settings.from_env()
+request_templates = build_request_templates(settings)
+# coalesces the tokens of an answer into fewer frames to the browser
+stream_batching = StreamBatching.from_env()
+# accepted and heartbeat frames to delta clients while the regions are connecting
+stream_progress = StreamProgress.from_env()
+# answers the browser abandoned, whose upstream requests were closed early
+stream_disconnects = StreamDisconnects(settings.max_tokens)
+# continues answers whose upstream stream broke off on another region
+stream_resume = StreamResume.from_env()
+NO_ANSWER_ERROR = "Sorry, I could not answer that. Please try asking a different question."
+STALLED_ERROR = "Sorry, the answer was interrupted because the service stopped responding. Please try again."
+
+# -----------------------------------------------------------------------------
+# Load balanced endpoints
 # -----------------------------------------------------------------------------
-AZURE_SEARCH_SERVICE = os.environ.get("AZURE_SEARCH_SERVICE")
-AZURE_SEARCH_INDEX = os.environ.get("AZURE_SEARCH_INDEX")
-AZURE_SEARCH_KEY = os.environ.get("AZURE_SEARCH_KEY")
-AZURE_SEARCH_USE_SEMANTIC_SEARCH = os.environ.get("AZURE_SEARCH_USE_SEMANTIC_SEARCH", "false")
-AZURE_SEARCH_SEMANTIC_SEARCH_CONFIG = os.environ.get("AZURE_SEARCH_SEMANTIC_SEARCH_CONFIG", "default")
-AZURE_SEARCH_TOP_K = os.environ.get("AZURE_SEARCH_TOP_K", 5)
-AZURE_SEARCH_ENABLE_IN_DOMAIN = os.environ.get("AZURE_SEARCH_ENABLE_IN_DOMAIN", "true")
-AZURE_SEARCH_CONTENT_COLUMNS = os.environ.get("AZURE_SEARCH_CONTENT_COLUMNS")
-AZURE_SEARCH_FILENAME_COLUMN = os.environ.get("AZURE_SEARCH_FILENAME_COLUMN")
-AZURE_SEARCH_TITLE_COLUMN = os.environ.get("AZURE_SEARCH_TITLE_COLUMN")
-AZURE_SEARCH_URL_COLUMN = os.environ.get("AZURE_SEARCH_URL_COLUMN")
+# per region, in the order of settings.regions
+openai_resources = [region.resource for region in settings.regions]
+openai_models = [region.model for region in settings.regions]
+# env var suffixes of the regions, e.g. AZURE_OPENAI_TPM_NC
+openai_env_suffixes = list(REGION_ENV_SUFFIXES)
 
 # -----------------------------------------------------------------------------
-# AOAI Integration Settings
+# Endpoint selection
 # -----------------------------------------------------------------------------
-AZURE_OPENAI_TEMPERATURE = os.environ.get("AZURE_OPENAI_TEMPERATURE", 0)
-AZURE_OPENAI_TOP_P = os.environ.get("AZURE_OPENAI_TOP_P", 1.0)
-AZURE_OPENAI_MAX_TOKENS = os.environ.get("AZURE_OPENAI_MAX_TOKENS", 1000)
-AZURE_OPENAI_STOP_SEQUENCE = os.environ.get("AZURE_OPENAI_STOP_SEQUENCE")
-AZURE_OPENAI_SYSTEM_MESSAGE = os.environ.get("AZURE_OPENAI_SYSTEM_MESSAGE", "You are an AI assistant that helps people find information.")
-AZURE_OPENAI_PREVIEW_API_VERSION = os.environ.get("AZURE_OPENAI_PREVIEW_API_VERSION", "2023-06-01-preview")
-AZURE_OPENAI_STREAM = os.environ.get("AZURE_OPENAI_STREAM", "true")
-SHOULD_STREAM = True if AZURE_OPENAI_STREAM.lower() == "true" else False
+max_retries = 3
+region_balancer = RegionBalancer.from_env(len(openai_resources))
+region_breakers = RegionBreakers.from_env(openai_resources)
+upstream_timeouts = UpstreamTimeouts.from_env()
+upstream_metrics = UpstreamMetrics.from_env(openai_resources, openai_models)
+tracing = Tracing.from_env(log_pipeline.summarize if log_pipeline.summaries else None)
+upstream_recorder = TranscriptRecorder.from_env()
+hedger = Hedger.from_env()
+region_limiters = DeploymentLimiters.from_env(openai_models, openai_env_suffixes)
+
+
+def generate_endpoint(ndx):
+    return request_templates[ndx].endpoint
+
+
+def choose_region(tried, tokens=0):
+    """Returns the next region to try, skipping regions already tried, regions with an open breaker
+    and regions without quota left for a request of `tokens` tokens."""
+    excluded = list(tried)
+    while True:
+        ndx = region_balancer.choose(exclude=excluded + region_breakers.unavailable() + region_limiters.unavailable(tokens))
+        if ndx is None:
+            return None
+        if region_limiters.acquire(ndx, tokens):
+            if region_breakers.acquire(ndx):
+                return ndx
+            region_limiters.give_back(ndx, tokens)
+        excluded.append(ndx)
+
+
+def region_wait_time(tried, tokens):
+    """Seconds until a region not tried yet has quota for the request, None when no region is left."""
+    unavailable = set(tried) | set(region_breakers.unavailable())
+    return region_limiters.wait_time([ndx for ndx in range(len(openai_resources)) if ndx not in unavailable], tokens)
+
+
+def wait_for_region(tried, tokens):
+    """Like choose_region, but queues the request for up to AZURE_OPENAI_RATE_LIMIT_MAX_WAIT seconds
+    when every remaining region is out of quota."""
+    deadline = time.monotonic() + region_limiters.max_wait
+    while True:
+        ndx = choose_region(tried, tokens)
+        if ndx is not None:
+            return ndx
+        wait = region_wait_time(tried, tokens)
+        if wait is None or time.monotonic() + wait > deadline:
+            return None
+        logger.info(f"wait_for_region: all regions are at their quota, waiting {round(wait, 3)} seconds")
+        time.sleep(wait)
 
 
 # -----------------------------------------------------------------------------
-# Load balanced endpoints
+# History compaction and token budget
 # -----------------------------------------------------------------------------
-AZURE_OPENAI_KEY = os.environ.get("AZURE_OPENAI_KEY")
-AZURE_OPENAI_RESOURCE = os.environ.get("AZURE_OPENAI_RESOURCE")
-AZURE_OPENAI_MODEL = os.environ.get("AZURE_OPENAI_MODEL")
-AZURE_OPENAI_MODEL_NAME = os.environ.get("AZURE_OPENAI_MODEL_NAME")
-
-AZURE_OPENAI_KEY_NC = os.environ.get("AZURE_OPENAI_KEY_NC")
-AZURE_OPENAI_RESOURCE_NC = os.environ.get("AZURE_OPENAI_RESOURCE_NC")
-AZURE_OPENAI_MODEL_NC = os.environ.get("AZURE_OPENAI_MODEL_NC")
-AZURE_OPENAI_MODEL_NAME_NC = os.environ.get("AZURE_OPENAI_MODEL_NAME_NC")
-
-AZURE_OPENAI_KEY_US2 = os.environ.get("AZURE_OPENAI_KEY_US2")
-AZURE_OPENAI_RESOURCE_US2 = os.environ.get("AZURE_OPENAI_RESOURCE_US2")
-AZURE_OPENAI_MODEL_US2 = os.environ.get("AZURE_OPENAI_MODEL_US2")
-AZURE_OPENAI_MODEL_NAME_US2 = os.environ.get("AZURE_OPENAI_MODEL_NAME_US2")
-
-# VERY IMPORTANT - THE ORDER IN THE ARRAYS BELOW MUST MATCH!!!!!
-openai_keys = [AZURE_OPENAI_KEY, AZURE_OPENAI_KEY_NC, AZURE_OPENAI_KEY_US2]
-openai_resources = [AZURE_OPENAI_RESOURCE, AZURE_OPENAI_RESOURCE_NC, AZURE_OPENAI_RESOURCE_US2]
-openai_models = [AZURE_OPENAI_MODEL, AZURE_OPENAI_MODEL_NC, AZURE_OPENAI_MODEL_US2]
-openai_model_names = [AZURE_OPENAI_MODEL_NAME, AZURE_OPENAI_MODEL_NAME_NC, AZURE_OPENAI_MODEL_NAME_US2]
+token_counter = TokenCounter()
+history_compactor = HistoryCompactor.from_env(count_tokens=token_counter.count_message)
+# trims the conversation to the context window of the model of each region
+context_budgets = RegionTokenBudgets.from_env(settings, token_counter)
+
+
+def compact_history(request_messages):
+    """Slims the conversation history down before it is forwarded upstream."""
+    messages, report = history_compactor.compact(request_messages)
+    if report is not None and report.bytes_saved:
+        logger.info(f"compact_history: {report.messages_before} -> {report.messages_after} messages, "
+                    f"saved {report.bytes_saved} bytes and ~{report.tokens_saved} tokens")
+    return messages
+
+
+def request_tokens(request_messages, max_tokens):
+    """Tokens a request counts against the TPM quota: the system message, the messages and `max_tokens`."""
+    system_tokens = TOKENS_PER_MESSAGE + token_counter.count_text(settings.system_message)
+    return system_tokens + token_counter.count_messages(request_messages) + max_tokens
+
 
 # -----------------------------------------------------------------------------
-# Endpoint randomization stuff
+# Conversation store
 # -----------------------------------------------------------------------------
-max_retries = 3
+conversation_store = ConversationStore.from_env()
 
 
-def generate_endpoint(ndx):
-    resource = openai_resources[ndx]
-    model = openai_models[ndx]
-    api_version = AZURE_OPENAI_PREVIEW_API_VERSION
-    return f"https://{resource}.openai.azure.com/openai/deployments/{model}/extensions/chat/completions?api-version={api_version}"
+def conversation_key(conversation_id, headers):
+    """Store key of a conversation, scoped to the signed in user so ids cannot be used across users."""
+    return f"{headers.get('X-Ms-Client-Principal-Id', 'anonymous')}:{conversation_id}"
+
 
+def resolve_conversation(body, headers):
+    """Returns (messages, store key) of a /conversation request; the key is None for clients that send the full history."""
+    conversation_id = body.get("conversation_id")
+    if conversation_id is None:
+        return body["messages"], None
+    if not is_valid_conversation_id(conversation_id):
+        raise ValueError("conversation_id must be 1 to 64 letters, digits, '-' or '_'")
+    key = conversation_key(conversation_id, headers)
+    return conversation_store.resolve(key, body), key
 
-def next_index(ndx):
-    return (ndx + 1) % max_retries
+
+def conversation_conflict(e):
+    return {"error": "conversation_history_required", "message": str(e)}
 
 
 # -----------------------------------------------------------------------------
-# Everything else
+# Answer cache
 # -----------------------------------------------------------------------------
-def is_chat_model():
-    if 'gpt-4' in AZURE_OPENAI_MODEL_NAME.lower() or AZURE_OPENAI_MODEL_NAME.lower() in ['gpt-35-turbo-4k',
-                                                                                         'gpt-35-turbo-16k']:
-        return True
-    return False
+answer_cache = AnswerCache.from_env()
+semantic_cache = SemanticCache.from_env(settings.base_url(settings.regions[0]), settings.regions[0].key)
+# shared secret of the ingestion for /cache/index_version, which is refused while it is unset
+CACHE_ADMIN_TOKEN = os.environ.get("CACHE_ADMIN_TOKEN") or None
+CACHE_ADMIN_TOKEN_HEADER = "X-Cache-Admin-Token"
 
 
+def answer_cache_key(request_messages):
+    """Cache key of a conversation, or None when answers are not cached or not deterministic."""
+    if not answer_cache.enabled:
+        return None
+    if settings.temperature != 0:
+        answer_cache.skip()
+        return None
+    return cache_key(request_messages, {
+        "search_service": settings.search_service,
+        "search_index": settings.search_index,
+        "top_k": settings.search_top_k,
+        "semantic_search": settings.search_use_semantic_search,
+        "semantic_search_config": settings.search_semantic_search_config,
+        "in_domain": settings.search_enable_in_domain,
+        "columns": [settings.search_content_columns, settings.search_filename_column, settings.search_title_column,
+                    settings.search_url_column],
+        "temperature": settings.temperature,
+        "top_p": settings.top_p,
+        "max_tokens": settings.max_tokens,
+        "stop": settings.stop_sequence,
+        "system_message": settings.system_message,
+        "model": settings.regions[0].model_name,
+        "api_version": settings.preview_api_version
+    })
+
+
+def semantic_cache_question(request_messages):
+    """The question of a single-turn conversation with deterministic settings, which the semantic cache may answer."""
+    if not semantic_cache.enabled or settings.temperature != 0:
+        return None
+    if len(request_messages) != 1 or request_messages[0].get("role") != "user":
+        return None
+    return request_messages[0].get("content") or None
+
+
+def cache_admin_authorized(headers):
+    token = headers.get(CACHE_ADMIN_TOKEN_HEADER)
+    if CACHE_ADMIN_TOKEN is None or token is None:
+        return False
+    return hmac.compare_digest(token.encode("utf-8"), CACHE_ADMIN_TOKEN.encode("utf-8"))
+
+
+def requested_index_version(body):
+    """The index version of a /cache/index_version request body, None when it has none."""
+    if not isinstance(body, dict) or body.get("index_version") in (None, ""):
+        return None
+    return str(body["index_version"])
+
+
+def cache_answer(request_messages, key, question, vector, lines):
+    if key is not None:
+        answer_cache.set(key, lines)
+    if vector is not None:
+        prompt_tokens = request_tokens(request_messages, 0)
+        semantic_cache.store(question, vector, lines, prompt_tokens)
+
+
+# -----------------------------------------------------------------------------
+# Everything else
+# -----------------------------------------------------------------------------
 def should_use_data():
-    if AZURE_SEARCH_SERVICE and AZURE_SEARCH_INDEX and AZURE_SEARCH_KEY:
+    if settings.search_service and settings.search_index and settings.search_key:
         return True
     return False
 
 
-def prepare_body_headers_with_data(request, ndx):
-    request_messages = request.json["messages"]
-    openai_key = openai_keys[ndx]
-    openai_resource = openai_resources[ndx]
-    openai_model = openai_models[ndx]
-
-    body = {
-        "messages": request_messages,
-        "temperature": float(AZURE_OPENAI_TEMPERATURE),
-        "max_tokens": int(AZURE_OPENAI_MAX_TOKENS),
-        "top_p": float(AZURE_OPENAI_TOP_P),
-        "stop": AZURE_OPENAI_STOP_SEQUENCE.split("|") if AZURE_OPENAI_STOP_SEQUENCE else None,
-        "stream": SHOULD_STREAM,
-        "dataSources": [
-            {
-                "type": "AzureCognitiveSearch",
-                "parameters": {
-                    "endpoint": f"https://{AZURE_SEARCH_SERVICE}.search.windows.net",
-                    "key": AZURE_SEARCH_KEY,
-                    "indexName": AZURE_SEARCH_INDEX,
-                    "fieldsMapping": {
-                        "contentField": AZURE_SEARCH_CONTENT_COLUMNS.split("|") if AZURE_SEARCH_CONTENT_COLUMNS else [],
-                        "titleField": AZURE_SEARCH_TITLE_COLUMN if AZURE_SEARCH_TITLE_COLUMN else None,
-                        "urlField": AZURE_SEARCH_URL_COLUMN if AZURE_SEARCH_URL_COLUMN else None,
-                        "filepathField": AZURE_SEARCH_FILENAME_COLUMN if AZURE_SEARCH_FILENAME_COLUMN else None
-                    },
-                    "inScope": True if AZURE_SEARCH_ENABLE_IN_DOMAIN.lower() == "true" else False,
-                    "topNDocuments": AZURE_SEARCH_TOP_K,
-                    "queryType": "semantic" if AZURE_SEARCH_USE_SEMANTIC_SEARCH.lower() == "true" else "simple",
-                    "semanticConfiguration": AZURE_SEARCH_SEMANTIC_SEARCH_CONFIG if AZURE_SEARCH_USE_SEMANTIC_SEARCH.lower() == "true" and AZURE_SEARCH_SEMANTIC_SEARCH_CONFIG else "",
-                    "roleInformation": AZURE_OPENAI_SYSTEM_MESSAGE
-                }
-            }
-        ]
-    }
-
-    chatgpt_url = f"https://{openai_resource}.openai.azure.com/openai/deployments/{openai_model}"
-    if is_chat_model():
-        chatgpt_url += "/chat/completions?api-version=2023-03-15-preview"
-    else:
-        chatgpt_url += "/completions?api-version=2023-03-15-preview"
-
-    headers = {
-        'Content-Type': 'application/json',
-        'api-key': openai_key,
-        'chatgpt_url': chatgpt_url,
-        'chatgpt_key': openai_key,
-        "x-ms-useragent": "GitHubSampleWebApp/PublicAPI/1.0.0"
-    }
-
-    return body, headers
-
-
-def stream_with_data(body, headers, endpoint):
-    logger.info(f"stream_with_data: {endpoint}")
-    s = requests.Session()
-    response = {
-        "id": "",
-        "model": "",
-        "created": 0,
-        "object": "",
-        "choices": [{
-            "messages": []
-        }]
-    }
-
-    logger.info("stream_with_data: starting POST")
-    start_time = time.time()
+def prepare_body_headers_with_data(request_messages, ndx, trace=NO_TRACE, continuation=False):
+    with trace.span("prepare_body", region_index=ndx):
+        return request_templates[ndx].render(context_budgets.fit(ndx, request_messages), continuation)
+
+
+def stream_with_data(body, headers, endpoint, ndx, stream_format=FORMAT_SNAPSHOT, cancellation=None, recorder=None,
+                     request_messages=None, trace=NO_TRACE):
+    # the progress of a request is in its summary record, see backend/logs.py
+    logger.debug("stream_with_data: %s", endpoint)
+    assembler = create_assembler(stream_format, stream_batching)
     try:
-        r = s.post(endpoint, json=body, headers=headers, stream=True, timeout=10)
-    except Exception:
-        logger.error(f"Endpoint {endpoint} timed out")
-        return None
-    logger.info(f"stream_with_data: status code of call: {r.status_code}")
-    if r.status_code != 200:
-        return None
+        yield from stream_from_region(body, headers, endpoint, ndx, assembler, cancellation, recorder, trace=trace)
+    except StreamInterrupted as e:
+        logger.error(f"stream_with_data: index #{ndx} broke off after {assembler.tokens} tokens: {e}")
+        stream_resume.record("interrupted")
+        yield from resume_answer(request_messages, [ndx], assembler, recorder, trace)
+
+
+def resume_attempts(request_messages, tried, assembler, trace=NO_TRACE):
+    """Prepares the attempts to continue an interrupted answer on the other regions.
+
+    Yields (ndx, body, headers, splice) for each of them; the answer delivered so far is read
+    when the next attempt is prepared, after the previous one broke off.
+    """
+    for _ in range(stream_resume.attempts if stream_resume.enabled and request_messages is not None else 0):
+        delivered = assembler.content
+        messages = continuation_messages(request_messages, delivered)
+        ndx = choose_region(tried, request_tokens(messages, settings.max_tokens))
+        if ndx is None:
+            return
+        upstream_metrics.record_retry(ndx)
+        upstream_metrics.record_failover(tried[-1], FAILOVER_INTERRUPTED)
+        tried.append(ndx)
+        logger.info(f"####### Resuming the answer on index #{ndx}")
+        stream_resume.record("attempt")
+        body, headers = prepare_body_headers_with_data(messages, ndx, trace, continuation=bool(delivered))
+        yield ndx, body, headers, Splice(delivered, assembler.metadata)
+
+
+def resume_failed(assembler):
+    """The frames ending an answer that could not be resumed."""
+    stream_resume.record("failed")
+    # the client has part of the answer: end it cleanly instead of breaking off the response
+    return join_frames(assembler.flush(), format_frame({"error": STALLED_ERROR}))
+
+
+def resume_answer(request_messages, tried, assembler, recorder, trace=NO_TRACE):
+    """Continues an interrupted answer on the other regions, or ends it with an error frame."""
+    for ndx, body, headers, splice in resume_attempts(request_messages, tried, assembler, trace):
+        try:
+            yield from stream_from_region(body, headers, generate_endpoint(ndx), ndx, assembler, recorder=recorder,
+                                          splice=splice, trace=trace)
+        except StreamInterrupted as e:
+            logger.error(f"resume_answer: index #{ndx} broke off too: {e}")
+            continue
+        if splice.completed:
+            return
+    yield resume_failed(assembler)
+
+
+class UpstreamAttempt(object):
+    """The bookkeeping of one request to a region, whichever HTTP client sends it.
+
+    The `stream_from_region` of app.py (requests) and of app_asgi.py (httpx) only do the I/O
+    and report to the attempt: `on_headers` once the response arrived, `on_event` for every
+    event of its stream and `on_complete` when the stream ended, `on_error` or `on_disconnect`
+    when it failed, and `on_end` in every case. The attempt keeps the balancer, breakers,
+    limiters, metrics, trace and transcripts up to date and turns the events into frames.
+    """
+
+    def __init__(self, endpoint, ndx, body, headers, assembler, recorder=None, cancellation=None, splice=None,
+                 trace=NO_TRACE):
+        self.endpoint = endpoint
+        self.ndx = ndx
+        self.body = body
+        self.assembler = assembler
+        self.recorder = recorder
+        self.cancellation = cancellation
+        self.splice = splice
+        self.trace = trace
+        self.outcome = OUTCOME_CANCELLED
+        self.failure = None
+        self.status_code = None
+        self.connect_time = None
+        self.first_token_time = None
+        self.tokens_before = assembler.tokens
+        self.transcript = None
+        # whether the response is 200 and its stream is read
+        self.streaming = False
+        # whether the stream said it is over, with [DONE] or an error line
+        self.done = False
+        # whether the breaker was told how the region did; otherwise the probe slot is given back
+        self.breaker_told = False
+        self.span = trace.start_span("upstream", client=True, region=openai_resources[ndx],
+                                     deployment=openai_models[ndx], resumed=splice is not None)
+        trace.inject(headers, self.span)
+        self.stage = trace.start_span("upstream.connect", self.span)
+        region_balancer.start(ndx)
+        self.request_start = time.time()
+
+    @property
+    def answered(self):
+        """Whether the region started streaming its answer."""
+        return self.first_token_time is not None
+
+    def _tell_breaker(self, record):
+        record(self.ndx)
+        self.breaker_told = True
+
+    def _feed(self, line_json):
+        if self.recorder is not None:
+            self.recorder.record(line_json)
+        return self.assembler.feed(line_json)
+
+    def _feed_all(self, lines):
+        frame = None
+        for line_json in lines:
+            frame = join_frames(frame, self._feed(line_json))
+        return frame
+
+    def on_headers(self, status_code, headers):
+        """Records the status of the response; returns whether its stream should be read."""
+        logger.debug("stream_with_data: status code of call: %s", status_code)
+        self.status_code = status_code
+        self.connect_time = time.time() - self.request_start
+        self.trace.end_span(self.stage, status_code=status_code)
+        self.stage = None
+        if status_code != 200:
+            self.outcome = OUTCOME_THROTTLED if status_code == 429 else OUTCOME_ERROR
+            if status_code == 429:
+                region_limiters.record_throttled(self.ndx, parse_retry_after(headers))
+                upstream_metrics.record_throttled(self.ndx)
+            if status_code == 429 or status_code >= 500:
+                self._tell_breaker(region_breakers.record_failure)
+            return False
+        self.streaming = True
+        region_balancer.record_connect(self.ndx, self.connect_time)
+        upstream_metrics.stream_started(self.ndx)
+        self.stage = self.trace.start_span("upstream.retrieval", self.span)
+        self.transcript = upstream_recorder.start(openai_resources[self.ndx], self.body, status_code, headers,
+                                                  self.connect_time, self.request_start)
+        return True
 
-    with r:
-        total_time = round(time.time() - start_time, 3)
-        logger.info(f"stream_with_data: POST completed in {total_time} seconds, processing response lines")
-        start_time = time.time()
-        for line in r.iter_lines(chunk_size=10):
-            if line:
-                line_json = json.loads(line.lstrip(b'data:').decode('utf-8'))
-                if 'error' in line_json:
-                    yield json.dumps(line_json).replace("\n", "\\n") + "\n"
-                response["id"] = line_json["id"]
-                response["model"] = line_json["model"]
-                response["created"] = line_json["created"]
-                response["object"] = line_json["object"]
-
-                role = line_json["choices"][0]["messages"][0]["delta"].get("role")
-                if role == "tool":
-                    response["choices"][0]["messages"].append(line_json["choices"][0]["messages"][0]["delta"])
-                elif role == "assistant":
-                    response["choices"][0]["messages"].append({
-                        "role": "assistant",
-                        "content": ""
-                    })
-                else:
-                    deltaText = line_json["choices"][0]["messages"][0]["delta"]["content"]
-                    if deltaText != "[DONE]":
-                        response["choices"][0]["messages"][1]["content"] += deltaText
+    def on_event(self, event):
+        """The frame of one event of the stream, if any; sets `done` once the stream is over."""
+        if self.first_token_time is None:
+            self.first_token_time = time.time() - self.request_start
+            region_balancer.record_first_token(self.ndx, self.first_token_time)
+            hedger.observe_first_token(self.first_token_time)
+            self._tell_breaker(region_breakers.record_success)
+            self.trace.end_span(self.stage)
+            self.stage = self.trace.start_span("upstream.generation", self.span)
+        if is_done(event):
+            self.done = True
+            return None
+        line_json = jsonutil.loads(event.data)
+        if 'error' in line_json:
+            self.done = True
+            self.outcome = OUTCOME_ERROR
+            # the client of a continuation gets the error frame of resume_failed instead
+            return format_frame(line_json) if self.splice is None else None
+        if self.splice is not None:
+            return self._feed_all(self.splice.feed(line_json))
+        return self._feed(line_json)
+
+    def on_complete(self):
+        """The closing frame of a stream that ended without an error line."""
+        if self.outcome == OUTCOME_ERROR:
+            return None
+        frame = self._feed_all(self.splice.flush()) if self.splice is not None else None
+        frame = join_frames(frame, self.assembler.finish())
+        self.outcome = OUTCOME_SUCCESS
+        stream_disconnects.record_completed(self.assembler.tokens)
+        if self.recorder is not None:
+            self.recorder.complete = True
+        if self.splice is not None:
+            self.splice.completed = True
+            stream_resume.record("resumed")
+            stream_resume.record("overlap_chars", self.splice.overlap)
+        return frame
+
+    def on_error(self, e, phase=None):
+        """Records a failed request; `phase` is the timeout it ran into, if the client reports one."""
+        logger.error(f"Endpoint {self.endpoint} failed: {e!r}")
+        if isinstance(e, UpstreamStalled):
+            phase = e.phase
+        self.outcome = OUTCOME_ERROR
+        self.failure = e
+        if phase is not None:
+            upstream_timeouts.record(self.ndx, phase)
+            upstream_metrics.record_timeout(self.ndx, phase)
+        self._tell_breaker(region_breakers.record_failure)
+
+    def on_disconnect(self):
+        """Records a request closed because the client went away, not because another region won."""
+        if self.cancellation is None or not self.cancellation.cancelled:
+            stream_disconnects.record_disconnected(self.assembler.tokens)
+
+    def on_end(self):
+        """Records how the request ended, whatever happened; called exactly once."""
+        region_balancer.finish(self.ndx, self.outcome)
+        if not self.breaker_told:
+            # ended before the region told anything about its health
+            region_breakers.release(self.ndx)
+        duration = time.time() - self.request_start
+        tokens = self.assembler.tokens - self.tokens_before
+        if self.streaming:
+            upstream_metrics.stream_ended(self.ndx)
+        upstream_metrics.observe_stream(self.ndx, self.outcome, self.connect_time, self.first_token_time, duration,
+                                        tokens, duration - self.first_token_time if self.answered else 0.0)
+        self.trace.end_span(self.stage, self.failure)
+        self.trace.end_span(self.span, self.failure, outcome=self.outcome, tokens=tokens)
+        fields = {}
+        if self.status_code is not None and self.status_code != 200:
+            fields["status_code"] = self.status_code
+        if self.failure is not None:
+            fields["error"] = repr(self.failure)
+        self.trace.record_upstream(self.ndx, openai_resources[self.ndx], self.outcome, resumed=self.splice is not None,
+                                   connect=self.connect_time, first_token=self.first_token_time, duration=duration,
+                                   tokens=tokens, **fields)
+        if self.transcript is not None:
+            self.transcript.finish(self.outcome)
+
+
+def stream_from_region(body, headers, endpoint, ndx, assembler, cancellation=None, recorder=None, splice=None,
+                       trace=NO_TRACE):
+    """Streams the answer of one region through `assembler`.
+
+    A failure before the first upstream chunk ends the stream without any frame, so that the
+    caller can try another region. StreamInterrupted is raised when the stream breaks off
+    later. With `splice`, the stream is the continuation of an interrupted answer.
+    """
+    attempt = UpstreamAttempt(endpoint, ndx, body, headers, assembler, recorder, cancellation, splice, trace)
+    try:
+        try:
+            r = get_session_pool().session_for(endpoint).post(endpoint, data=body, headers=headers, stream=True,
+                                                              timeout=upstream_timeouts.requests_timeout)
+        except Exception as e:
+            attempt.on_error(e, timeout_phase(e))
+            return
+        if cancellation is not None and not cancellation.attach(r):
+            # another region answered first while this one was connecting
+            r.close()
+            return
+        with r:
+            if not attempt.on_headers(r.status_code, r.headers):
+                return
+            chunks = iter_chunks(r, upstream_timeouts, SSE_READ_SIZE)
+            if attempt.transcript is not None:
+                chunks = attempt.transcript.chunks(chunks)
+            for event in iter_events(chunks):
+                frame = attempt.on_event(event)
+                if frame is not None:
+                    yield frame
+                if attempt.done:
+                    break
+            frame = attempt.on_complete()
+            if frame is not None:
+                yield frame
+    except GeneratorExit:
+        # closed by the server once a write to the browser failed; `with r` has closed the upstream
+        attempt.on_disconnect()
+        raise
+    except Exception as e:
+        if cancellation is not None and cancellation.cancelled:
+            logger.info(f"stream_with_data: {endpoint} cancelled")
+            return
+        attempt.on_error(e)
+        if not isinstance(e, (UpstreamStalled, requests.exceptions.RequestException)):
+            raise
+        # the connection to the region broke
+        if attempt.answered:
+            raise StreamInterrupted(repr(e)) from e
+    finally:
+        attempt.on_end()
+
+
+def sequential_first_frame(request_messages, tokens, stream_format, record=False, trace=NO_TRACE):
+    """Tries one region after the other until one of them answers; returns (data_stream, first_frame, recorder)."""
+    tried = []
+    for retry in range(max_retries):
+        current_index = wait_for_region(tried, tokens)
+        if current_index is None:
+            break
+        if tried:
+            upstream_metrics.record_retry(current_index)
+            upstream_metrics.record_failover(tried[-1])
+        logger.debug("####### Retry #%s Using index #%s", retry, current_index)
+        body, headers = prepare_body_headers_with_data(request_messages, current_index, trace)
+        endpoint = generate_endpoint(current_index)
+        recorder = AnswerRecorder() if record else None
+        data_stream = stream_with_data(body, headers, endpoint, current_index, stream_format, recorder=recorder,
+                                       request_messages=request_messages, trace=trace)
+        first_frame = next(data_stream, None)
+        if first_frame is not None:
+            return data_stream, first_frame, recorder
+        tried.append(current_index)
+        logger.error(f"Index #{current_index} did not answer")
+    return None, None, None
+
+
+def discard_attempts(results, pending):
+    """Closes the streams of the `pending` cancelled attempts once they have put them in `results`.
+
+    A stream that got its first frame holds the upstream response, the in-flight count of
+    the balancer and the breaker's probe slot until it is closed.
+    """
+    for _ in range(pending):
+        _, data_stream, _, _ = results.get()
+        data_stream.close()
+
+
+def hedged_first_frame(request_messages, tokens, stream_format, record=False, trace=NO_TRACE):
+    """Like sequential_first_frame, but sends a second request to another region when the first
+    one has not answered within the hedge delay. The first region to answer wins, the other
+    request is cancelled."""
+    results = queue.Queue()
+    cancellations = {}
+    tried = []
+
+    def attempt(ndx, cancellation):
+        body, headers = prepare_body_headers_with_data(request_messages, ndx, trace)
+        recorder = AnswerRecorder() if record else None
+        data_stream = stream_with_data(body, headers, generate_endpoint(ndx), ndx, stream_format, cancellation, recorder,
+                                       request_messages, trace)
+        try:
+            first_frame = next(data_stream, None)
+        except Exception:
+            logger.exception(f"Index #{ndx} failed")
+            first_frame = None
+        results.put((ndx, data_stream, first_frame, recorder))
+
+    def launch(ndx, is_hedge):
+        if ndx is None:
+            return False
+        logger.debug("####### %s #%s Using index #%s", 'Hedge' if is_hedge else 'Attempt', len(tried), ndx)
+        if tried:
+            upstream_metrics.record_retry(ndx)
+        tried.append(ndx)
+        cancellations[ndx] = Cancellation()
+        threading.Thread(target=attempt, args=(ndx, cancellations[ndx]), daemon=True).start()
+        return True
 
-                yield json.dumps(response).replace("\n", "\\n") + "\n"
-        total_time = round(time.time() - start_time, 3)
-        logger.info(f"stream_with_data: lines processed in {total_time} seconds")
+    delay = hedger.start_request()
+    if not launch(wait_for_region(tried, tokens), is_hedge=False):
+        return None, None, None
+    may_hedge = True
+    hedge_index = None
+    pending = 1
+    while pending:
+        try:
+            ndx, data_stream, first_frame, recorder = results.get(timeout=delay if may_hedge else None)
+        except queue.Empty:
+            # at most one hedge per question
+            may_hedge = False
+            if hedger.try_fire():
+                if launch(choose_region(tried, tokens), is_hedge=True):
+                    hedge_index = tried[-1]
+                    pending += 1
+                else:
+                    hedger.refund()
+            continue
+        pending -= 1
+        if first_frame is not None:
+            for other, cancellation in cancellations.items():
+                if other != ndx:
+                    cancellation.cancel()
+            if ndx == hedge_index:
+                logger.info(f"Hedge to index #{ndx} answered first")
+                hedger.record_won()
+            if pending:
+                threading.Thread(target=discard_attempts, args=(results, pending), daemon=True).start()
+            return data_stream, first_frame, recorder
+        logger.error(f"Index #{ndx} did not answer")
+        if len(tried) < max_retries and launch(choose_region(tried, tokens), is_hedge=False):
+            upstream_metrics.record_failover(ndx)
+            pending += 1
+    return None, None, None
+
+
+def replay_first_frame(first_frame, data_stream, frames):
+    """Sends the probed first frame, then `frames`, the wrapped rest of `data_stream`."""
+    # closed explicitly: the client may leave before `frames` has started reading it
+    with contextlib.closing(data_stream):
+        yield first_frame
+        yield from frames
+
+
+def cache_when_complete(data_stream, recorder, store):
+    """Passes the frames of a live answer through and hands its upstream lines to `store` once it streamed completely."""
+    yield from data_stream
+    if recorder.complete:
+        store(recorder.lines)
 
 
 @app.route("/conversation", methods=["GET", "POST"])
 def conversation():
-    current_index = random.randint(0, max_retries - 1)
-    for retry in range(max_retries):
-        logger.info(f"####### Retry #{retry} Using index #{current_index}")
-        body, headers = prepare_body_headers_with_data(request, current_index)
-        openai_resource = openai_resources[current_index]
-        openai_model = openai_models[current_index]
-        endpoint = f"https://{openai_resource}.openai.azure.com/openai/deployments/{openai_model}/extensions/chat/completions?api-version={AZURE_OPENAI_PREVIEW_API_VERSION}"
-        data_stream = stream_with_data(body, headers, endpoint)
-        if data_stream is not None and next(data_stream, None) is not None:
-            logger.info("Data stream received, sending response to client")
-            return Response(data_stream, mimetype='text/event-stream')
-        else:
-            if retry < max_retries - 1:
-                logger.error("Retrying...")
-                current_index = next_index(current_index)
-            else:
-                logger.error("Giving up and returning an error")
-                return Response(json.dumps({"error": "Sorry, I could not answer that. Please try asking a different question."}) + "\n")
+    response = app.make_response(answer_conversation())
+    if conversation_store.enabled:
+        # from now on the browser only sends its new turn
+        response.headers[CONVERSATION_STORE_HEADER] = "true"
+    return response
+
+
+def answer_conversation():
+    stream_format = negotiate_stream_format(request.headers, request.args)
+    trace = tracing.start("conversation", request.headers, stream_format=stream_format)
+    try:
+        history, store_key = resolve_conversation(request.json, request.headers)
+    except ValueError as e:
+        trace.end(status_code=400)
+        return jsonify({"error": str(e)}), 400
+    except ConversationConflict as e:
+        trace.end(status_code=409)
+        return jsonify(conversation_conflict(e)), 409
+    request_messages = compact_history(history)
+    trace.set_attributes(messages=len(request_messages))
+    key = answer_cache_key(request_messages)
+    lines = answer_cache.get(key) if key is not None else None
+    question = semantic_cache_question(request_messages) if lines is None else None
+    vector = semantic_cache.embed(question) if question is not None else None
+    if vector is not None:
+        lines = semantic_cache.lookup(vector)
+    if lines is not None:
+        logger.debug("Answer found in cache, replaying it to the client")
+        if store_key is not None:
+            conversation_store.save(store_key, history, lines)
+        trace.set_attributes(cached=True)
+        return Response(trace.frames(replay_answer(lines, stream_format, stream_batching)), mimetype='text/event-stream',
+                        headers={STREAM_FORMAT_HEADER: stream_format})
+
+    record = key is not None or vector is not None or (store_key is not None and conversation_store.enabled)
+    tokens = request_tokens(request_messages, settings.max_tokens)
+
+    def find_answer():
+        if hedger.enabled:
+            return hedged_first_frame(request_messages, tokens, stream_format, record=record, trace=trace)
+        return sequential_first_frame(request_messages, tokens, stream_format, record=record, trace=trace)
+
+    def answer_frames(data_stream, recorder):
+        logger.debug("Data stream received, sending response to client")
+        if recorder is None:
+            return data_stream
+
+        def store(lines):
+            cache_answer(request_messages, key, question, vector, lines)
+            if store_key is not None:
+                conversation_store.save(store_key, history, lines)
+        return cache_when_complete(data_stream, recorder, store)
+
+    if stream_progress.applies(stream_format):
+        # the response starts at once, the regions are tried while it sends progress frames
+        return Response(trace.frames(stream_progress.stream(find_answer, answer_frames, NO_ANSWER_ERROR)),
+                        mimetype='text/event-stream', headers={STREAM_FORMAT_HEADER: stream_format})
+
+    data_stream, first_frame, recorder = find_answer()
+    if first_frame is not None:
+        frames = answer_frames(data_stream, recorder)
+        return Response(trace.frames(replay_first_frame(first_frame, data_stream, frames)), mimetype='text/event-stream',
+                        headers={STREAM_FORMAT_HEADER: stream_format})
+
+    logger.error("Giving up and returning an error")
+    trace.end(answered=False)
+    return Response(json.dumps({"error": NO_ANSWER_ERROR}) + "\n")
+
+
+@app.route("/cache/index_version", methods=["POST"])
+def cache_index_version():
+    """Invalidation hook for the ingestion: drops the cached answers generated from an older search index.
+
+    Only the caches of the worker process that handles the request are invalidated, see the README.
+    """
+    if not cache_admin_authorized(request.headers):
+        return jsonify({"error": "forbidden"}), 403
+    index_version = requested_index_version(request.get_json(silent=True))
+    if index_version is None:
+        return jsonify({"error": "index_version is required"}), 400
+    dropped = semantic_cache.set_index_version(index_version)
+    if answer_cache.enabled:
+        answer_cache.clear()
+    return jsonify({"index_version": semantic_cache.index_version, "semantic_answers_dropped": dropped})
+
+
+# -----------------------------------------------------------------------------
+# Monitoring
+# -----------------------------------------------------------------------------
+@app.route("/upstream/status", methods=["GET"])
+def upstream_status():
+    return jsonify({
+        "session_pool": get_session_pool().stats(),
+        "balancer": region_balancer.stats(),
+        "breakers": region_breakers.stats(),
+        "timeouts": upstream_timeouts.stats(),
+        "resume": stream_resume.stats(),
+        "hedging": hedger.stats(),
+        "rate_limits": region_limiters.stats(),
+        "answer_cache": answer_cache.stats(),
+        "semantic_cache": semantic_cache.stats(),
+        "history": history_compactor.stats(),
+        "conversations": conversation_store.stats(),
+        "stream_batching": stream_batching.stats(),
+        "disconnects": stream_disconnects.stats(),
+        "token_budget": context_budgets.stats(),
+        "tracing": tracing.stats(),
+        "transcripts": upstream_recorder.stats(),
+        "logging": log_pipeline.stats()
+    })
+
+
+@app.route("/metrics", methods=["GET"])
+def metrics():
+    if not upstream_metrics.enabled:
+        return jsonify({"error": "metrics are disabled"}), 404
+    body, content_type = upstream_metrics.render()
+    return Response(body, content_type=content_type)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,425 @@
+"""Asyncio (ASGI) serving mode for the chat app.
+
+Serves the same routes and JSON-lines contract as app.py, but every in-flight answer is an
+async generator on one event loop instead of a pinned uwsgi worker, so a single process can
+hold thousands of concurrent streams. Run it with:
+
+    uvicorn --factory app_asgi:create_app --host 0.0.0.0 --port 80
+"""
+import asyncio
+import contextlib
+import json
+import logging
+import os
+import time
+
+import anyio
+import httpx
+from starlette.applications import Starlette
+from starlette.responses import FileResponse, JSONResponse, Response, StreamingResponse
+from starlette.routing import Mount, Route
+from starlette.staticfiles import StaticFiles
+
+from app import (logger, NO_ANSWER_ERROR, UpstreamAttempt, answer_cache, answer_cache_key, cache_admin_authorized,
+                 cache_answer, choose_region, compact_history, context_budgets, conversation_conflict,
+                 conversation_store, generate_endpoint, hedger, history_compactor, log_pipeline, max_retries,
+                 prepare_body_headers_with_data, region_balancer, region_breakers, region_limiters, region_wait_time,
+                 request_tokens, requested_index_version, resolve_conversation, resume_attempts, resume_failed,
+                 semantic_cache, semantic_cache_question, settings, stream_batching, stream_disconnects,
+                 stream_progress, stream_resume, token_counter, tracing, upstream_metrics, upstream_recorder,
+                 upstream_timeouts)
+from backend.async_upstream import AsyncUpstreamClient, timeout_phase
+from backend.cache import AnswerRecorder, replay_answer
+from backend.conversations import CONVERSATION_STORE_HEADER, ConversationConflict
+from backend.resume import StreamInterrupted
+from backend.sse import aiter_events
+from backend.streaming import (FORMAT_SNAPSHOT, STREAM_FORMAT_HEADER, create_assembler, flush_when_due,
+                               negotiate_stream_format)
+from backend.tracing import NO_TRACE
+from backend.upstream import Cancellation, UpstreamStalled
+
+# httpx logs every upstream request at INFO; they are in the request summaries
+logging.getLogger("httpx").setLevel(logging.WARNING)
+
+STATIC_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), "static")
+
+
+# -----------------------------------------------------------------------------
+# Static Files
+# -----------------------------------------------------------------------------
+async def index(request):
+    return FileResponse(os.path.join(STATIC_FOLDER, "index.html"))
+
+
+async def favicon(request):
+    return FileResponse(os.path.join(STATIC_FOLDER, "favicon.ico"))
+
+
+# -----------------------------------------------------------------------------
+# Conversation
+# -----------------------------------------------------------------------------
+async def stream_with_data(client, body, headers, endpoint, ndx, stream_format=FORMAT_SNAPSHOT, recorder=None,
+                           cancellation=None, request_messages=None, trace=NO_TRACE):
+    logger.debug("stream_with_data: %s", endpoint)
+    assembler = create_assembler(stream_format, stream_batching)
+    try:
+        # closed explicitly so that a disconnect closes the upstream at once
+        async with contextlib.aclosing(stream_from_region(client, body, headers, endpoint, ndx, assembler, recorder,
+                                                          cancellation, trace=trace)) as frames:
+            async for frame in frames:
+                yield frame
+    except StreamInterrupted as e:
+        logger.error(f"stream_with_data: index #{ndx} broke off after {assembler.tokens} tokens: {e}")
+        stream_resume.record("interrupted")
+        async with contextlib.aclosing(resume_answer(client, request_messages, [ndx], assembler, recorder,
+                                                     trace)) as frames:
+            async for frame in frames:
+                yield frame
+
+
+async def resume_answer(client, request_messages, tried, assembler, recorder, trace=NO_TRACE):
+    """Continues an interrupted answer on the other regions, or ends it with an error frame."""
+    for ndx, body, headers, splice in resume_attempts(request_messages, tried, assembler, trace):
+        try:
+            async with contextlib.aclosing(stream_from_region(client, body, headers, generate_endpoint(ndx), ndx,
+                                                              assembler, recorder, splice=splice,
+                                                              trace=trace)) as frames:
+                async for frame in frames:
+                    yield frame
+        except StreamInterrupted as e:
+            logger.error(f"resume_answer: index #{ndx} broke off too: {e}")
+            continue
+        if splice.completed:
+            return
+    yield resume_failed(assembler)
+
+
+async def stream_from_region(client, body, headers, endpoint, ndx, assembler, recorder=None, cancellation=None,
+                             splice=None, trace=NO_TRACE):
+    """Streams the answer of one region through `assembler`, like `app.stream_from_region`."""
+    attempt = UpstreamAttempt(endpoint, ndx, body, headers, assembler, recorder, cancellation, splice, trace)
+    r = None
+    try:
+        try:
+            r = await client.open_stream(endpoint, body, headers)
+        except Exception as e:
+            attempt.on_error(e, timeout_phase(e))
+            return
+        if not attempt.on_headers(r.status_code, r.headers):
+            return
+        chunks = client.aiter_chunks(r)
+        if attempt.transcript is not None:
+            chunks = attempt.transcript.achunks(chunks)
+        client.active_streams += 1
+        async for event in flush_when_due(aiter_events(chunks), assembler):
+            # None: the batch window ran out while waiting for the next token
+            frame = assembler.flush() if event is None else attempt.on_event(event)
+            if frame is not None:
+                yield frame
+            if attempt.done:
+                break
+        frame = attempt.on_complete()
+        if frame is not None:
+            yield frame
+    except (GeneratorExit, asyncio.CancelledError):
+        # closed or cancelled once the browser went away, or another region answered first while
+        # this one was connecting; the finally block closes the upstream
+        attempt.on_disconnect()
+        raise
+    except Exception as e:
+        attempt.on_error(e)
+        if not isinstance(e, (UpstreamStalled, httpx.TransportError)):
+            raise
+        # the connection to the region broke
+        if attempt.answered:
+            raise StreamInterrupted(repr(e)) from e
+    finally:
+        if attempt.streaming:
+            client.active_streams -= 1
+        attempt.on_end()
+        if r is not None:
+            # when the browser went away, Starlette's cancel scope would also cancel the close,
+            # leaving the upstream connection open and the model generating
+            with anyio.CancelScope(shield=True):
+                await r.aclose()
+
+
+class AnswerResponse(StreamingResponse):
+    """Closes the frames of the answer as soon as the response ends.
+
+    Starlette stops iterating when the client disconnects but leaves the closing of the
+    iterator to the garbage collector; closing it here closes the upstream request at once.
+    """
+
+    async def __call__(self, scope, receive, send):
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            await self.body_iterator.aclose()
+
+
+async def replay_first_frame(first_frame, data_stream, frames):
+    # closed explicitly: the client may leave before `frames` has started reading it
+    async with contextlib.aclosing(data_stream):
+        yield first_frame
+        async for frame in frames:
+            yield frame
+
+
+async def wait_for_region(tried, tokens):
+    deadline = time.monotonic() + region_limiters.max_wait
+    while True:
+        ndx = choose_region(tried, tokens)
+        if ndx is not None:
+            return ndx
+        wait = region_wait_time(tried, tokens)
+        if wait is None or time.monotonic() + wait > deadline:
+            return None
+        logger.info(f"wait_for_region: all regions are at their quota, waiting {round(wait, 3)} seconds")
+        await asyncio.sleep(wait)
+
+
+async def sequential_first_frame(client, request_messages, tokens, stream_format, record=False, trace=NO_TRACE):
+    tried = []
+    for retry in range(max_retries):
+        current_index = await wait_for_region(tried, tokens)
+        if current_index is None:
+            break
+        if tried:
+            upstream_metrics.record_retry(current_index)
+            upstream_metrics.record_failover(tried[-1])
+        logger.debug("####### Retry #%s Using index #%s", retry, current_index)
+        body, headers = prepare_body_headers_with_data(request_messages, current_index, trace)
+        endpoint = generate_endpoint(current_index)
+        recorder = AnswerRecorder() if record else None
+        data_stream = stream_with_data(client, body, headers, endpoint, current_index, stream_format, recorder,
+                                       request_messages=request_messages, trace=trace)
+        first_frame = await anext(data_stream, None)
+        if first_frame is not None:
+            return data_stream, first_frame, recorder
+        tried.append(current_index)
+        logger.error(f"Index #{current_index} did not answer")
+    return None, None, None
+
+
+async def discard_attempt(task, data_stream, cancellation=None):
+    if cancellation is not None:
+        cancellation.cancel()
+    task.cancel()
+    with contextlib.suppress(BaseException):
+        await task
+    await data_stream.aclose()
+
+
+async def hedged_first_frame(client, request_messages, tokens, stream_format, record=False, trace=NO_TRACE):
+    attempts = {}
+    tried = []
+
+    def launch(ndx, is_hedge):
+        if ndx is None:
+            return False
+        logger.debug("####### %s #%s Using index #%s", 'Hedge' if is_hedge else 'Attempt', len(tried), ndx)
+        if tried:
+            upstream_metrics.record_retry(ndx)
+        tried.append(ndx)
+        body, headers = prepare_body_headers_with_data(request_messages, ndx, trace)
+        recorder = AnswerRecorder() if record else None
+        cancellation = Cancellation()
+        data_stream = stream_with_data(client, body, headers, generate_endpoint(ndx), ndx, stream_format, recorder,
+                                       cancellation, request_messages, trace)
+        attempts[asyncio.create_task(anext(data_stream, None))] = (ndx, data_stream, is_hedge, recorder, cancellation)
+        return True
+
+    delay = hedger.start_request()
+    if not launch(await wait_for_region(tried, tokens), is_hedge=False):
+        return None, None, None
+    may_hedge = True
+    while attempts:
+        try:
+            done, _ = await asyncio.wait(attempts, timeout=delay if may_hedge else None,
+                                         return_when=asyncio.FIRST_COMPLETED)
+        except asyncio.CancelledError:
+            # the client left: the attempts still connecting must not be left running
+            for other, (_, other_stream, _, _, _) in attempts.items():
+                await discard_attempt(other, other_stream)
+            raise
+        if not done:
+            # at most one hedge per question
+            may_hedge = False
+            if hedger.try_fire() and not launch(choose_region(tried, tokens), is_hedge=True):
+                hedger.refund()
+            continue
+        for task in done:
+            ndx, data_stream, is_hedge, recorder, _ = attempts.pop(task)
+            first_frame = None if task.exception() else task.result()
+            if first_frame is not None:
+                for other, (_, other_stream, _, _, other_cancellation) in attempts.items():
+                    await discard_attempt(other, other_stream, other_cancellation)
+                if is_hedge:
+                    logger.info(f"Hedge to index #{ndx} answered first")
+                    hedger.record_won()
+                return data_stream, first_frame, recorder
+            logger.error(f"Index #{ndx} did not answer")
+            if len(tried) < max_retries and launch(choose_region(tried, tokens), is_hedge=False):
+                upstream_metrics.record_failover(ndx)
+    return None, None, None
+
+
+async def run_blocking(blocking, method, *args):
+    """Runs a cache or embedder call, in a worker thread when it does network I/O."""
+    if blocking:
+        return await asyncio.to_thread(method, *args)
+    return method(*args)
+
+
+async def cache_when_complete(data_stream, recorder, store):
+    async for frame in data_stream:
+        yield frame
+    if recorder.complete:
+        await store(recorder.lines)
+
+
+async def conversation(request):
+    response = await answer_conversation(request)
+    if conversation_store.enabled:
+        response.headers[CONVERSATION_STORE_HEADER] = "true"
+    return response
+
+
+async def answer_conversation(request):
+    client = request.app.state.upstream
+    stream_format = negotiate_stream_format(request.headers, request.query_params)
+    store_blocking = conversation_store.enabled and conversation_store.backend.blocking
+    trace = tracing.start("conversation", request.headers, stream_format=stream_format)
+    try:
+        history, store_key = await run_blocking(store_blocking, resolve_conversation, await request.json(), request.headers)
+    except ValueError as e:
+        trace.end(status_code=400)
+        return JSONResponse({"error": str(e)}, status_code=400)
+    except ConversationConflict as e:
+        trace.end(status_code=409)
+        return JSONResponse(conversation_conflict(e), status_code=409)
+    request_messages = compact_history(history)
+    trace.set_attributes(messages=len(request_messages))
+    key = answer_cache_key(request_messages)
+    lines = await run_blocking(answer_cache.backend.blocking, answer_cache.get, key) if key is not None else None
+    question = semantic_cache_question(request_messages) if lines is None else None
+    vector = None
+    if question is not None:
+        vector = await run_blocking(semantic_cache.embedder.blocking, semantic_cache.embed, question)
+    if vector is not None:
+        lines = semantic_cache.lookup(vector)
+    if lines is not None:
+        logger.debug("Answer found in cache, replaying it to the client")
+        if store_key is not None:
+            await run_blocking(store_blocking, conversation_store.save, store_key, history, lines)
+        trace.set_attributes(cached=True)
+        return StreamingResponse(trace.frames(replay_answer(lines, stream_format, stream_batching)),
+                                 media_type='text/event-stream', headers={STREAM_FORMAT_HEADER: stream_format})
+
+    record = key is not None or vector is not None or (store_key is not None and conversation_store.enabled)
+    tokens = request_tokens(request_messages, settings.max_tokens)
+
+    async def find_answer():
+        if hedger.enabled:
+            return await hedged_first_frame(client, request_messages, tokens, stream_format, record, trace)
+        return await sequential_first_frame(client, request_messages, tokens, stream_format, record, trace)
+
+    def answer_frames(data_stream, recorder):
+        logger.debug("Data stream received, sending response to client")
+        if recorder is None:
+            return data_stream
+
+        async def store(lines):
+            await run_blocking(answer_cache.enabled and answer_cache.backend.blocking, cache_answer, request_messages, key,
+                               question, vector, lines)
+            if store_key is not None:
+                await run_blocking(store_blocking, conversation_store.save, store_key, history, lines)
+        return cache_when_complete(data_stream, recorder, store)
+
+    if stream_progress.applies(stream_format):
+        return AnswerResponse(trace.aframes(stream_progress.astream(find_answer, answer_frames, NO_ANSWER_ERROR)),
+                              media_type='text/event-stream', headers={STREAM_FORMAT_HEADER: stream_format})
+
+    data_stream, first_frame, recorder = await find_answer()
+    if first_frame is not None:
+        frames = answer_frames(data_stream, recorder)
+        return AnswerResponse(trace.aframes(replay_first_frame(first_frame, data_stream, frames)),
+                              media_type='text/event-stream', headers={STREAM_FORMAT_HEADER: stream_format})
+
+    logger.error("Giving up and returning an error")
+    trace.end(answered=False)
+    return Response(json.dumps({"error": NO_ANSWER_ERROR}) + "\n", media_type="text/html")
+
+
+async def cache_index_version(request):
+    if not cache_admin_authorized(request.headers):
+        return JSONResponse({"error": "forbidden"}, status_code=403)
+    try:
+        body = await request.json()
+    except ValueError:
+        body = None
+    index_version = requested_index_version(body)
+    if index_version is None:
+        return JSONResponse({"error": "index_version is required"}, status_code=400)
+    dropped = semantic_cache.set_index_version(index_version)
+    if answer_cache.enabled:
+        await run_blocking(answer_cache.backend.blocking, answer_cache.clear)
+    return JSONResponse({"index_version": semantic_cache.index_version, "semantic_answers_dropped": dropped})
+
+
+# -----------------------------------------------------------------------------
+# Monitoring
+# -----------------------------------------------------------------------------
+async def upstream_status(request):
+    return JSONResponse({
+        "async_client": request.app.state.upstream.stats(),
+        "balancer": region_balancer.stats(),
+        "breakers": region_breakers.stats(),
+        "timeouts": upstream_timeouts.stats(),
+        "resume": stream_resume.stats(),
+        "hedging": hedger.stats(),
+        "rate_limits": region_limiters.stats(),
+        "answer_cache": answer_cache.stats(),
+        "semantic_cache": semantic_cache.stats(),
+        "history": history_compactor.stats(),
+        "conversations": conversation_store.stats(),
+        "stream_batching": stream_batching.stats(),
+        "disconnects": stream_disconnects.stats(),
+        "token_budget": context_budgets.stats(),
+        "tracing": tracing.stats(),
+        "transcripts": upstream_recorder.stats(),
+        "logging": log_pipeline.stats()
+    })
+
+
+async def metrics(request):
+    if not upstream_metrics.enabled:
+        return JSONResponse({"error": "metrics are disabled"}, status_code=404)
+    body, content_type = upstream_metrics.render()
+    return Response(body, headers={"Content-Type": content_type})
+
+
+# -----------------------------------------------------------------------------
+# App factory
+# -----------------------------------------------------------------------------
+def create_app():
+    @contextlib.asynccontextmanager
+    async def lifespan(app):
+        app.state.upstream = AsyncUpstreamClient.from_env(upstream_timeouts)
+        # loading the encoding may download it, which must not happen on the event loop
+        await asyncio.to_thread(lambda: token_counter.encoding)
+        logger.info("create_app: ASGI application starting")
+        yield
+        await app.state.upstream.aclose()
+
+    routes = [
+        Route("/", index),
+        Route("/favicon.ico", favicon),
+        Mount("/assets", StaticFiles(directory=os.path.join(STATIC_FOLDER, "assets"), check_dir=False)),
+        Route("/conversation", conversation, methods=["GET", "POST"]),
+        Route("/cache/index_version", cache_index_version, methods=["POST"]),
+        Route("/upstream/status", upstream_status, methods=["GET"]),
+        Route("/metrics", metrics, methods=["GET"]),
+    ]
+    return Starlette(routes=routes, lifespan=lifespan)
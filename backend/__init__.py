@@ -0,0 +1 @@
+"""Shared building blocks for the chat backend (app.py and its serving variants)."""
@@ -0,0 +1,94 @@
+"""Async counterpart of backend.upstream, used by the ASGI serving mode (app_asgi.py)."""
+import asyncio
+import logging
+import os
+from typing import AsyncIterator, Optional
+
+import httpx
+
+from backend.upstream import (DEFAULT_IDLE_TIMEOUT, PHASE_CONNECT, PHASE_FIRST_BYTE, PHASE_IDLE, UpstreamStalled,
+                              UpstreamTimeouts)
+
+logger = logging.getLogger(__name__)
+
+# one event loop holds every in-flight stream of the process, so the pool is much larger
+# than the per-thread pool of a uwsgi worker
+DEFAULT_ASYNC_MAX_CONNECTIONS = 1000
+
+
+class AsyncUpstreamClient(object):
+    """Keep-alive `httpx.AsyncClient` shared by every request of the ASGI process."""
+
+    def __init__(self, max_connections: int = DEFAULT_ASYNC_MAX_CONNECTIONS, idle_timeout: float = DEFAULT_IDLE_TIMEOUT,
+                 timeouts: Optional[UpstreamTimeouts] = None, transport: Optional[httpx.AsyncBaseTransport] = None):
+        self.max_connections = max_connections
+        self.idle_timeout = idle_timeout
+        self.timeouts = timeouts or UpstreamTimeouts()
+        limits = httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections,
+                              keepalive_expiry=idle_timeout)
+        timeout = httpx.Timeout(self.timeouts.connect, read=self.timeouts.first_byte)
+        # `transport` replaces the network, e.g. with a `backend.transcripts.AsyncReplayTransport`
+        self.client = httpx.AsyncClient(limits=limits, timeout=timeout, transport=transport)
+        self.requests = 0
+        self.active_streams = 0
+
+    @classmethod
+    def from_env(cls, timeouts: Optional[UpstreamTimeouts] = None):
+        max_connections = os.environ.get("AZURE_OPENAI_ASYNC_MAX_CONNECTIONS", DEFAULT_ASYNC_MAX_CONNECTIONS)
+        idle_timeout = os.environ.get("AZURE_OPENAI_POOL_IDLE_TIMEOUT", DEFAULT_IDLE_TIMEOUT)
+        return cls(max_connections=int(max_connections), idle_timeout=float(idle_timeout),
+                   timeouts=timeouts or UpstreamTimeouts.from_env())
+
+    async def open_stream(self, endpoint: str, body: bytes, headers: dict) -> httpx.Response:
+        """Sends the request and returns as soon as the response headers have arrived.
+
+        Like the read timeout of `requests`, the first-byte timeout covers the wait for the
+        headers, past it UpstreamStalled is raised. The caller owns the response and must
+        `aclose()` it, reading its body with `aiter_chunks`.
+        """
+        request = self.client.build_request("POST", endpoint, content=body, headers=headers)
+        self.requests += 1
+        try:
+            response = await self.client.send(request, stream=True)
+        except httpx.ReadTimeout as e:
+            raise UpstreamStalled(PHASE_FIRST_BYTE, self.timeouts.first_byte) from e
+        # httpcore takes the read timeout of the body from this request extension when the body is
+        # first read; aiter_chunks times the body instead, its timeout changes after the first chunk
+        request.extensions["timeout"] = dict(request.extensions.get("timeout", {}), read=None)
+        return response
+
+    async def aiter_chunks(self, response: httpx.Response) -> AsyncIterator[bytes]:
+        """The body of a streaming response, timed like `backend.upstream.iter_chunks`."""
+        chunks = response.aiter_bytes().__aiter__()
+        phase, timeout = PHASE_FIRST_BYTE, self.timeouts.first_byte
+        while True:
+            try:
+                async with asyncio.timeout(timeout):
+                    chunk = await chunks.__anext__()
+            except StopAsyncIteration:
+                return
+            except TimeoutError as e:
+                raise UpstreamStalled(phase, timeout) from e
+            yield chunk
+            phase, timeout = PHASE_IDLE, self.timeouts.idle
+
+    async def aclose(self):
+        await self.client.aclose()
+
+    def stats(self) -> dict:
+        return {
+            "pid": os.getpid(),
+            "max_connections": self.max_connections,
+            "idle_timeout": self.idle_timeout,
+            "requests": self.requests,
+            "active_streams": self.active_streams
+        }
+
+
+def timeout_phase(error: Exception) -> Optional[str]:
+    """The phase whose timeout an `open_stream` exception reports, None for other failures."""
+    if isinstance(error, UpstreamStalled):
+        return error.phase
+    if isinstance(error, (httpx.ConnectTimeout, httpx.PoolTimeout)):
+        return PHASE_CONNECT
+    return None
@@ -0,0 +1,194 @@
+"""Latency-aware selection of the Azure OpenAI region that serves a request.
+
+The balancer keeps exponentially weighted moving averages (EWMA) of the connect time, the
+time to first token and the error and throttling (429) rates of every region, shared by all
+requests of the worker process. Every region gets a score (expected latency, inflated by its
+recent error rate and its in-flight requests) and a pluggable strategy turns the scores into
+a choice. Error rates and latencies decay back to their optimistic defaults while a region
+receives no traffic, so a region that was avoided after a bad spell is probed again after a
+while instead of being starved forever.
+"""
+import math
+import os
+import random
+import threading
+import time
+from abc import ABC, abstractmethod
+from typing import Dict, Iterable, List, Optional
+
+OUTCOME_SUCCESS = "success"
+OUTCOME_ERROR = "error"
+OUTCOME_THROTTLED = "throttled"
+OUTCOME_CANCELLED = "cancelled"
+
+DEFAULT_ALPHA = 0.3
+DEFAULT_DECAY_SECONDS = 30
+# assumed latency of a region nobody has measured yet; optimistic so new regions get explored
+DEFAULT_INITIAL_LATENCY = 0.5
+ERROR_PENALTY = 10
+THROTTLE_PENALTY = 5
+IN_FLIGHT_PENALTY = 0.1
+
+
+class RegionStats(object):
+    def __init__(self, initial_latency: float = DEFAULT_INITIAL_LATENCY):
+        self.connect_time = None
+        self.first_token_time = None
+        self.error_rate = 0.0
+        self.throttle_rate = 0.0
+        self.in_flight = 0
+        self.requests = 0
+        self.initial_latency = initial_latency
+        self.last_outcome_at = time.monotonic()
+        self.last_sample_at = self.last_outcome_at
+
+    def decayed(self, rate: float, now: float, decay_seconds: float) -> float:
+        return rate * math.exp(-(now - self.last_outcome_at) / decay_seconds)
+
+    def latency(self, now: float, decay_seconds: float) -> float:
+        if self.first_token_time is not None:
+            observed = self.first_token_time
+        elif self.connect_time is not None:
+            observed = self.connect_time + self.initial_latency
+        else:
+            return self.initial_latency
+        freshness = math.exp(-(now - self.last_sample_at) / decay_seconds)
+        return self.initial_latency + (observed - self.initial_latency) * freshness
+
+    def to_dict(self, now: float, decay_seconds: float) -> dict:
+        return {
+            "connect_time": None if self.connect_time is None else round(self.connect_time, 4),
+            "first_token_time": None if self.first_token_time is None else round(self.first_token_time, 4),
+            "error_rate": round(self.decayed(self.error_rate, now, decay_seconds), 4),
+            "throttle_rate": round(self.decayed(self.throttle_rate, now, decay_seconds), 4),
+            "in_flight": self.in_flight,
+            "requests": self.requests
+        }
+
+
+class SelectionStrategy(ABC):
+    """Chooses one of the candidate regions given their scores (lower is better)."""
+
+    name = ""
+
+    @abstractmethod
+    def select(self, scores: Dict[int, float]) -> int:
+        pass
+
+
+class PowerOfTwoChoices(SelectionStrategy):
+    """Samples two candidate regions at random and takes the one with the better score."""
+
+    name = "p2c"
+
+    def select(self, scores):
+        candidates = list(scores.keys())
+        if len(candidates) == 1:
+            return candidates[0]
+        first, second = random.sample(candidates, 2)
+        return first if scores[first] <= scores[second] else second
+
+
+class WeightedLeastLatency(SelectionStrategy):
+    """Picks a region at random, weighted by the inverse of its score."""
+
+    name = "least_latency"
+
+    def select(self, scores):
+        candidates = list(scores.keys())
+        weights = [1 / max(scores[ndx], 1e-3) for ndx in candidates]
+        return random.choices(candidates, weights=weights)[0]
+
+
+class RandomChoice(SelectionStrategy):
+    """Ignores the scores, like the original random.randint based selection."""
+
+    name = "random"
+
+    def select(self, scores):
+        return random.choice(list(scores.keys()))
+
+
+STRATEGIES = {strategy.name: strategy for strategy in (PowerOfTwoChoices, WeightedLeastLatency, RandomChoice)}
+
+
+class RegionBalancer(object):
+    def __init__(self, regions: int, strategy: Optional[SelectionStrategy] = None, alpha: float = DEFAULT_ALPHA,
+                 decay_seconds: float = DEFAULT_DECAY_SECONDS):
+        self.strategy = strategy or PowerOfTwoChoices()
+        self.alpha = alpha
+        self.decay_seconds = decay_seconds
+        self._lock = threading.Lock()
+        self._stats: List[RegionStats] = [RegionStats() for _ in range(regions)]
+
+    @classmethod
+    def from_env(cls, regions: int):
+        strategy_name = os.environ.get("AZURE_OPENAI_BALANCER", PowerOfTwoChoices.name).lower()
+        if strategy_name not in STRATEGIES:
+            raise ValueError(f"Unknown AZURE_OPENAI_BALANCER '{strategy_name}', expected one of {', '.join(STRATEGIES)}")
+        return cls(regions, strategy=STRATEGIES[strategy_name](),
+                   alpha=float(os.environ.get("AZURE_OPENAI_BALANCER_ALPHA", DEFAULT_ALPHA)),
+                   decay_seconds=float(os.environ.get("AZURE_OPENAI_BALANCER_DECAY_SECONDS", DEFAULT_DECAY_SECONDS)))
+
+    def _ewma(self, current: Optional[float], sample: float) -> float:
+        if current is None:
+            return sample
+        return self.alpha * sample + (1 - self.alpha) * current
+
+    def score(self, ndx: int, now: Optional[float] = None) -> float:
+        stats = self._stats[ndx]
+        now = time.monotonic() if now is None else now
+        error_rate = stats.decayed(stats.error_rate, now, self.decay_seconds)
+        throttle_rate = stats.decayed(stats.throttle_rate, now, self.decay_seconds)
+        penalty = 1 + ERROR_PENALTY * error_rate + THROTTLE_PENALTY * throttle_rate + IN_FLIGHT_PENALTY * stats.in_flight
+        return stats.latency(now, self.decay_seconds) * penalty
+
+    def choose(self, exclude: Iterable[int] = ()) -> Optional[int]:
+        """Returns the region for the next attempt, or None when every region is excluded."""
+        excluded = set(exclude)
+        with self._lock:
+            now = time.monotonic()
+            scores = {ndx: self.score(ndx, now) for ndx in range(len(self._stats)) if ndx not in excluded}
+            if not scores:
+                return None
+            return self.strategy.select(scores)
+
+    def start(self, ndx: int):
+        with self._lock:
+            self._stats[ndx].in_flight += 1
+            self._stats[ndx].requests += 1
+
+    def record_connect(self, ndx: int, seconds: float):
+        with self._lock:
+            stats = self._stats[ndx]
+            stats.connect_time = self._ewma(stats.connect_time, seconds)
+            stats.last_sample_at = time.monotonic()
+
+    def record_first_token(self, ndx: int, seconds: float):
+        with self._lock:
+            stats = self._stats[ndx]
+            stats.first_token_time = self._ewma(stats.first_token_time, seconds)
+            stats.last_sample_at = time.monotonic()
+
+    def finish(self, ndx: int, outcome: str):
+        """Records how an attempt started with `start` ended."""
+        with self._lock:
+            stats = self._stats[ndx]
+            stats.in_flight = max(stats.in_flight - 1, 0)
+            if outcome == OUTCOME_CANCELLED:
+                return
+            now = time.monotonic()
+            error_rate = stats.decayed(stats.error_rate, now, self.decay_seconds)
+            throttle_rate = stats.decayed(stats.throttle_rate, now, self.decay_seconds)
+            stats.error_rate = self._ewma(error_rate, 1.0 if outcome == OUTCOME_ERROR else 0.0)
+            stats.throttle_rate = self._ewma(throttle_rate, 1.0 if outcome == OUTCOME_THROTTLED else 0.0)
+            stats.last_outcome_at = now
+
+    def stats(self) -> dict:
+        with self._lock:
+            now = time.monotonic()
+            return {
+                "strategy": self.strategy.name,
+                "regions": [dict(stats.to_dict(now, self.decay_seconds), score=round(self.score(ndx, now), 4))
+                            for ndx, stats in enumerate(self._stats)]
+            }
@@ -0,0 +1,143 @@
+"""Per-region circuit breakers.
+
+A breaker is closed while its region works. After `failure_threshold` consecutive failures
+(timeouts, 5xx and 429 responses) it opens and the region is skipped immediately instead of
+every request waiting out the upstream timeout. After `open_seconds` it becomes half-open and
+lets a limited trickle of probe requests through: the first successful probe closes it again,
+a failed probe re-opens it.
+"""
+import collections
+import logging
+import os
+import threading
+import time
+from typing import List
+
+logger = logging.getLogger(__name__)
+
+STATE_CLOSED = "closed"
+STATE_OPEN = "open"
+STATE_HALF_OPEN = "half_open"
+
+DEFAULT_FAILURE_THRESHOLD = 3
+DEFAULT_OPEN_SECONDS = 30
+DEFAULT_HALF_OPEN_PROBES = 1
+TRANSITION_HISTORY = 20
+
+
+class CircuitBreaker(object):
+    def __init__(self, name: str, failure_threshold: int = DEFAULT_FAILURE_THRESHOLD,
+                 open_seconds: float = DEFAULT_OPEN_SECONDS, half_open_probes: int = DEFAULT_HALF_OPEN_PROBES):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.open_seconds = open_seconds
+        self.half_open_probes = half_open_probes
+        self.state = STATE_CLOSED
+        self.consecutive_failures = 0
+        self.opened_at = 0.0
+        self.probes_in_flight = 0
+        self.transitions = collections.deque(maxlen=TRANSITION_HISTORY)
+        self.transition_counts = collections.Counter()
+        self.rejected = 0
+
+    def _transition(self, state: str, now: float):
+        logger.warning(f"CircuitBreaker {self.name}: {self.state} -> {state}")
+        self.transitions.append({"from": self.state, "to": state, "at": time.time()})
+        self.transition_counts[f"{self.state}->{state}"] += 1
+        self.state = state
+        if state == STATE_OPEN:
+            self.opened_at = now
+            self.probes_in_flight = 0
+        elif state == STATE_CLOSED:
+            self.consecutive_failures = 0
+            self.probes_in_flight = 0
+
+    def _refresh(self, now: float):
+        if self.state == STATE_OPEN and now - self.opened_at >= self.open_seconds:
+            self._transition(STATE_HALF_OPEN, now)
+
+    def available(self, now: float) -> bool:
+        """Whether a request could be sent right now, without reserving a probe."""
+        self._refresh(now)
+        if self.state == STATE_CLOSED:
+            return True
+        if self.state == STATE_HALF_OPEN:
+            return self.probes_in_flight < self.half_open_probes
+        return False
+
+    def acquire(self, now: float) -> bool:
+        """Reserves the right to send a request; in half-open state this takes a probe slot."""
+        if not self.available(now):
+            self.rejected += 1
+            return False
+        if self.state == STATE_HALF_OPEN:
+            self.probes_in_flight += 1
+        return True
+
+    def record_success(self, now: float):
+        if self.state != STATE_CLOSED:
+            self._transition(STATE_CLOSED, now)
+        self.consecutive_failures = 0
+
+    def record_failure(self, now: float):
+        self.consecutive_failures += 1
+        if self.state == STATE_HALF_OPEN or (self.state == STATE_CLOSED and self.consecutive_failures >= self.failure_threshold):
+            self._transition(STATE_OPEN, now)
+
+    def release(self):
+        """Gives back a probe slot of a request that ended without telling anything about the region."""
+        if self.state == STATE_HALF_OPEN:
+            self.probes_in_flight = max(self.probes_in_flight - 1, 0)
+
+    def to_dict(self, now: float) -> dict:
+        return {
+            "state": self.state,
+            "consecutive_failures": self.consecutive_failures,
+            "open_for_seconds": round(now - self.opened_at, 3) if self.state == STATE_OPEN else None,
+            "probes_in_flight": self.probes_in_flight,
+            "rejected": self.rejected,
+            "transition_counts": dict(self.transition_counts),
+            "transitions": list(self.transitions)
+        }
+
+
+class RegionBreakers(object):
+    """The circuit breakers of all regions of the worker process, indexed like `openai_resources`."""
+
+    def __init__(self, names: List[str], failure_threshold: int = DEFAULT_FAILURE_THRESHOLD,
+                 open_seconds: float = DEFAULT_OPEN_SECONDS, half_open_probes: int = DEFAULT_HALF_OPEN_PROBES):
+        self._lock = threading.Lock()
+        self._breakers = [CircuitBreaker(str(name), failure_threshold, open_seconds, half_open_probes) for name in names]
+
+    @classmethod
+    def from_env(cls, names: List[str]):
+        return cls(names,
+                   failure_threshold=int(os.environ.get("AZURE_OPENAI_BREAKER_FAILURE_THRESHOLD", DEFAULT_FAILURE_THRESHOLD)),
+                   open_seconds=float(os.environ.get("AZURE_OPENAI_BREAKER_OPEN_SECONDS", DEFAULT_OPEN_SECONDS)),
+                   half_open_probes=int(os.environ.get("AZURE_OPENAI_BREAKER_HALF_OPEN_PROBES", DEFAULT_HALF_OPEN_PROBES)))
+
+    def unavailable(self) -> List[int]:
+        with self._lock:
+            now = time.monotonic()
+            return [ndx for ndx, breaker in enumerate(self._breakers) if not breaker.available(now)]
+
+    def acquire(self, ndx: int) -> bool:
+        with self._lock:
+            return self._breakers[ndx].acquire(time.monotonic())
+
+    def record_success(self, ndx: int):
+        with self._lock:
+            self._breakers[ndx].record_success(time.monotonic())
+
+    def record_failure(self, ndx: int):
+        with self._lock:
+            self._breakers[ndx].record_failure(time.monotonic())
+
+    def release(self, ndx: int):
+        with self._lock:
+            self._breakers[ndx].release()
+
+    def stats(self) -> list:
+        with self._lock:
+            now = time.monotonic()
+            return [dict(breaker.to_dict(now), region=breaker.name) for breaker in self._breakers]
@@ -0,0 +1,225 @@
+"""Exact-match cache of streamed answers.
+
+An answer is stored as the upstream lines it was streamed from, keyed on the normalized message
+history plus every setting that changes retrieval or generation. A hit is replayed through the
+same assembler as a live answer, so the client receives the same JSON lines in the stream format
+it negotiated. Only deterministic requests (temperature 0) are cached.
+
+Backends are pluggable: `MemoryCacheBackend` keeps an LRU per worker process, `RedisCacheBackend`
+shares the cache between workers and instances (eviction is then up to the Redis `maxmemory-policy`,
+e.g. `allkeys-lru`).
+"""
+import collections
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from abc import ABC, abstractmethod
+from typing import Iterator, List, Optional
+
+from backend import jsonutil
+from backend.streaming import StreamBatching, create_assembler
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_TTL = 3600
+DEFAULT_MAX_ENTRIES = 1000
+KEY_PREFIX = "answer-cache:"
+
+
+def normalize_text(text: str) -> str:
+    return " ".join((text or "").split()).casefold()
+
+
+def cache_key(messages: List[dict], settings: dict) -> str:
+    """Hash of the normalized message history and the retrieval and generation settings."""
+    history = [[message.get("role"), normalize_text(message.get("content"))] for message in messages]
+    payload = json.dumps({"messages": history, "settings": settings}, sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class CacheBackend(ABC):
+    # whether get and set do network I/O and must not run on an event loop
+    blocking = False
+
+    @abstractmethod
+    def get(self, key: str) -> Optional[list]:
+        pass
+
+    @abstractmethod
+    def set(self, key: str, lines: list, ttl: float):
+        pass
+
+    @abstractmethod
+    def clear(self):
+        pass
+
+    def stats(self) -> dict:
+        return {}
+
+
+class MemoryCacheBackend(CacheBackend):
+    """In-process LRU with a TTL per entry."""
+
+    def __init__(self, max_entries: int = DEFAULT_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries = collections.OrderedDict()
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires_at, lines = entry
+            if expires_at <= time.monotonic():
+                del self._entries[key]
+                self.expirations += 1
+                return None
+            self._entries.move_to_end(key)
+            return lines
+
+    def set(self, key, lines, ttl):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + ttl, lines)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            return {"entries": len(self._entries), "max_entries": self.max_entries, "evictions": self.evictions,
+                    "expirations": self.expirations}
+
+
+class RedisCacheBackend(CacheBackend):
+    """Cache shared through Redis; needs the `redis` package."""
+
+    blocking = True
+
+    def __init__(self, url: str, prefix: str = KEY_PREFIX, setting: str = "ANSWER_CACHE_BACKEND"):
+        try:
+            import redis
+        except ImportError:
+            raise RuntimeError(f"{setting}=redis needs the redis package, pip install redis")
+        self._client = redis.Redis.from_url(url)
+        self.prefix = prefix
+
+    def get(self, key):
+        value = self._client.get(self.prefix + key)
+        return None if value is None else jsonutil.loads(value)
+
+    def set(self, key, lines, ttl):
+        self._client.set(self.prefix + key, jsonutil.dumps(lines), ex=max(int(ttl), 1))
+
+    def clear(self):
+        for key in self._client.scan_iter(match=self.prefix + "*"):
+            self._client.delete(key)
+
+
+class AnswerRecorder(object):
+    """Collects the upstream lines of an answer while it is streamed to the client."""
+
+    def __init__(self):
+        self.lines = []
+        self.complete = False
+
+    def record(self, line_json: dict):
+        self.lines.append(line_json)
+
+
+class AnswerCache(object):
+    def __init__(self, backend: Optional[CacheBackend] = None, ttl: float = DEFAULT_TTL):
+        self.backend = backend
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self.counters = collections.Counter()
+
+    @property
+    def enabled(self) -> bool:
+        return self.backend is not None
+
+    @classmethod
+    def from_env(cls):
+        backend_name = os.environ.get("ANSWER_CACHE_BACKEND", "none").lower()
+        if backend_name == "memory":
+            backend = MemoryCacheBackend(int(os.environ.get("ANSWER_CACHE_MAX_ENTRIES", DEFAULT_MAX_ENTRIES)))
+        elif backend_name == "redis":
+            backend = RedisCacheBackend(os.environ.get("ANSWER_CACHE_REDIS_URL", "redis://localhost:6379/0"))
+        elif backend_name == "none":
+            backend = None
+        else:
+            raise ValueError(f"Unknown ANSWER_CACHE_BACKEND '{backend_name}', expected one of none, memory, redis")
+        return cls(backend, ttl=float(os.environ.get("ANSWER_CACHE_TTL", DEFAULT_TTL)))
+
+    def _count(self, name: str):
+        with self._lock:
+            self.counters[name] += 1
+
+    def get(self, key: str) -> Optional[list]:
+        try:
+            lines = self.backend.get(key)
+        except Exception:
+            logger.exception("AnswerCache: lookup failed")
+            self._count("errors")
+            return None
+        self._count("hits" if lines is not None else "misses")
+        return lines
+
+    def set(self, key: str, lines: list):
+        try:
+            self.backend.set(key, lines, self.ttl)
+        except Exception:
+            logger.exception("AnswerCache: store failed")
+            self._count("errors")
+            return
+        self._count("stores")
+
+    def clear(self):
+        try:
+            self.backend.clear()
+        except Exception:
+            logger.exception("AnswerCache: clear failed")
+            self._count("errors")
+
+    def skip(self):
+        """Counts a request that cannot be cached, e.g. because its temperature is not 0."""
+        self._count("uncacheable")
+
+    def stats(self) -> dict:
+        with self._lock:
+            counters = dict(self.counters)
+        lookups = counters.get("hits", 0) + counters.get("misses", 0)
+        return {
+            "enabled": self.enabled,
+            "backend": type(self.backend).__name__ if self.backend else None,
+            "ttl": self.ttl,
+            "hits": counters.get("hits", 0),
+            "misses": counters.get("misses", 0),
+            "hit_rate": round(counters.get("hits", 0) / lookups, 4) if lookups else None,
+            "stores": counters.get("stores", 0),
+            "uncacheable": counters.get("uncacheable", 0),
+            "errors": counters.get("errors", 0),
+            **(self.backend.stats() if self.backend else {})
+        }
+
+
+def replay_answer(lines: list, stream_format: str, batching: Optional[StreamBatching] = None) -> Iterator[bytes]:
+    """Streams a cached answer in the given stream format, like stream_with_data does for a live one."""
+    assembler = create_assembler(stream_format, batching)
+    for line_json in lines:
+        frame = assembler.feed(line_json)
+        if frame is not None:
+            yield frame
+    frame = assembler.finish()
+    if frame is not None:
+        yield frame
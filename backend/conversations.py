@@ -0,0 +1,154 @@
+"""Server-held conversation history, so clients only send the new turn.
+
+A client that sends a `conversation_id` may send just its new user message together with
+`history_length`, the number of messages it already exchanged in that conversation. It only
+does so once a response carried the `X-Conversation-Store` header, which the server sets while
+it stores conversations. The server prepends the history it stored under that id. When the
+history is not there (expired, evicted, served by another instance) or does not have
+`history_length` messages (e.g. the client stopped an answer half way), the request is
+rejected with 409 and the client falls back to sending the full history with
+`full_history: true`, which seeds the store again.
+
+The history is stored once an answer streamed completely, using the cache backends: Redis to
+share it between workers and instances, or an in-process LRU, which only fits a single worker
+process. The store is off by default.
+"""
+import collections
+import logging
+import os
+import re
+import threading
+from typing import List, Optional
+
+from backend import jsonutil
+from backend.cache import CacheBackend, MemoryCacheBackend, RedisCacheBackend
+from backend.history import split_turns
+from backend.streaming import FORMAT_DELTA, create_assembler
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_TTL = 3600
+DEFAULT_MAX_ENTRIES = 1000
+DEFAULT_MAX_BYTES = 256 * 1024
+KEY_PREFIX = "conversation:"
+# set on the /conversation responses while conversations are stored
+CONVERSATION_STORE_HEADER = "X-Conversation-Store"
+CONVERSATION_ID_PATTERN = re.compile(r"^[A-Za-z0-9_-]{1,64}$")
+
+
+class ConversationConflict(Exception):
+    """The client sent only its new turn, but the server does not hold the history it builds on."""
+
+
+def answer_messages(lines: list) -> List[dict]:
+    """The messages of a streamed answer, as the client assembles them: the tool message and the assistant message."""
+    # the delta assembler renders the cheapest frames, which are not needed here
+    assembler = create_assembler(FORMAT_DELTA)
+    for line_json in lines:
+        assembler.feed(line_json)
+    return assembler.messages
+
+
+def is_valid_conversation_id(conversation_id) -> bool:
+    return isinstance(conversation_id, str) and CONVERSATION_ID_PATTERN.match(conversation_id) is not None
+
+
+class ConversationStore(object):
+    def __init__(self, backend: Optional[CacheBackend] = None, ttl: float = DEFAULT_TTL, max_bytes: int = DEFAULT_MAX_BYTES):
+        self.backend = backend
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self.counters = collections.Counter()
+
+    @property
+    def enabled(self) -> bool:
+        return self.backend is not None
+
+    @classmethod
+    def from_env(cls):
+        backend_name = os.environ.get("CONVERSATION_STORE_BACKEND", "none").lower()
+        if backend_name == "memory":
+            backend = MemoryCacheBackend(int(os.environ.get("CONVERSATION_STORE_MAX_ENTRIES", DEFAULT_MAX_ENTRIES)))
+        elif backend_name == "redis":
+            backend = RedisCacheBackend(os.environ.get("CONVERSATION_STORE_REDIS_URL", "redis://localhost:6379/0"),
+                                        prefix=KEY_PREFIX, setting="CONVERSATION_STORE_BACKEND")
+        elif backend_name == "none":
+            backend = None
+        else:
+            raise ValueError(f"Unknown CONVERSATION_STORE_BACKEND '{backend_name}', expected one of none, memory, redis")
+        return cls(backend, ttl=float(os.environ.get("CONVERSATION_STORE_TTL", DEFAULT_TTL)),
+                   max_bytes=int(os.environ.get("CONVERSATION_STORE_MAX_BYTES", DEFAULT_MAX_BYTES)))
+
+    def _count(self, name: str, n: int = 1):
+        with self._lock:
+            self.counters[name] += n
+
+    def resolve(self, key: str, body: dict) -> List[dict]:
+        """The full history of a /conversation request that carries a conversation id.
+
+        Raises ConversationConflict when the request only carries the new turn and the stored
+        history is missing or out of step with the client.
+        """
+        messages = body["messages"]
+        history_length = body.get("history_length", 0)
+        if body.get("full_history") or history_length == 0:
+            self._count("full_requests")
+            return messages
+        if not self.enabled:
+            raise ConversationConflict("the server does not store conversations")
+        try:
+            entry = self.backend.get(key)
+        except Exception:
+            logger.exception("ConversationStore: lookup failed")
+            self._count("errors")
+            entry = None
+        if entry is None:
+            self._count("misses")
+            raise ConversationConflict("conversation not found")
+        if entry["length"] != history_length:
+            self._count("conflicts")
+            raise ConversationConflict(f"the server holds {entry['length']} messages, the client {history_length}")
+        self._count("hits")
+        self._count("bytes_not_uploaded", len(jsonutil.dumps(entry["messages"])))
+        return entry["messages"] + messages
+
+    def save(self, key: str, messages: List[dict], answer_lines: list):
+        """Stores the history after a completed answer; the oldest turns are dropped beyond `max_bytes`."""
+        if not self.enabled:
+            return
+        history = messages + answer_messages(answer_lines)
+        length = len(history)
+        turns = split_turns(history)
+        turn_bytes = [len(jsonutil.dumps(turn)) for turn in turns]
+        while len(turns) > 1 and sum(turn_bytes) > self.max_bytes:
+            turns.pop(0)
+            turn_bytes.pop(0)
+            self._count("turns_pruned")
+        try:
+            # the length counts the pruned messages too: it is what the client holds
+            self.backend.set(key, {"messages": [message for turn in turns for message in turn], "length": length}, self.ttl)
+        except Exception:
+            logger.exception("ConversationStore: store failed")
+            self._count("errors")
+            return
+        self._count("saves")
+
+    def stats(self) -> dict:
+        with self._lock:
+            counters = dict(self.counters)
+        return {
+            "enabled": self.enabled,
+            "backend": type(self.backend).__name__ if self.backend else None,
+            "ttl": self.ttl,
+            "max_bytes": self.max_bytes,
+            "hits": counters.get("hits", 0),
+            "misses": counters.get("misses", 0),
+            "conflicts": counters.get("conflicts", 0),
+            "full_requests": counters.get("full_requests", 0),
+            "saves": counters.get("saves", 0),
+            "turns_pruned": counters.get("turns_pruned", 0),
+            "bytes_not_uploaded": counters.get("bytes_not_uploaded", 0),
+            "errors": counters.get("errors", 0),
+            **(self.backend.stats() if self.backend else {})
+        }
@@ -0,0 +1,127 @@
+"""Hedged upstream requests for the time-to-first-token tail.
+
+When the first upstream line of a request has not arrived after a delay taken from a high
+percentile of recently observed times to first token, a second request is sent to another
+region; the first one to produce a line wins and the other one is cancelled. A budget keeps
+the extra requests to a small fraction of all requests, so a region-wide slowdown cannot
+double the load on the remaining regions.
+"""
+import collections
+import os
+import threading
+from typing import Optional
+
+DEFAULT_PERCENTILE = 95
+DEFAULT_INITIAL_DELAY = 3.0
+DEFAULT_MIN_DELAY = 0.5
+DEFAULT_MAX_DELAY = 10.0
+DEFAULT_BUDGET = 0.05
+DEFAULT_WINDOW = 500
+MIN_SAMPLES = 20
+# how many hedges may be saved up while traffic is quiet
+MAX_BUDGET_BURST = 5
+
+
+class HedgePolicy(object):
+    """Derives the hedge delay from a sliding window of times to first token."""
+
+    def __init__(self, percentile: float = DEFAULT_PERCENTILE, initial_delay: float = DEFAULT_INITIAL_DELAY,
+                 min_delay: float = DEFAULT_MIN_DELAY, max_delay: float = DEFAULT_MAX_DELAY, window: int = DEFAULT_WINDOW):
+        self.percentile = percentile
+        self.initial_delay = initial_delay
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.samples = collections.deque(maxlen=window)
+
+    def observe(self, seconds: float):
+        self.samples.append(seconds)
+
+    def delay(self) -> float:
+        if len(self.samples) < MIN_SAMPLES:
+            return self.initial_delay
+        ordered = sorted(self.samples)
+        index = min(len(ordered) - 1, int(len(ordered) * self.percentile / 100))
+        return min(max(ordered[index], self.min_delay), self.max_delay)
+
+
+class HedgeBudget(object):
+    """Allows at most `ratio` hedged requests per primary request, with a small burst allowance."""
+
+    def __init__(self, ratio: float = DEFAULT_BUDGET, burst: float = MAX_BUDGET_BURST):
+        self.ratio = ratio
+        self.burst = burst
+        self.credits = 0.0
+
+    def deposit(self):
+        self.credits = min(self.credits + self.ratio, self.burst)
+
+    def withdraw(self) -> bool:
+        if self.credits < 1:
+            return False
+        self.credits -= 1
+        return True
+
+
+class Hedger(object):
+    """Hedging policy, budget and counters shared by every request of the worker process."""
+
+    def __init__(self, enabled: bool = False, policy: Optional[HedgePolicy] = None, budget: Optional[HedgeBudget] = None):
+        self.enabled = enabled
+        self.policy = policy or HedgePolicy()
+        self.budget = budget or HedgeBudget()
+        self._lock = threading.Lock()
+        self.counters = collections.Counter()
+
+    @classmethod
+    def from_env(cls):
+        enabled = os.environ.get("AZURE_OPENAI_HEDGING", "false").lower() == "true"
+        policy = HedgePolicy(percentile=float(os.environ.get("AZURE_OPENAI_HEDGE_PERCENTILE", DEFAULT_PERCENTILE)),
+                             initial_delay=float(os.environ.get("AZURE_OPENAI_HEDGE_INITIAL_DELAY", DEFAULT_INITIAL_DELAY)),
+                             min_delay=float(os.environ.get("AZURE_OPENAI_HEDGE_MIN_DELAY", DEFAULT_MIN_DELAY)),
+                             max_delay=float(os.environ.get("AZURE_OPENAI_HEDGE_MAX_DELAY", DEFAULT_MAX_DELAY)))
+        budget = HedgeBudget(ratio=float(os.environ.get("AZURE_OPENAI_HEDGE_BUDGET", DEFAULT_BUDGET)))
+        return cls(enabled=enabled, policy=policy, budget=budget)
+
+    def observe_first_token(self, seconds: float):
+        with self._lock:
+            self.policy.observe(seconds)
+
+    def start_request(self) -> float:
+        """Counts a primary request and returns how long to wait for its first line before hedging."""
+        with self._lock:
+            self.counters["requests"] += 1
+            self.budget.deposit()
+            return self.policy.delay()
+
+    def try_fire(self) -> bool:
+        with self._lock:
+            if not self.budget.withdraw():
+                self.counters["skipped_budget"] += 1
+                return False
+            self.counters["fired"] += 1
+            return True
+
+    def refund(self):
+        """Gives back a hedge that could not be sent, e.g. because no other region was available."""
+        with self._lock:
+            self.budget.credits += 1
+            self.counters["fired"] -= 1
+            self.counters["skipped_no_region"] += 1
+
+    def record_won(self):
+        with self._lock:
+            self.counters["won"] += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "enabled": self.enabled,
+                "delay": round(self.policy.delay(), 4),
+                "samples": len(self.policy.samples),
+                "budget_credits": round(self.budget.credits, 3),
+                "requests": self.counters["requests"],
+                "hedges_fired": self.counters["fired"],
+                "hedges_won": self.counters["won"],
+                "hedges_skipped_budget": self.counters["skipped_budget"],
+                "hedges_skipped_no_region": self.counters["skipped_no_region"]
+            }
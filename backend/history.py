@@ -0,0 +1,149 @@
+"""Compaction of the conversation history before it is forwarded upstream.
+
+The frontend sends back every prior message, including the `tool` messages that carry the full
+text of the retrieved citation chunks. Those are only useful for the answer they were retrieved
+for, so by the fifth turn most of the upload and of the prompt is stale citations. The
+compactor applies, in this order:
+
+- a tool message policy for every tool message before the last user message: `keep` it, `drop`
+  it, or `summarize` it down to the titles, URLs and file paths of its citations;
+- `max_turns`: only the last N turns (a user message and the messages that answer it) are kept;
+- `max_tokens`: the oldest turns are dropped until the history fits the token budget.
+
+The last user message is always kept.
+"""
+import collections
+import json
+import logging
+import os
+import threading
+from typing import Callable, List, Optional, Tuple
+
+from backend import jsonutil
+from backend.ratelimit import CHARS_PER_TOKEN, TOKENS_PER_MESSAGE
+
+logger = logging.getLogger(__name__)
+
+TOOL_KEEP = "keep"
+TOOL_DROP = "drop"
+TOOL_SUMMARIZE = "summarize"
+TOOL_POLICIES = (TOOL_KEEP, TOOL_DROP, TOOL_SUMMARIZE)
+CITATION_KEYS = ("title", "url", "filepath")
+
+
+def estimate_message_tokens(message: dict) -> int:
+    return len(message.get("content") or "") // CHARS_PER_TOKEN + TOKENS_PER_MESSAGE
+
+
+def summarize_tool_message(message: dict) -> dict:
+    """Keeps only where the citations of a tool message came from, not their text."""
+    try:
+        content = json.loads(message.get("content") or "")
+        citations = [{key: citation.get(key) for key in CITATION_KEYS if citation.get(key)}
+                     for citation in content.get("citations", [])]
+        summary = {"citations": citations}
+        if content.get("intent"):
+            summary["intent"] = content["intent"]
+    except (ValueError, AttributeError):
+        return message
+    return dict(message, content=json.dumps(summary))
+
+
+def split_turns(messages: List[dict]) -> List[List[dict]]:
+    """Groups the messages into turns, each starting with a user message."""
+    turns = []
+    for message in messages:
+        if message.get("role") == "user" or not turns:
+            turns.append([])
+        turns[-1].append(message)
+    return turns
+
+
+class CompactionReport(object):
+    def __init__(self, messages_before: int, bytes_before: int, tokens_before: int):
+        self.messages_before = messages_before
+        self.bytes_before = bytes_before
+        self.tokens_before = tokens_before
+        self.messages_after = messages_before
+        self.bytes_after = bytes_before
+        self.tokens_after = tokens_before
+
+    @property
+    def bytes_saved(self) -> int:
+        return self.bytes_before - self.bytes_after
+
+    @property
+    def tokens_saved(self) -> int:
+        return self.tokens_before - self.tokens_after
+
+
+class HistoryCompactor(object):
+    def __init__(self, tool_policy: str = TOOL_KEEP, max_turns: int = 0, max_tokens: int = 0,
+                 count_tokens: Callable[[dict], int] = estimate_message_tokens):
+        if tool_policy not in TOOL_POLICIES:
+            raise ValueError(f"Unknown HISTORY_TOOL_MESSAGES '{tool_policy}', expected one of {', '.join(TOOL_POLICIES)}")
+        self.tool_policy = tool_policy
+        self.max_turns = max_turns
+        self.max_tokens = max_tokens
+        self.count_tokens = count_tokens
+        self._lock = threading.Lock()
+        self.counters = collections.Counter()
+
+    @classmethod
+    def from_env(cls, count_tokens: Callable[[dict], int] = estimate_message_tokens):
+        return cls(tool_policy=os.environ.get("HISTORY_TOOL_MESSAGES", TOOL_KEEP).lower(),
+                   max_turns=int(os.environ.get("HISTORY_MAX_TURNS", 0)),
+                   max_tokens=int(os.environ.get("HISTORY_MAX_TOKENS", 0)),
+                   count_tokens=count_tokens)
+
+    @property
+    def enabled(self) -> bool:
+        return self.tool_policy != TOOL_KEEP or self.max_turns > 0 or self.max_tokens > 0
+
+    def _measure(self, messages: List[dict]):
+        return len(jsonutil.dumps(messages)), sum(self.count_tokens(message) for message in messages)
+
+    def compact(self, messages: List[dict]) -> Tuple[List[dict], Optional[CompactionReport]]:
+        """Returns the compacted messages and a report of what was saved, None when compaction is off."""
+        if not self.enabled:
+            return messages, None
+        report = CompactionReport(len(messages), *self._measure(messages))
+
+        turns = split_turns(messages)
+        if self.tool_policy != TOOL_KEEP:
+            for turn in turns[:-1]:
+                if self.tool_policy == TOOL_DROP:
+                    turn[:] = [message for message in turn if message.get("role") != "tool"]
+                else:
+                    turn[:] = [summarize_tool_message(message) if message.get("role") == "tool" else message
+                               for message in turn]
+        if self.max_turns > 0:
+            turns = turns[-self.max_turns:]
+        if self.max_tokens > 0:
+            turn_tokens = [sum(self.count_tokens(message) for message in turn) for turn in turns]
+            while len(turns) > 1 and sum(turn_tokens) > self.max_tokens:
+                turns.pop(0)
+                turn_tokens.pop(0)
+
+        compacted = [message for turn in turns for message in turn]
+        report.messages_after = len(compacted)
+        report.bytes_after, report.tokens_after = self._measure(compacted)
+        with self._lock:
+            self.counters["requests"] += 1
+            self.counters["messages_dropped"] += report.messages_before - report.messages_after
+            self.counters["bytes_saved"] += report.bytes_saved
+            self.counters["tokens_saved"] += report.tokens_saved
+        return compacted, report
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "enabled": self.enabled,
+                "tool_messages": self.tool_policy,
+                "max_turns": self.max_turns,
+                "max_tokens": self.max_tokens,
+                "requests": self.counters["requests"],
+                "messages_dropped": self.counters["messages_dropped"],
+                "bytes_saved": self.counters["bytes_saved"],
+                "tokens_saved": self.counters["tokens_saved"]
+            }
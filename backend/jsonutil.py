@@ -0,0 +1,66 @@
+"""JSON encoding and decoding for the /conversation stream path.
+
+Uses orjson when it is installed, then ujson, then the standard library; JSON_BACKEND picks one
+explicitly. Whatever the backend, `dumps` returns UTF-8 bytes without raw newlines, so
+a frame is the encoded object plus b"\\n", and `loads` takes the bytes of an upstream event's
+data as they are.
+"""
+import json
+import logging
+import os
+from collections import namedtuple
+
+logger = logging.getLogger(__name__)
+
+BACKENDS = ("orjson", "ujson", "json")
+
+JsonCodec = namedtuple("JsonCodec", ["name", "loads", "dumps"])
+
+
+def _orjson_codec():
+    import orjson
+
+    return JsonCodec("orjson", orjson.loads, orjson.dumps)
+
+
+def _ujson_codec():
+    import ujson
+
+    def dumps(obj) -> bytes:
+        return ujson.dumps(obj, ensure_ascii=False, escape_forward_slashes=False).encode("utf-8")
+
+    return JsonCodec("ujson", ujson.loads, dumps)
+
+
+def _json_codec():
+    def dumps(obj) -> bytes:
+        return json.dumps(obj).encode("utf-8")
+
+    return JsonCodec("json", json.loads, dumps)
+
+
+_FACTORIES = {"orjson": _orjson_codec, "ujson": _ujson_codec, "json": _json_codec}
+
+
+def get_codec(name: str = "auto") -> JsonCodec:
+    """The codec of backend `name`; `auto` is the fastest one installed."""
+    name = name.lower()
+    if name == "auto":
+        for candidate in BACKENDS:
+            try:
+                return _FACTORIES[candidate]()
+            except ImportError:
+                continue
+    if name not in _FACTORIES:
+        raise ValueError(f"Unknown JSON_BACKEND '{name}', expected one of auto, {', '.join(BACKENDS)}")
+    try:
+        return _FACTORIES[name]()
+    except ImportError:
+        raise RuntimeError(f"JSON_BACKEND={name} needs the {name} package, pip install {name}")
+
+
+codec = get_codec(os.environ.get("JSON_BACKEND", "auto"))
+logger.info(f"jsonutil: using {codec.name}")
+
+loads = codec.loads
+dumps = codec.dumps
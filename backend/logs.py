@@ -0,0 +1,207 @@
+"""Logging of the app, off the request path.
+
+Every logger's records go through a bounded queue to a background thread. That thread hands
+them to the real handlers: stderr, and Application Insights when it is configured. A slow
+handler therefore never holds up a request or a stream. When the queue is full the records
+are dropped and counted. Only the message is formatted on the request's thread.
+
+Before a record is queued, it may be thrown away:
+- LOG_SAMPLE_RATIO keeps that fraction of the records below WARNING;
+- LOG_RATE_LIMIT lets each call site (file and line) log that many records per second, with
+  bursts of up to one second's worth. The next record of the site tells how many were
+  suppressed.
+
+Each /conversation request is logged once, when it ends, as a structured summary. The
+summary holds the request id, the stream format, every region tried with its outcome and
+timings, the time to the first frame and the duration. The fields are the
+`custom_dimensions` of the record; AzureLogHandler sends them as properties of the trace.
+Summaries are never sampled or rate limited. `backend.tracing.RequestTrace` gathers them
+along with the spans.
+"""
+import atexit
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import threading
+import time
+from typing import List, Optional
+
+from backend import jsonutil
+
+DEFAULT_LEVEL = "INFO"
+DEFAULT_QUEUE_SIZE = 10000
+LOG_FORMAT = "%(asctime)s - %(levelname)s - %(message)s"
+
+
+class _JsonFields(object):
+    """The fields of a summary, serialized when the record is formatted."""
+
+    def __init__(self, fields: dict):
+        self.fields = fields
+
+    def __str__(self):
+        return jsonutil.dumps(self.fields).decode("utf-8")
+
+
+class SiteSampler(logging.Filter):
+    """Samples the records below WARNING and rate limits every call site."""
+
+    def __init__(self, sample_ratio: float = 1.0, rate_limit: float = 0.0):
+        super().__init__()
+        self.sample_ratio = sample_ratio
+        self.rate_limit = rate_limit
+        self.sampled_out = 0
+        self.rate_limited = 0
+        self._lock = threading.Lock()
+        # (pathname, lineno) -> [tokens, last refill, suppressed since the last record]
+        self._sites = {}
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if getattr(record, "request_summary", False):
+            return True
+        if record.levelno < logging.WARNING and self.sample_ratio < 1.0 and random.random() >= self.sample_ratio:
+            with self._lock:
+                self.sampled_out += 1
+            return False
+        if not self.rate_limit:
+            return True
+        now = time.monotonic()
+        with self._lock:
+            site = self._sites.get((record.pathname, record.lineno))
+            if site is None:
+                site = self._sites[(record.pathname, record.lineno)] = [self.rate_limit, now, 0]
+            site[0] = min(self.rate_limit, site[0] + (now - site[1]) * self.rate_limit)
+            site[1] = now
+            if site[0] < 1:
+                site[2] += 1
+                self.rate_limited += 1
+                return False
+            site[0] -= 1
+            suppressed, site[2] = site[2], 0
+        if suppressed:
+            record.msg = f"{record.getMessage()} ({suppressed} similar records suppressed)"
+            record.args = None
+        return True
+
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    """Queues the records without blocking, dropping them when the queue is full."""
+
+    def __init__(self, pipeline: "LogPipeline"):
+        super().__init__(None)
+        self.pipeline = pipeline
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        if getattr(record, "request_summary", False):
+            # nothing changes the fields of an ended request: serialized by the listener thread
+            return record
+        # the message is frozen here, its arguments may change once the caller goes on; the rest
+        # of the formatting (time, traceback) happens on the listener thread
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        if self.pipeline.pid != os.getpid():
+            # forked into a uwsgi worker: the listener thread stayed in the parent
+            self.pipeline.start()
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class _QueueListener(logging.handlers.QueueListener):
+    def enqueue_sentinel(self):
+        # waits for room in a full queue, the records before the sentinel are written out
+        self.queue.put(self._sentinel)
+
+
+class LogPipeline(object):
+    """The logging set-up of the process: the root logger's records go through a queue to `handlers`."""
+
+    def __init__(self, level: str = DEFAULT_LEVEL, queue_size: int = DEFAULT_QUEUE_SIZE, sample_ratio: float = 1.0,
+                 rate_limit: float = 0.0, summaries: bool = True):
+        self.level = level.upper()
+        self.queue_size = queue_size
+        self.summaries = summaries
+        self.sampler = SiteSampler(sample_ratio, rate_limit)
+        self.handler = _QueueHandler(self)
+        self.handler.addFilter(self.sampler)
+        self.handlers: List[logging.Handler] = []
+        self.listener: Optional[logging.handlers.QueueListener] = None
+        self.pid = None
+        self.summary_logger = logging.getLogger(__name__)
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls):
+        return cls(level=os.environ.get("LOG_LEVEL", DEFAULT_LEVEL),
+                   queue_size=int(os.environ.get("LOG_QUEUE_SIZE", DEFAULT_QUEUE_SIZE)),
+                   sample_ratio=float(os.environ.get("LOG_SAMPLE_RATIO", 1.0)),
+                   rate_limit=float(os.environ.get("LOG_RATE_LIMIT", 0.0)),
+                   summaries=os.environ.get("LOG_REQUEST_SUMMARY", "true").lower() == "true")
+
+    def install(self, handlers: List[logging.Handler], summary_logger: Optional[logging.Logger] = None):
+        """Replaces the handlers of the root logger with the queue in front of `handlers`.
+
+        The summaries are logged by `summary_logger`, this module's logger by default.
+        """
+        self.handlers = handlers
+        if summary_logger is not None:
+            self.summary_logger = summary_logger
+        root = logging.getLogger()
+        for handler in list(root.handlers):
+            root.removeHandler(handler)
+        root.setLevel(self.level)
+        root.addHandler(self.handler)
+        self.start()
+        atexit.register(self.stop)
+
+    def start(self):
+        """Starts the listener thread of this process, with a new queue."""
+        with self._lock:
+            if self.pid == os.getpid():
+                return
+            # a queue inherited from the parent may have been locked by one of its threads
+            self.handler.queue = queue.Queue(self.queue_size)
+            self.listener = _QueueListener(self.handler.queue, *self.handlers, respect_handler_level=True)
+            self.listener.start()
+            self.pid = os.getpid()
+
+    def stop(self):
+        """Writes out the queued records and stops the listener thread; the records logged after
+        that, while the process exits, go to the handlers directly."""
+        root = logging.getLogger()
+        root.removeHandler(self.handler)
+        for handler in self.handlers:
+            root.addHandler(handler)
+        with self._lock:
+            if self.listener is not None and self.pid == os.getpid():
+                self.listener.stop()
+            self.listener = None
+
+    def summarize(self, fields: dict):
+        """Logs the summary of a request."""
+        # Application Insights takes flat properties: the lists of the regions tried go as JSON
+        dimensions = {key: value if isinstance(value, (str, int, float, bool))
+                      else jsonutil.dumps(value).decode("utf-8")
+                      for key, value in fields.items()}
+        self.summary_logger.info("request %s", _JsonFields(fields),
+                                 extra={"custom_dimensions": dimensions, "request_summary": True})
+
+    def stats(self) -> dict:
+        return {
+            "level": self.level,
+            "queued": self.handler.queue.qsize() if self.handler.queue is not None else 0,
+            "queue_size": self.queue_size,
+            "dropped": self.handler.dropped,
+            "sample_ratio": self.sampler.sample_ratio,
+            "sampled_out": self.sampler.sampled_out,
+            "rate_limit": self.sampler.rate_limit,
+            "rate_limited": self.sampler.rate_limited,
+            "summaries": self.summaries
+        }
@@ -0,0 +1,152 @@
+"""Prometheus metrics of the upstream requests, served by the /metrics endpoint.
+
+Every stream to a region ends with one observation of its connect time, time to first token,
+duration and generation speed (tokens per second after the first one), labelled by region,
+deployment and outcome. Counters add the retries, failovers, 429 answers and timeouts, and a
+gauge the streams in flight.
+
+uwsgi serves with several worker processes, each with its own metrics. When
+PROMETHEUS_MULTIPROC_DIR is set (before the workers start, it selects the storage of
+prometheus_client), every process writes its values to files in that directory and a scrape
+of any worker adds up those of all of them. A worker marks its files dead when it exits,
+through uwsgi's worker shutdown hook (also run for workers recycled by max-requests or a
+reload). A worker that is killed (harakiri, SIGKILL, out of memory) cannot, so the directory
+must be emptied every time the server starts; the files of a previous run would be added up too.
+
+prometheus_client is optional: without it the metrics are not collected and /metrics answers 404.
+"""
+import atexit
+import logging
+import os
+from typing import List, Optional, Tuple
+
+try:
+    import prometheus_client
+    from prometheus_client import multiprocess
+except ImportError:
+    prometheus_client = None
+
+logger = logging.getLogger(__name__)
+
+CONNECT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+FIRST_TOKEN_BUCKETS = (0.1, 0.25, 0.5, 0.75, 1, 1.5, 2, 3, 5, 7.5, 10, 15, 30)
+DURATION_BUCKETS = (0.5, 1, 2, 5, 10, 15, 20, 30, 45, 60, 90, 120)
+TOKENS_PER_SECOND_BUCKETS = (1, 2, 5, 10, 20, 30, 40, 50, 75, 100, 150, 200)
+
+FAILOVER_NO_ANSWER = "no_answer"
+FAILOVER_INTERRUPTED = "interrupted"
+
+
+def at_worker_exit(callback):
+    """Calls `callback` when this worker process exits: uwsgi's hook when served by uwsgi, atexit otherwise."""
+    try:
+        import uwsgi
+    except ImportError:
+        atexit.register(callback)
+        return
+    # uwsgi has one hook, the one already set is kept
+    previous = getattr(uwsgi, "atexit", None)
+
+    def exit_hook():
+        try:
+            callback()
+        finally:
+            if previous is not None:
+                previous()
+
+    uwsgi.atexit = exit_hook
+
+
+class UpstreamMetrics(object):
+    """The metrics of the requests to the regions, indexed like `openai_resources`."""
+
+    def __init__(self, resources: List[Optional[str]], models: List[Optional[str]], multiprocess_dir: Optional[str] = None):
+        self.regions: List[Tuple[str, str]] = [(resource or f"region{ndx}", model or "")
+                                                for ndx, (resource, model) in enumerate(zip(resources, models))]
+        self.multiprocess_dir = multiprocess_dir
+        self.enabled = prometheus_client is not None
+        if not self.enabled:
+            logger.warning("UpstreamMetrics: prometheus_client is not installed, metrics are disabled")
+            return
+        if multiprocess_dir is not None:
+            # the gauge values of a worker that is gone are dropped instead of added up forever; the
+            # pid is read at exit, uwsgi forks its workers after importing the app
+            at_worker_exit(lambda: multiprocess.mark_process_dead(os.getpid(), multiprocess_dir))
+        self.registry = prometheus_client.CollectorRegistry()
+        labels = ("region", "deployment", "outcome")
+        self.connect_time = prometheus_client.Histogram(
+            "aoai_upstream_connect_seconds", "Time to connect to a region and receive its response headers",
+            labels, buckets=CONNECT_BUCKETS, registry=self.registry)
+        self.first_token_time = prometheus_client.Histogram(
+            "aoai_upstream_first_token_seconds", "Time from sending the request to the first chunk of the answer",
+            labels, buckets=FIRST_TOKEN_BUCKETS, registry=self.registry)
+        self.duration = prometheus_client.Histogram(
+            "aoai_upstream_stream_seconds", "Time from sending the request to the end of the stream",
+            labels, buckets=DURATION_BUCKETS, registry=self.registry)
+        self.tokens_per_second = prometheus_client.Histogram(
+            "aoai_upstream_tokens_per_second", "Tokens streamed per second after the first one",
+            labels, buckets=TOKENS_PER_SECOND_BUCKETS, registry=self.registry)
+        self.retries = prometheus_client.Counter(
+            "aoai_upstream_retries", "Requests sent for a question after its first one, hedges included",
+            ("region", "deployment"), registry=self.registry)
+        self.failovers = prometheus_client.Counter(
+            "aoai_upstream_failovers", "Regions that failed a question, which was then sent to another region",
+            ("region", "deployment", "reason"), registry=self.registry)
+        self.throttled = prometheus_client.Counter(
+            "aoai_upstream_throttled", "429 answers of a region", ("region", "deployment"), registry=self.registry)
+        self.timeouts = prometheus_client.Counter(
+            "aoai_upstream_timeouts", "Upstream timeouts by phase", ("region", "deployment", "phase"),
+            registry=self.registry)
+        self.active_streams = prometheus_client.Gauge(
+            "aoai_upstream_active_streams", "Streams from a region in flight", ("region", "deployment"),
+            multiprocess_mode="livesum", registry=self.registry)
+
+    @classmethod
+    def from_env(cls, resources: List[Optional[str]], models: List[Optional[str]]):
+        return cls(resources, models, multiprocess_dir=os.environ.get("PROMETHEUS_MULTIPROC_DIR") or None)
+
+    def observe_stream(self, ndx: int, outcome: str, connect_time: Optional[float], first_token_time: Optional[float],
+                       duration: float, tokens: int = 0, streaming_time: float = 0.0):
+        """Records a finished request; the times a request did not get to are None."""
+        if not self.enabled:
+            return
+        labels = self.regions[ndx] + (outcome,)
+        if connect_time is not None:
+            self.connect_time.labels(*labels).observe(connect_time)
+        if first_token_time is not None:
+            self.first_token_time.labels(*labels).observe(first_token_time)
+        self.duration.labels(*labels).observe(duration)
+        if tokens > 1 and streaming_time > 0:
+            self.tokens_per_second.labels(*labels).observe((tokens - 1) / streaming_time)
+
+    def stream_started(self, ndx: int):
+        if self.enabled:
+            self.active_streams.labels(*self.regions[ndx]).inc()
+
+    def stream_ended(self, ndx: int):
+        if self.enabled:
+            self.active_streams.labels(*self.regions[ndx]).dec()
+
+    def record_retry(self, ndx: int):
+        if self.enabled:
+            self.retries.labels(*self.regions[ndx]).inc()
+
+    def record_failover(self, ndx: int, reason: str = FAILOVER_NO_ANSWER):
+        if self.enabled:
+            self.failovers.labels(*self.regions[ndx], reason).inc()
+
+    def record_throttled(self, ndx: int):
+        if self.enabled:
+            self.throttled.labels(*self.regions[ndx]).inc()
+
+    def record_timeout(self, ndx: int, phase: str):
+        if self.enabled:
+            self.timeouts.labels(*self.regions[ndx], phase).inc()
+
+    def render(self) -> Tuple[bytes, str]:
+        """The scrape body and its content type, summed over all processes in multiprocess mode."""
+        registry = self.registry
+        if self.multiprocess_dir is not None:
+            registry = prometheus_client.CollectorRegistry()
+            multiprocess.MultiProcessCollector(registry, path=self.multiprocess_dir)
+        return prometheus_client.generate_latest(registry), prometheus_client.CONTENT_TYPE_LATEST
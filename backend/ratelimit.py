@@ -0,0 +1,182 @@
+"""Client-side rate limiting per Azure OpenAI deployment.
+
+Every deployment has a tokens-per-minute (TPM) and a requests-per-minute (RPM) quota. Azure
+OpenAI counts the estimated prompt tokens plus `max_tokens` of a request against the TPM
+quota as soon as the request arrives, and enforces both quotas over 10 second windows. The
+limiter mirrors that with two token buckets per deployment that hold 10 seconds worth of
+quota, so a request is only sent to a deployment that has room for it instead of finding out
+with a 429. A `Retry-After` from a 429 blocks the deployment until it has passed.
+"""
+import os
+import threading
+import time
+from typing import Iterable, List, Optional
+
+# Azure OpenAI enforces the per-minute quotas over 10 second windows
+WINDOW_SECONDS = 10
+DEFAULT_MAX_WAIT = 5.0
+DEFAULT_RETRY_AFTER = 10.0
+# rough characters per token for English text, used when no tokenizer is at hand
+CHARS_PER_TOKEN = 4
+# overhead of every chat message: <|im_start|>{role}<|im_sep|>...<|im_end|>
+TOKENS_PER_MESSAGE = 4
+
+
+def default_worker_count() -> int:
+    """Number of uwsgi worker processes sharing the quota of a deployment."""
+    try:
+        import uwsgi
+        return max(int(uwsgi.numproc), 1)
+    except (ImportError, AttributeError, ValueError):
+        return 1
+
+
+def parse_retry_after(headers) -> float:
+    """Seconds to wait after a 429, from the `retry-after-ms` or `Retry-After` response header."""
+    retry_after_ms = headers.get("retry-after-ms")
+    if retry_after_ms:
+        try:
+            return float(retry_after_ms) / 1000
+        except ValueError:
+            pass
+    retry_after = headers.get("Retry-After")
+    if retry_after:
+        try:
+            return float(retry_after)
+        except ValueError:
+            # HTTP-date form, not sent by Azure OpenAI
+            pass
+    return DEFAULT_RETRY_AFTER
+
+
+class TokenBucket(object):
+    def __init__(self, per_minute: float):
+        self.capacity = per_minute * WINDOW_SECONDS / 60
+        self.refill_per_second = per_minute / 60
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.refill_per_second)
+        self.updated = now
+
+    def wait_time(self, amount: float, now: float) -> float:
+        """Seconds until `amount` can be taken; a request larger than the bucket only needs a full bucket."""
+        self._refill(now)
+        missing = min(amount, self.capacity) - self.tokens
+        return max(missing / self.refill_per_second, 0.0)
+
+    def take(self, amount: float):
+        self.tokens -= amount
+
+    def give_back(self, amount: float):
+        self.tokens = min(self.capacity, self.tokens + amount)
+
+
+class DeploymentLimiter(object):
+    def __init__(self, name: str, tokens_per_minute: Optional[float] = None, requests_per_minute: Optional[float] = None):
+        self.name = name
+        self.tokens = TokenBucket(tokens_per_minute) if tokens_per_minute else None
+        self.requests = TokenBucket(requests_per_minute) if requests_per_minute else None
+        self.blocked_until = 0.0
+        self.admitted = 0
+        self.throttled = 0
+
+    def wait_time(self, tokens: int, now: float) -> float:
+        wait = max(self.blocked_until - now, 0.0)
+        if self.tokens is not None:
+            wait = max(wait, self.tokens.wait_time(tokens, now))
+        if self.requests is not None:
+            wait = max(wait, self.requests.wait_time(1, now))
+        return wait
+
+    def take(self, tokens: int):
+        if self.tokens is not None:
+            self.tokens.take(tokens)
+        if self.requests is not None:
+            self.requests.take(1)
+        self.admitted += 1
+
+    def give_back(self, tokens: int):
+        if self.tokens is not None:
+            self.tokens.give_back(tokens)
+        if self.requests is not None:
+            self.requests.give_back(1)
+        self.admitted -= 1
+
+    def to_dict(self, now: float) -> dict:
+        return {
+            "tokens_available": None if self.tokens is None else round(self.tokens.tokens),
+            "requests_available": None if self.requests is None else round(self.requests.tokens, 2),
+            "blocked_for_seconds": round(max(self.blocked_until - now, 0.0), 3),
+            "admitted": self.admitted,
+            "throttled": self.throttled
+        }
+
+
+class DeploymentLimiters(object):
+    """The rate limiters of all deployments of the worker process, indexed like `openai_models`.
+
+    The configured quotas are those of the deployment; each uwsgi worker process enforces its
+    share of them.
+    """
+
+    def __init__(self, names: List[str], tokens_per_minute: List[Optional[float]], requests_per_minute: List[Optional[float]],
+                 max_wait: float = DEFAULT_MAX_WAIT, workers: Optional[int] = None):
+        workers = workers or default_worker_count()
+        self.max_wait = max_wait
+        self._lock = threading.Lock()
+        self._limiters = [DeploymentLimiter(str(name), tpm / workers if tpm else None, rpm / workers if rpm else None)
+                          for name, tpm, rpm in zip(names, tokens_per_minute, requests_per_minute)]
+
+    @classmethod
+    def from_env(cls, names: List[str], suffixes: List[str]):
+        def quota(name):
+            value = os.environ.get(name)
+            return float(value) if value else None
+
+        return cls(names,
+                   tokens_per_minute=[quota(f"AZURE_OPENAI_TPM{suffix}") for suffix in suffixes],
+                   requests_per_minute=[quota(f"AZURE_OPENAI_RPM{suffix}") for suffix in suffixes],
+                   max_wait=float(os.environ.get("AZURE_OPENAI_RATE_LIMIT_MAX_WAIT", DEFAULT_MAX_WAIT)))
+
+    def unavailable(self, tokens: int) -> List[int]:
+        """Deployments without room for a request of `tokens` tokens right now."""
+        with self._lock:
+            now = time.monotonic()
+            return [ndx for ndx, limiter in enumerate(self._limiters) if limiter.wait_time(tokens, now) > 0]
+
+    def acquire(self, ndx: int, tokens: int) -> bool:
+        """Takes a request of `tokens` tokens from the quota of a deployment, if it has room for it."""
+        with self._lock:
+            limiter = self._limiters[ndx]
+            if limiter.wait_time(tokens, time.monotonic()) > 0:
+                return False
+            limiter.take(tokens)
+            return True
+
+    def give_back(self, ndx: int, tokens: int):
+        """Returns the quota of a request that was acquired but never sent."""
+        with self._lock:
+            self._limiters[ndx].give_back(tokens)
+
+    def wait_time(self, candidates: Iterable[int], tokens: int) -> Optional[float]:
+        """Seconds until one of the candidate deployments has room for the request, None without candidates."""
+        with self._lock:
+            now = time.monotonic()
+            waits = [self._limiters[ndx].wait_time(tokens, now) for ndx in candidates]
+            return min(waits) if waits else None
+
+    def record_throttled(self, ndx: int, retry_after: float):
+        """Blocks a deployment that answered 429 until its `Retry-After` has passed."""
+        with self._lock:
+            limiter = self._limiters[ndx]
+            limiter.throttled += 1
+            limiter.blocked_until = max(limiter.blocked_until, time.monotonic() + retry_after)
+            if limiter.tokens is not None:
+                limiter.tokens.tokens = min(limiter.tokens.tokens, 0.0)
+
+    def stats(self) -> list:
+        with self._lock:
+            now = time.monotonic()
+            return [dict(limiter.to_dict(now), deployment=limiter.name) for limiter in self._limiters]
@@ -0,0 +1,136 @@
+"""Resumption of answers whose upstream stream broke off half-way.
+
+When the stream of a region stalls or drops after part of the answer was sent to the browser,
+the request is sent again to another region with the text delivered so far as a trailing
+assistant message, and an instruction to continue it appended to the system message
+(`roleInformation`). The user's question stays the last user turn: the "on your data"
+extension searches the index with it, so the continuation is grounded on the same documents
+as the interrupted answer. The continuation is spliced into the answer being streamed:
+
+- its tool and assistant messages are dropped, the client already has them;
+- its chunks get the metadata of the interrupted answer, so ids do not change mid-answer;
+- its first characters are held back until `SPLICE_WINDOW` of them have arrived, and a
+  restart of the text already sent, which models tend to produce, is cut off.
+
+The client sees a short pause in the answer and nothing else.
+"""
+import collections
+import os
+import threading
+from typing import List
+
+RESUME_INSTRUCTION = ("Your last answer was cut off. Continue it exactly where it stopped, without repeating any of "
+                      "it and without mentioning the interruption.")
+DEFAULT_RESUME_ATTEMPTS = 2
+# characters of the continuation held back to look for a repeat of the text already sent
+SPLICE_WINDOW = 96
+# shorter matches are more likely a coincidence than a repeat
+MIN_OVERLAP = 8
+
+
+class StreamInterrupted(Exception):
+    """The upstream stream of an answer broke off after its first chunk."""
+
+
+def continuation_messages(request_messages: list, delivered: str) -> list:
+    """The messages of the request that continues an answer of which `delivered` was sent."""
+    if not delivered:
+        # nothing of the answer was sent, ask again
+        return request_messages
+    return request_messages + [{"role": "assistant", "content": delivered}]
+
+
+def continuation_system_message(system_message: str) -> str:
+    """The system message of the requests that continue an answer."""
+    return f"{system_message}\n\n{RESUME_INSTRUCTION}" if system_message else RESUME_INSTRUCTION
+
+
+def overlap(delivered: str, continuation: str) -> int:
+    """The length of the longest start of `continuation` that `delivered` ends with.
+
+    Matches shorter than MIN_OVERLAP only count when the continuation repeats all of `delivered`.
+    """
+    for size in range(min(len(delivered), len(continuation)), 0, -1):
+        if size < MIN_OVERLAP and size < len(delivered):
+            break
+        if delivered.endswith(continuation[:size]):
+            return size
+    return 0
+
+
+class Splice(object):
+    """Turns the upstream chunks of a continuation into chunks of the interrupted answer.
+
+    `feed` takes one decoded upstream chunk and returns the chunks to pass on, `flush` the
+    held text when the stream ends without its `[DONE]` chunk. The streaming code sets
+    `completed` once the continuation has been streamed to its end.
+    """
+
+    def __init__(self, delivered: str, metadata: dict):
+        self.delivered = delivered[-SPLICE_WINDOW:]
+        self.metadata = dict(metadata)
+        self.spliced = False
+        self.overlap = 0
+        self.completed = False
+        self._held: List[str] = []
+        self._held_chars = 0
+
+    def feed(self, line_json: dict) -> List[dict]:
+        delta = line_json["choices"][0]["messages"][0]["delta"]
+        if "role" in delta:
+            return []
+        content = delta["content"]
+        if content == "[DONE]":
+            return self.flush() + [self._line(content)]
+        if self.spliced:
+            return [self._line(content)]
+        self._held.append(content)
+        self._held_chars += len(content)
+        if self._held_chars < SPLICE_WINDOW:
+            return []
+        return self.flush()
+
+    def flush(self) -> List[dict]:
+        if self.spliced:
+            return []
+        self.spliced = True
+        text = "".join(self._held)
+        self._held = []
+        self.overlap = overlap(self.delivered, text)
+        text = text[self.overlap:]
+        return [self._line(text)] if text else []
+
+    def _line(self, content: str) -> dict:
+        return {**self.metadata, "choices": [{"index": 0, "messages": [{"delta": {"content": content}}]}]}
+
+
+class StreamResume(object):
+    """Whether interrupted answers are resumed on another region, and how often that worked."""
+
+    def __init__(self, enabled: bool = False, attempts: int = DEFAULT_RESUME_ATTEMPTS):
+        self.enabled = enabled
+        self.attempts = attempts
+        self._lock = threading.Lock()
+        self.counters = collections.Counter()
+
+    @classmethod
+    def from_env(cls):
+        return cls(enabled=os.environ.get("AZURE_OPENAI_STREAM_RESUME", "false").lower() == "true",
+                   attempts=int(os.environ.get("AZURE_OPENAI_STREAM_RESUME_ATTEMPTS", DEFAULT_RESUME_ATTEMPTS)))
+
+    def record(self, event: str, count: int = 1):
+        with self._lock:
+            self.counters[event] += count
+
+    def stats(self) -> dict:
+        with self._lock:
+            counters = dict(self.counters)
+        return {
+            "enabled": self.enabled,
+            "attempts": self.attempts,
+            "interrupted": counters.get("interrupted", 0),
+            "resume_attempts": counters.get("attempt", 0),
+            "resumed": counters.get("resumed", 0),
+            "failed": counters.get("failed", 0),
+            "overlap_chars_dropped": counters.get("overlap_chars", 0)
+        }
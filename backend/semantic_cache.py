@@ -0,0 +1,270 @@
+"""Semantic cache for paraphrased single-turn questions.
+
+Questions are embedded into unit vectors and kept in a bounded in-memory index together with
+the upstream lines of their answer. A new single-turn question whose embedding has a cosine
+similarity of at least `threshold` with a cached question gets that answer replayed instead of
+a new retrieval and generation round trip.
+
+Cached answers depend on the content of the search index, so every entry is tagged with the
+index version it was generated from; changing the version (`set_index_version`, e.g. after a
+re-ingestion) drops all entries of older versions.
+
+The embedder is pluggable: `HashingEmbedder` is a deterministic local stand-in (hashed words and
+character trigrams, no network), `AzureOpenAIEmbedder` calls an Azure OpenAI embeddings deployment.
+"""
+import collections
+import hashlib
+import logging
+import math
+import os
+import threading
+import time
+from abc import ABC, abstractmethod
+from typing import List, Optional
+
+import requests
+
+from backend.ratelimit import CHARS_PER_TOKEN
+from backend.streaming import FORMAT_DELTA, create_assembler
+from backend.upstream import get_session_pool
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MAX_ENTRIES = 1000
+DEFAULT_TTL = 3600
+DEFAULT_DIMENSIONS = 512
+EMBEDDINGS_API_VERSION = "2023-05-15"
+
+
+def normalize(vector: List[float]) -> List[float]:
+    norm = math.sqrt(sum(value * value for value in vector))
+    if norm == 0:
+        return vector
+    return [value / norm for value in vector]
+
+
+class Embedder(ABC):
+    # whether embed does network I/O and must not run on an event loop
+    blocking = False
+    # similarity above which two questions count as paraphrases; depends on the embedding model
+    default_threshold = 0.9
+
+    @abstractmethod
+    def embed(self, text: str) -> List[float]:
+        """Returns the unit-length embedding of `text`."""
+
+
+class HashingEmbedder(Embedder):
+    """Deterministic bag of hashed words and character trigrams; paraphrases that share most of
+    their words land close together, unrelated questions do not."""
+
+    default_threshold = 0.85
+
+    def __init__(self, dimensions: int = DEFAULT_DIMENSIONS):
+        self.dimensions = dimensions
+
+    def _add(self, vector: List[float], feature: str, weight: float):
+        digest = hashlib.blake2b(feature.encode("utf-8"), digest_size=8).digest()
+        bucket = int.from_bytes(digest[:4], "little") % self.dimensions
+        sign = 1 if digest[4] & 1 else -1
+        vector[bucket] += sign * weight
+
+    def embed(self, text):
+        vector = [0.0] * self.dimensions
+        words = "".join(char if char.isalnum() else " " for char in text.casefold()).split()
+        for word in words:
+            self._add(vector, "w:" + word, 1.0)
+            padded = f" {word} "
+            for start in range(len(padded) - 2):
+                self._add(vector, "t:" + padded[start:start + 3], 0.5)
+        return normalize(vector)
+
+
+class AzureOpenAIEmbedder(Embedder):
+    """Embeds with an Azure OpenAI embeddings deployment, e.g. text-embedding-ada-002."""
+
+    blocking = True
+    # ada-002 similarities of unrelated questions are already around 0.75
+    default_threshold = 0.95
+
+    def __init__(self, base_url: str, deployment: str, key: str, session: Optional[requests.Session] = None):
+        self.endpoint = f"{base_url}/openai/deployments/{deployment}/embeddings?api-version={EMBEDDINGS_API_VERSION}"
+        self.key = key
+        self.session = session
+
+    def embed(self, text):
+        # the keep-alive connections to the resource are shared with the chat requests of the region
+        session = self.session or get_session_pool().session_for(self.endpoint)
+        r = session.post(self.endpoint, json={"input": text}, headers={"api-key": self.key}, timeout=5)
+        r.raise_for_status()
+        return normalize(r.json()["data"][0]["embedding"])
+
+
+class _Entry(object):
+    def __init__(self, vector, lines, index_version, tokens, expires_at):
+        self.vector = vector
+        self.lines = lines
+        self.index_version = index_version
+        self.tokens = tokens
+        self.expires_at = expires_at
+
+
+def answer_tokens(lines: list) -> int:
+    """Estimated tokens of the retrieved documents and the answer in the upstream lines of an answer."""
+    assembler = create_assembler(FORMAT_DELTA)
+    for line_json in lines:
+        assembler.feed(line_json)
+    chars = len(assembler.content)
+    if assembler.tool_message is not None:
+        chars += len(assembler.tool_message.get("content") or "")
+    return chars // CHARS_PER_TOKEN
+
+
+class VectorIndex(object):
+    """Bounded LRU of (vector, answer) entries with exhaustive cosine similarity search."""
+
+    def __init__(self, max_entries: int = DEFAULT_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self.entries = collections.OrderedDict()
+        self._matrix = None
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def add(self, key: str, entry: _Entry):
+        self.entries[key] = entry
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+        self._matrix = None
+
+    def remove(self, keys: List[str]):
+        for key in keys:
+            del self.entries[key]
+        if keys:
+            self._matrix = None
+
+    def nearest(self, vector: List[float]):
+        """Returns (key, similarity) of the most similar entry, or (None, 0) when the index is empty."""
+        if not self.entries:
+            return None, 0.0
+        keys = list(self.entries.keys())
+        if numpy is not None:
+            if self._matrix is None:
+                self._matrix = numpy.array([entry.vector for entry in self.entries.values()], dtype=numpy.float32)
+            similarities = self._matrix @ numpy.asarray(vector, dtype=numpy.float32)
+            best = int(similarities.argmax())
+            return keys[best], float(similarities[best])
+        best_key, best_similarity = None, -1.0
+        for key, entry in self.entries.items():
+            similarity = sum(a * b for a, b in zip(vector, entry.vector))
+            if similarity > best_similarity:
+                best_key, best_similarity = key, similarity
+        return best_key, best_similarity
+
+
+class SemanticCache(object):
+    def __init__(self, embedder: Optional[Embedder] = None, threshold: Optional[float] = None,
+                 max_entries: int = DEFAULT_MAX_ENTRIES, ttl: float = DEFAULT_TTL, index_version: str = ""):
+        self.embedder = embedder
+        if threshold is None:
+            threshold = embedder.default_threshold if embedder else Embedder.default_threshold
+        self.threshold = threshold
+        self.ttl = ttl
+        self.index_version = index_version
+        self._index = VectorIndex(max_entries)
+        self._lock = threading.Lock()
+        self.counters = collections.Counter()
+
+    @property
+    def enabled(self) -> bool:
+        return self.embedder is not None
+
+    @classmethod
+    def from_env(cls, base_url: str, key: str):
+        embedder_name = os.environ.get("SEMANTIC_CACHE_EMBEDDER", "none").lower()
+        if embedder_name == "hashing":
+            embedder = HashingEmbedder()
+        elif embedder_name == "azure":
+            deployment = os.environ.get("SEMANTIC_CACHE_EMBEDDING_DEPLOYMENT", "text-embedding-ada-002")
+            embedder = AzureOpenAIEmbedder(base_url, deployment, key)
+        elif embedder_name == "none":
+            embedder = None
+        else:
+            raise ValueError(f"Unknown SEMANTIC_CACHE_EMBEDDER '{embedder_name}', expected one of none, hashing, azure")
+        threshold = os.environ.get("SEMANTIC_CACHE_THRESHOLD")
+        return cls(embedder,
+                   threshold=float(threshold) if threshold else None,
+                   max_entries=int(os.environ.get("SEMANTIC_CACHE_MAX_ENTRIES", DEFAULT_MAX_ENTRIES)),
+                   ttl=float(os.environ.get("SEMANTIC_CACHE_TTL", DEFAULT_TTL)),
+                   index_version=os.environ.get("SEMANTIC_CACHE_INDEX_VERSION", ""))
+
+    def embed(self, question: str) -> Optional[List[float]]:
+        try:
+            return self.embedder.embed(question)
+        except Exception:
+            logger.exception("SemanticCache: embedding failed")
+            with self._lock:
+                self.counters["errors"] += 1
+            return None
+
+    def lookup(self, vector: List[float]) -> Optional[list]:
+        """Returns the upstream lines of the answer to the most similar cached question above the threshold."""
+        with self._lock:
+            now = time.monotonic()
+            expired = [key for key, entry in self._index.entries.items() if entry.expires_at <= now]
+            self._index.remove(expired)
+            self.counters["expirations"] += len(expired)
+            key, similarity = self._index.nearest(vector)
+            if key is None or similarity < self.threshold:
+                self.counters["misses"] += 1
+                return None
+            entry = self._index.entries[key]
+            self._index.entries.move_to_end(key)
+            self.counters["hits"] += 1
+            self.counters["saved_tokens"] += entry.tokens
+            return entry.lines
+
+    def store(self, question: str, vector: List[float], lines: list, prompt_tokens: int):
+        entry = _Entry(vector, lines, self.index_version, prompt_tokens + answer_tokens(lines), time.monotonic() + self.ttl)
+        with self._lock:
+            self._index.add(hashlib.sha256(question.encode("utf-8")).hexdigest(), entry)
+            self.counters["stores"] += 1
+
+    def set_index_version(self, index_version: str) -> int:
+        """Invalidation hook for search index updates: drops the answers of other index versions."""
+        with self._lock:
+            self.index_version = index_version
+            stale = [key for key, entry in self._index.entries.items() if entry.index_version != index_version]
+            self._index.remove(stale)
+            self.counters["invalidated"] += len(stale)
+            logger.info(f"SemanticCache: index version {index_version}, dropped {len(stale)} answers")
+            return len(stale)
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.counters["hits"] + self.counters["misses"]
+            return {
+                "enabled": self.enabled,
+                "embedder": type(self.embedder).__name__ if self.embedder else None,
+                "threshold": self.threshold,
+                "index_version": self.index_version,
+                "entries": len(self._index),
+                "max_entries": self._index.max_entries,
+                "hits": self.counters["hits"],
+                "misses": self.counters["misses"],
+                "hit_rate": round(self.counters["hits"] / lookups, 4) if lookups else None,
+                "saved_upstream_tokens": self.counters["saved_tokens"],
+                "stores": self.counters["stores"],
+                "evictions": self._index.evictions,
+                "expirations": self.counters["expirations"],
+                "invalidated": self.counters["invalidated"],
+                "errors": self.counters["errors"]
+            }
@@ -0,0 +1,203 @@
+"""Immutable app settings and the per-region upstream request templates built from them.
+
+The environment is read, converted and validated once at startup. Everything in an upstream
+request that does not depend on the conversation (the generation parameters, the
+`dataSources` block, the headers and the endpoint of each region) is rendered into a
+`RequestTemplate`, so preparing a request only has to serialize the messages.
+"""
+import json
+import logging
+import os
+from dataclasses import dataclass
+from types import MappingProxyType
+from typing import Mapping, Optional, Tuple
+
+from backend import jsonutil
+from backend.resume import continuation_system_message
+
+logger = logging.getLogger(__name__)
+
+# env var suffixes of the regions, in the order of openai_resources
+REGION_ENV_SUFFIXES = ("", "_NC", "_US2")
+CHAT_MODEL_NAMES = ("gpt-35-turbo-4k", "gpt-35-turbo-16k")
+CHATGPT_API_VERSION = "2023-03-15-preview"
+USER_AGENT = "GitHubSampleWebApp/PublicAPI/1.0.0"
+
+
+def _bool(value: Optional[str], default: bool) -> bool:
+    if value is None or value == "":
+        return default
+    return value.lower() == "true"
+
+
+def _split(value: Optional[str]) -> Tuple[str, ...]:
+    return tuple(value.split("|")) if value else ()
+
+
+def _number(environ: Mapping[str, str], name: str, default, convert):
+    value = environ.get(name)
+    if value is None or value == "":
+        return default
+    try:
+        return convert(value)
+    except ValueError:
+        raise ValueError(f"{name} must be a {convert.__name__}, got '{value}'")
+
+
+@dataclass(frozen=True)
+class RegionSettings:
+    resource: Optional[str]
+    key: Optional[str]
+    model: Optional[str]
+    model_name: Optional[str]
+
+    @property
+    def configured(self) -> bool:
+        return bool(self.resource and self.key and self.model)
+
+
+@dataclass(frozen=True)
+class Settings:
+    search_service: Optional[str]
+    search_index: Optional[str]
+    search_key: Optional[str]
+    search_use_semantic_search: bool
+    search_semantic_search_config: str
+    search_top_k: int
+    search_enable_in_domain: bool
+    search_content_columns: Tuple[str, ...]
+    search_filename_column: Optional[str]
+    search_title_column: Optional[str]
+    search_url_column: Optional[str]
+    temperature: float
+    top_p: float
+    max_tokens: int
+    stop_sequence: Tuple[str, ...]
+    system_message: str
+    preview_api_version: str
+    base_url_template: str
+    stream: bool
+    regions: Tuple[RegionSettings, ...]
+
+    def __post_init__(self):
+        if not 0 <= self.temperature <= 2:
+            raise ValueError(f"AZURE_OPENAI_TEMPERATURE must be between 0 and 2, got {self.temperature}")
+        if not 0 <= self.top_p <= 1:
+            raise ValueError(f"AZURE_OPENAI_TOP_P must be between 0 and 1, got {self.top_p}")
+        if self.max_tokens <= 0:
+            raise ValueError(f"AZURE_OPENAI_MAX_TOKENS must be positive, got {self.max_tokens}")
+        if self.search_top_k <= 0:
+            raise ValueError(f"AZURE_SEARCH_TOP_K must be positive, got {self.search_top_k}")
+        if "{resource}" not in self.base_url_template:
+            raise ValueError("AZURE_OPENAI_BASE_URL_TEMPLATE must contain {resource}")
+        for suffix, region in zip(REGION_ENV_SUFFIXES, self.regions):
+            if not region.configured:
+                logger.warning(f"Settings: region AZURE_OPENAI_RESOURCE{suffix} is not fully configured")
+
+    @classmethod
+    def from_env(cls, environ: Mapping[str, str] = os.environ):
+        return cls(
+            search_service=environ.get("AZURE_SEARCH_SERVICE"),
+            search_index=environ.get("AZURE_SEARCH_INDEX"),
+            search_key=environ.get("AZURE_SEARCH_KEY"),
+            search_use_semantic_search=_bool(environ.get("AZURE_SEARCH_USE_SEMANTIC_SEARCH"), False),
+            search_semantic_search_config=environ.get("AZURE_SEARCH_SEMANTIC_SEARCH_CONFIG", "default"),
+            search_top_k=_number(environ, "AZURE_SEARCH_TOP_K", 5, int),
+            search_enable_in_domain=_bool(environ.get("AZURE_SEARCH_ENABLE_IN_DOMAIN"), True),
+            search_content_columns=_split(environ.get("AZURE_SEARCH_CONTENT_COLUMNS")),
+            search_filename_column=environ.get("AZURE_SEARCH_FILENAME_COLUMN") or None,
+            search_title_column=environ.get("AZURE_SEARCH_TITLE_COLUMN") or None,
+            search_url_column=environ.get("AZURE_SEARCH_URL_COLUMN") or None,
+            temperature=_number(environ, "AZURE_OPENAI_TEMPERATURE", 0.0, float),
+            top_p=_number(environ, "AZURE_OPENAI_TOP_P", 1.0, float),
+            max_tokens=_number(environ, "AZURE_OPENAI_MAX_TOKENS", 1000, int),
+            stop_sequence=_split(environ.get("AZURE_OPENAI_STOP_SEQUENCE")),
+            system_message=environ.get("AZURE_OPENAI_SYSTEM_MESSAGE", "You are an AI assistant that helps people find information."),
+            preview_api_version=environ.get("AZURE_OPENAI_PREVIEW_API_VERSION", "2023-06-01-preview"),
+            base_url_template=environ.get("AZURE_OPENAI_BASE_URL_TEMPLATE", "https://{resource}.openai.azure.com"),
+            stream=_bool(environ.get("AZURE_OPENAI_STREAM"), True),
+            regions=tuple(RegionSettings(resource=environ.get(f"AZURE_OPENAI_RESOURCE{suffix}"),
+                                         key=environ.get(f"AZURE_OPENAI_KEY{suffix}"),
+                                         model=environ.get(f"AZURE_OPENAI_MODEL{suffix}"),
+                                         model_name=environ.get(f"AZURE_OPENAI_MODEL_NAME{suffix}"))
+                          for suffix in REGION_ENV_SUFFIXES)
+        )
+
+    def base_url(self, region: RegionSettings) -> str:
+        return self.base_url_template.format(resource=region.resource)
+
+    def is_chat_model(self, region: RegionSettings) -> bool:
+        # regions without their own model name run the model of the primary region
+        model_name = (region.model_name or self.regions[0].model_name or "").lower()
+        return "gpt-4" in model_name or model_name in CHAT_MODEL_NAMES
+
+    def request_body(self, system_message: Optional[str] = None) -> dict:
+        """The upstream request body without the messages, with `system_message` instead of the configured one."""
+        return {
+            "temperature": self.temperature,
+            "max_tokens": self.max_tokens,
+            "top_p": self.top_p,
+            "stop": list(self.stop_sequence) if self.stop_sequence else None,
+            "stream": self.stream,
+            "dataSources": [
+                {
+                    "type": "AzureCognitiveSearch",
+                    "parameters": {
+                        "endpoint": f"https://{self.search_service}.search.windows.net",
+                        "key": self.search_key,
+                        "indexName": self.search_index,
+                        "fieldsMapping": {
+                            "contentField": list(self.search_content_columns),
+                            "titleField": self.search_title_column,
+                            "urlField": self.search_url_column,
+                            "filepathField": self.search_filename_column
+                        },
+                        "inScope": self.search_enable_in_domain,
+                        "topNDocuments": self.search_top_k,
+                        "queryType": "semantic" if self.search_use_semantic_search else "simple",
+                        "semanticConfiguration": self.search_semantic_search_config if self.search_use_semantic_search else "",
+                        "roleInformation": self.system_message if system_message is None else system_message
+                    }
+                }
+            ]
+        }
+
+
+class RequestTemplate(object):
+    """The upstream request of one region, rendered once; `render` only adds the messages."""
+
+    def __init__(self, settings: Settings, region: RegionSettings):
+        base_url = settings.base_url(region)
+        self.endpoint = (f"{base_url}/openai/deployments/{region.model}/extensions/chat/completions"
+                         f"?api-version={settings.preview_api_version}")
+        chatgpt_url = f"https://{region.resource}.openai.azure.com/openai/deployments/{region.model}"
+        if settings.is_chat_model(region):
+            chatgpt_url += f"/chat/completions?api-version={CHATGPT_API_VERSION}"
+        else:
+            chatgpt_url += f"/completions?api-version={CHATGPT_API_VERSION}"
+        self.headers = MappingProxyType({
+            'Content-Type': 'application/json',
+            'api-key': region.key,
+            'chatgpt_url': chatgpt_url,
+            'chatgpt_key': region.key,
+            "x-ms-useragent": USER_AGENT
+        })
+        # the serialized body up to where the messages go: '{"temperature": ..., "messages": '
+        self._body_prefix = self._prefix(settings.request_body())
+        # the same for the requests that continue an interrupted answer, see backend/resume.py
+        self._continuation_prefix = self._prefix(
+            settings.request_body(continuation_system_message(settings.system_message)))
+
+    @staticmethod
+    def _prefix(body: dict) -> bytes:
+        return (json.dumps(body)[:-1] + ', "messages": ').encode("utf-8")
+
+    def render(self, messages: list, continuation: bool = False) -> Tuple[bytes, dict]:
+        """Returns the serialized body and the headers of the request for `messages`; with
+        `continuation`, of the request continuing the partial answer that ends `messages`."""
+        prefix = self._continuation_prefix if continuation else self._body_prefix
+        return prefix + jsonutil.dumps(messages) + b"}", dict(self.headers)
+
+
+def build_request_templates(settings: Settings) -> Tuple[RequestTemplate, ...]:
+    return tuple(RequestTemplate(settings, region) for region in settings.regions)
@@ -0,0 +1,110 @@
+"""Incremental parser of server-sent event streams.
+
+The upstream answers with `text/event-stream`: events separated by a blank line, each made of
+`field: value` lines. The parser is fed the raw bytes as they arrive, in chunks of any size and
+cut anywhere, and returns the complete events. It implements the parts of the event stream
+format the upstream can send:
+
+- `data:` fields, several of which are joined with newlines into one event;
+- `event:`, `id:` and `retry:` fields;
+- comment lines starting with `:`, which proxies and servers use as keep-alives;
+- line breaks as `\\n`, `\\r\\n` or `\\r`.
+
+A `data: [DONE]` event is the end-of-stream sentinel of the OpenAI API; `is_done` detects it.
+Bytes are read in large chunks: upstream responses are chunked, so a read still returns as soon
+as an HTTP chunk arrives. Lines are found with one scan over the buffer and only the field
+values are sliced out of it.
+"""
+import re
+from collections import namedtuple
+from typing import AsyncIterable, Iterable, Iterator, List, Optional
+
+READ_SIZE = 65536
+DONE = b"[DONE]"
+
+_LINE_END = re.compile(rb"\r\n|\r|\n")
+
+ServerSentEvent = namedtuple("ServerSentEvent", ["event", "data", "id", "retry"])
+
+
+def is_done(event: ServerSentEvent) -> bool:
+    return event.data.strip() == DONE
+
+
+class SSEParser(object):
+    def __init__(self):
+        self._buffer = bytearray()
+        self._data: List[bytes] = []
+        self._event = ""
+        self.last_event_id = ""
+        self.retry: Optional[int] = None
+        self.comments = 0
+
+    def feed(self, chunk: bytes) -> List[ServerSentEvent]:
+        """Adds the next bytes of the stream and returns the events they complete."""
+        buffer = self._buffer
+        buffer += chunk
+        events = []
+        start = 0
+        end = len(buffer)
+        for match in _LINE_END.finditer(buffer):
+            if match.end() == end and buffer[-1] == 0x0d:
+                # a \r at the very end may be the first half of a \r\n cut by the chunking
+                break
+            self._line(buffer[start:match.start()], events)
+            start = match.end()
+        if start:
+            del buffer[:start]
+        return events
+
+    def finish(self) -> List[ServerSentEvent]:
+        """Ends the stream; a last event not followed by a blank line is still returned."""
+        events = []
+        if self._buffer:
+            self._line(self._buffer.rstrip(b"\r"), events)
+            self._buffer = bytearray()
+        self._line(b"", events)
+        return events
+
+    def _line(self, line, events: list):
+        if not line:
+            if self._data:
+                data = self._data[0] if len(self._data) == 1 else b"\n".join(self._data)
+                events.append(ServerSentEvent(self._event or "message", bytes(data), self.last_event_id, self.retry))
+            self._data = []
+            self._event = ""
+            return
+        if line[0] == 0x3a:
+            self.comments += 1
+            return
+        field, _, value = line.partition(b":")
+        if value[:1] == b" ":
+            value = value[1:]
+        if field == b"data":
+            self._data.append(value)
+        elif field == b"event":
+            self._event = value.decode("utf-8")
+        elif field == b"id":
+            if b"\0" not in value:
+                self.last_event_id = value.decode("utf-8")
+        elif field == b"retry":
+            if value.isdigit():
+                self.retry = int(value)
+
+
+def iter_events(chunks: Iterable[bytes]) -> Iterator[ServerSentEvent]:
+    """The events of a stream read as `chunks`, e.g. `response.iter_content(READ_SIZE)`."""
+    parser = SSEParser()
+    for chunk in chunks:
+        yield from parser.feed(chunk)
+    yield from parser.finish()
+
+
+async def aiter_events(chunks: AsyncIterable[bytes]):
+    """The events of a stream read as async `chunks`, e.g. `response.aiter_raw()`."""
+    parser = SSEParser()
+    async for chunk in chunks:
+        for event in parser.feed(chunk):
+            yield event
+    for event in parser.finish():
+        yield event
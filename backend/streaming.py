@@ -0,0 +1,458 @@
+"""Turns upstream chat completion chunks into the JSON-lines frames sent to the browser.
+
+Two wire formats are supported:
+
+- ``snapshot`` (legacy): every frame is the whole response accumulated so far.
+- ``delta``: the tool (citations) message and the assistant message are sent once as
+  ``{"message": {...}}`` frames, every later frame only carries the new text as
+  ``{"delta": "..."}`` and a final ``{"done": {...}}`` frame carries the ids and metadata.
+
+Clients opt in to the delta format with the ``X-Stream-Format: delta`` request header or the
+``stream_format=delta`` query parameter; the chosen format is echoed in the response header.
+
+Delta clients also get progress frames while the upstream is connecting: `{"accepted": true}`
+as soon as the request is taken, then `{"heartbeat": true}` every few seconds until the first
+frame of the answer, which keeps proxies from timing out idle responses. If no region answers,
+the stream ends with an `{"error": ...}` frame.
+
+With `StreamBatching`, the text of the answer is coalesced: the first token is sent at once,
+later tokens are held until `max_tokens` of them are pending or the oldest pending one has
+waited `window` seconds, then sent as one frame. That is one write, one flush and one browser
+render per batch instead of per token.
+
+When the browser goes away in the middle of an answer, the server stops writing to it and
+closes the answer's frames, which closes the upstream request so the model stops generating.
+`StreamDisconnects` counts these answers and estimates the completion tokens that were saved.
+"""
+import asyncio
+import collections
+import contextlib
+import logging
+import os
+import queue
+import threading
+import time
+from abc import ABC, abstractmethod
+from typing import AsyncIterator, Awaitable, Callable, List, Optional
+
+from backend import jsonutil
+
+STREAM_FORMAT_HEADER = "X-Stream-Format"
+STREAM_FORMAT_PARAM = "stream_format"
+FORMAT_SNAPSHOT = "snapshot"
+FORMAT_DELTA = "delta"
+
+logger = logging.getLogger(__name__)
+
+METADATA_KEYS = ("id", "model", "created", "object")
+DEFAULT_HEARTBEAT_SECONDS = 5
+DEFAULT_BATCH_WINDOW_MS = 30
+DEFAULT_BATCH_MAX_TOKENS = 16
+
+
+def negotiate_stream_format(headers, query_params) -> str:
+    """Returns the wire format requested by the client, defaulting to the legacy snapshots."""
+    requested = headers.get(STREAM_FORMAT_HEADER) or query_params.get(STREAM_FORMAT_PARAM) or ""
+    if requested.strip().lower() == FORMAT_DELTA:
+        return FORMAT_DELTA
+    return FORMAT_SNAPSHOT
+
+
+def format_frame(obj) -> bytes:
+    # the encoders never emit raw newlines, so every frame is exactly one line
+    return jsonutil.dumps(obj) + b"\n"
+
+
+def join_frames(first: Optional[bytes], second: Optional[bytes]) -> Optional[bytes]:
+    if first is None:
+        return second
+    if second is None:
+        return first
+    # frames are lines, so two of them can go out in one write
+    return first + second
+
+
+class StreamBatching(object):
+    """How the tokens of an answer are coalesced into frames; a window of 0 sends every token."""
+
+    def __init__(self, window: float = DEFAULT_BATCH_WINDOW_MS / 1000, max_tokens: int = DEFAULT_BATCH_MAX_TOKENS):
+        self.window = window
+        self.max_tokens = max_tokens
+        self._lock = threading.Lock()
+        self.counters = collections.Counter()
+
+    @classmethod
+    def from_env(cls):
+        return cls(window=float(os.environ.get("STREAM_BATCH_WINDOW_MS", DEFAULT_BATCH_WINDOW_MS)) / 1000,
+                   max_tokens=int(os.environ.get("STREAM_BATCH_MAX_TOKENS", DEFAULT_BATCH_MAX_TOKENS)))
+
+    @property
+    def enabled(self) -> bool:
+        return self.window > 0 and self.max_tokens > 1
+
+    def record(self, tokens: int, frames: int):
+        with self._lock:
+            self.counters["streams"] += 1
+            self.counters["tokens"] += tokens
+            self.counters["frames"] += frames
+
+    def stats(self) -> dict:
+        with self._lock:
+            counters = dict(self.counters)
+        frames = counters.get("frames", 0)
+        return {
+            "enabled": self.enabled,
+            "window_ms": round(self.window * 1000, 3),
+            "max_tokens": self.max_tokens,
+            "streams": counters.get("streams", 0),
+            "tokens": counters.get("tokens", 0),
+            "frames": frames,
+            "tokens_per_frame": round(counters.get("tokens", 0) / frames, 2) if frames else None
+        }
+
+
+class StreamDisconnects(object):
+    """Counts the answers abandoned by the browser while they were streaming.
+
+    The tokens an abandoned answer would still have produced are estimated from the mean
+    length of the answers that completed, capped at `max_tokens`, the limit of every request.
+    """
+
+    def __init__(self, max_tokens: int):
+        self.max_tokens = max_tokens
+        self._lock = threading.Lock()
+        self.counters = collections.Counter()
+
+    def expected_tokens(self) -> int:
+        with self._lock:
+            completed = self.counters["completed"]
+            tokens = self.counters["completed_tokens"]
+        if not completed:
+            return self.max_tokens
+        return min(round(tokens / completed), self.max_tokens)
+
+    def record_completed(self, tokens: int):
+        with self._lock:
+            self.counters["completed"] += 1
+            self.counters["completed_tokens"] += tokens
+
+    def record_disconnected(self, tokens: int):
+        saved = max(self.expected_tokens() - tokens, 0)
+        with self._lock:
+            self.counters["disconnected"] += 1
+            self.counters["disconnected_tokens"] += tokens
+            self.counters["saved_tokens"] += saved
+        logger.info(f"StreamDisconnects: client went away after {tokens} tokens, upstream closed")
+
+    def stats(self) -> dict:
+        with self._lock:
+            counters = dict(self.counters)
+        return {
+            "completed": counters.get("completed", 0),
+            "cancelled": counters.get("disconnected", 0),
+            "tokens_streamed_before_cancel": counters.get("disconnected_tokens", 0),
+            "completion_tokens_saved_estimate": counters.get("saved_tokens", 0),
+            "expected_tokens": self.expected_tokens()
+        }
+
+
+class StreamAssembler(ABC):
+    """Accumulates an upstream stream and renders the frames of one wire format.
+
+    `feed` takes one decoded upstream chunk and returns the frame to send, or None when
+    nothing needs to be sent for that chunk; `finish` returns the closing frame, if any.
+    With batching, `flush` returns the held text before `flush_deadline`, if the caller can
+    wake up for it; otherwise the text goes out with the next chunk past the deadline.
+    """
+
+    def __init__(self, batching: Optional[StreamBatching] = None):
+        self.metadata = {"id": "", "model": "", "created": 0, "object": ""}
+        self.tool_message = None
+        self.assistant_started = False
+        self.content_parts: List[str] = []
+        self.batching = batching if batching is not None and batching.enabled else None
+        self._pending: List[str] = []
+        self._pending_since = 0.0
+        self._tokens = 0
+        self._content_frames = 0
+
+    @property
+    def tokens(self) -> int:
+        """The content chunks of the answer received so far, one token each."""
+        return self._tokens
+
+    @property
+    def content(self) -> str:
+        return "".join(self.content_parts)
+
+    @property
+    def messages(self) -> list:
+        messages = []
+        if self.tool_message is not None:
+            messages.append(self.tool_message)
+        if self.assistant_started:
+            messages.append({"role": "assistant", "content": self.content})
+        return messages
+
+    def feed(self, line_json: dict) -> Optional[bytes]:
+        for key in METADATA_KEYS:
+            self.metadata[key] = line_json[key]
+
+        delta = line_json["choices"][0]["messages"][0]["delta"]
+        role = delta.get("role")
+        if role == "tool":
+            self.tool_message = delta
+            return self.on_tool_message(delta)
+        elif role == "assistant":
+            self.assistant_started = True
+            return self.on_assistant_message()
+
+        delta_text = delta["content"]
+        if delta_text == "[DONE]":
+            return join_frames(self.flush(), self.on_done())
+        self.content_parts.append(delta_text)
+        self._tokens += 1
+        if self.batching is None or self._tokens == 1:
+            # the first token is never held, it is what the user waits for
+            return self._content_frame(delta_text)
+        now = time.monotonic()
+        if not self._pending:
+            self._pending_since = now
+        self._pending.append(delta_text)
+        if len(self._pending) >= self.batching.max_tokens or now - self._pending_since >= self.batching.window:
+            return self.flush()
+        return None
+
+    @property
+    def flush_deadline(self) -> Optional[float]:
+        """The time.monotonic() by which the held text should be flushed, None when nothing is held."""
+        if not self._pending:
+            return None
+        return self._pending_since + self.batching.window
+
+    def flush(self) -> Optional[bytes]:
+        """The frame of the text held back by batching, if any."""
+        if not self._pending:
+            return None
+        delta_text = "".join(self._pending)
+        self._pending = []
+        return self._content_frame(delta_text)
+
+    def _content_frame(self, delta_text: str) -> Optional[bytes]:
+        frame = self.on_content(delta_text)
+        if frame is not None:
+            self._content_frames += 1
+        return frame
+
+    def finish(self) -> Optional[bytes]:
+        frame = join_frames(self.flush(), self.on_finish())
+        if self.batching is not None:
+            self.batching.record(self._tokens, self._content_frames)
+        return frame
+
+    def on_finish(self) -> Optional[bytes]:
+        return None
+
+    @abstractmethod
+    def on_tool_message(self, message: dict) -> Optional[bytes]:
+        pass
+
+    @abstractmethod
+    def on_assistant_message(self) -> Optional[bytes]:
+        pass
+
+    @abstractmethod
+    def on_content(self, delta_text: str) -> Optional[bytes]:
+        pass
+
+    @abstractmethod
+    def on_done(self) -> Optional[bytes]:
+        pass
+
+
+class SnapshotAssembler(StreamAssembler):
+    """Legacy format: re-sends the whole accumulated response for every upstream chunk."""
+
+    def snapshot(self) -> bytes:
+        return format_frame({
+            **self.metadata,
+            "choices": [{
+                "messages": self.messages
+            }]
+        })
+
+    def on_tool_message(self, message):
+        return self.snapshot()
+
+    def on_assistant_message(self):
+        return self.snapshot()
+
+    def on_content(self, delta_text):
+        return self.snapshot()
+
+    def on_done(self):
+        return self.snapshot()
+
+
+class DeltaAssembler(StreamAssembler):
+    """Delta format: every message is sent once, then only the new text of the answer."""
+
+    def on_tool_message(self, message):
+        return format_frame({"message": message})
+
+    def on_assistant_message(self):
+        return format_frame({"message": {"role": "assistant", "content": ""}})
+
+    def on_content(self, delta_text):
+        if not delta_text:
+            return None
+        return format_frame({"delta": delta_text})
+
+    def on_done(self):
+        return None
+
+    def on_finish(self):
+        return format_frame({"done": self.metadata})
+
+
+def create_assembler(stream_format: str, batching: Optional[StreamBatching] = None) -> StreamAssembler:
+    if stream_format == FORMAT_DELTA:
+        return DeltaAssembler(batching)
+    return SnapshotAssembler(batching)
+
+
+async def flush_when_due(events: AsyncIterator, assembler: StreamAssembler):
+    """Passes `events` through, yielding None whenever the held text of `assembler` is due while
+    the next event has not arrived yet; the caller then sends `assembler.flush()`."""
+    events = events.__aiter__()
+    next_event = None
+    try:
+        while True:
+            if next_event is None:
+                next_event = asyncio.ensure_future(events.__anext__())
+            deadline = assembler.flush_deadline
+            # asyncio.wait, not await: the cancellation of the caller, repeated by Starlette's cancel
+            # scope when the client leaves, must not reach the read while it closes the upstream
+            done, _ = await asyncio.wait({next_event}, timeout=None if deadline is None else max(deadline - time.monotonic(), 0))
+            if not done:
+                yield None
+                continue
+            try:
+                event = next_event.result()
+            except StopAsyncIteration:
+                return
+            next_event = None
+            yield event
+    finally:
+        if next_event is not None and not next_event.done():
+            next_event.cancel()
+
+
+class StreamProgress(object):
+    """Sends the progress frames of the delta format while the upstream is connecting.
+
+    `stream` (threads) and `astream` (asyncio) take `find_answer`, which returns
+    (data_stream, first_frame, recorder) like the first-frame functions of the apps, and
+    `answer_frames`, which wraps the data stream of the answer found.
+    """
+
+    def __init__(self, accepted: bool = True, heartbeat: float = DEFAULT_HEARTBEAT_SECONDS):
+        self.accepted = accepted
+        self.heartbeat = heartbeat
+
+    @classmethod
+    def from_env(cls):
+        return cls(accepted=os.environ.get("STREAM_ACCEPTED_FRAME", "true").lower() == "true",
+                   heartbeat=float(os.environ.get("STREAM_HEARTBEAT_SECONDS", DEFAULT_HEARTBEAT_SECONDS)))
+
+    def applies(self, stream_format: str) -> bool:
+        # snapshot clients take every frame for a whole response
+        return stream_format == FORMAT_DELTA and (self.accepted or self.heartbeat > 0)
+
+    def stream(self, find_answer: Callable, answer_frames: Callable, error: str):
+        if self.accepted:
+            yield format_frame({"accepted": True})
+        results = queue.Queue()
+        abandoned = threading.Event()
+
+        def probe():
+            try:
+                result = find_answer()
+            except Exception:
+                logger.exception("StreamProgress: finding an answer failed")
+                result = (None, None, None)
+            results.put(result)
+            if abandoned.is_set():
+                _close_abandoned(results)
+
+        threading.Thread(target=probe, daemon=True).start()
+        try:
+            while True:
+                try:
+                    data_stream, first_frame, recorder = results.get(timeout=self.heartbeat if self.heartbeat > 0 else None)
+                    break
+                except queue.Empty:
+                    yield format_frame({"heartbeat": True})
+        except GeneratorExit:
+            # the client left while the upstream was connecting: the answer must not be left open
+            abandoned.set()
+            _close_abandoned(results)
+            raise
+        if first_frame is None:
+            yield format_frame({"error": error})
+            return
+        # closed explicitly, the client may leave before the wrappers of the answer start
+        with contextlib.closing(data_stream):
+            yield first_frame
+            yield from answer_frames(data_stream, recorder)
+
+    async def astream(self, find_answer: Callable[[], Awaitable], answer_frames: Callable, error: str):
+        if self.accepted:
+            yield format_frame({"accepted": True})
+        task = asyncio.ensure_future(find_answer())
+        try:
+            while True:
+                done, _ = await asyncio.wait({task}, timeout=self.heartbeat if self.heartbeat > 0 else None)
+                if done:
+                    break
+                yield format_frame({"heartbeat": True})
+        except (GeneratorExit, asyncio.CancelledError):
+            # not awaited: a cancel scope of the server would cancel it again while it closes the upstream
+            task.add_done_callback(_aclose_abandoned)
+            task.cancel()
+            raise
+        try:
+            data_stream, first_frame, recorder = task.result()
+        except Exception:
+            logger.exception("StreamProgress: finding an answer failed")
+            first_frame = None
+        if first_frame is None:
+            yield format_frame({"error": error})
+            return
+        async with contextlib.aclosing(data_stream):
+            yield first_frame
+            async for frame in answer_frames(data_stream, recorder):
+                yield frame
+
+
+def _close_abandoned(results: queue.Queue):
+    try:
+        data_stream = results.get_nowait()[0]
+    except queue.Empty:
+        return
+    if data_stream is not None:
+        data_stream.close()
+
+
+_closing = set()
+
+
+def _aclose_abandoned(task: asyncio.Future):
+    if task.cancelled() or task.exception() is not None:
+        return
+    data_stream = task.result()[0]
+    if data_stream is not None:
+        # the event loop only keeps weak references to its tasks
+        closing = asyncio.ensure_future(data_stream.aclose())
+        _closing.add(closing)
+        closing.add_done_callback(_closing.discard)
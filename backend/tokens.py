@@ -0,0 +1,222 @@
+"""Token accounting for the upstream requests.
+
+`TokenCounter` counts tokens with the tiktoken encoding of the chat models (cl100k_base); counts
+of message contents are cached because the same history is sent back on every turn; the cache
+is keyed on a digest of the content, so it holds no conversation text. When the
+encoding cannot be loaded (tiktoken is missing or its encoding file cannot be downloaded) it
+falls back to estimating 4 characters per token.
+
+`ContextBudget` fits a conversation into the context window of the model of a region: the
+window minus `max_tokens`, the system message and a reserve for the retrieved documents is
+left for the messages. The oldest turns are dropped first; if the last question alone does not
+fit, it is truncated.
+"""
+import collections
+import hashlib
+import logging
+import os
+import threading
+from typing import List, Optional, Tuple
+
+from backend.history import split_turns
+from backend.ratelimit import CHARS_PER_TOKEN, TOKENS_PER_MESSAGE
+from backend.settings import REGION_ENV_SUFFIXES, Settings
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_ENCODING = "cl100k_base"
+DEFAULT_CACHE_SIZE = 4096
+# every reply is primed with <|im_start|>assistant<|im_sep|>
+TOKENS_PER_REPLY = 3
+DEFAULT_RETRIEVAL_TOKENS = 1000
+DEFAULT_CONTEXT_WINDOW = 4096
+# the least a context window must leave for the messages, below it even a short question is cut
+MIN_MESSAGE_BUDGET = 256
+# longest matching prefix wins
+MODEL_CONTEXT_WINDOWS = {
+    "gpt-35-turbo": 4096,
+    "gpt-35-turbo-4k": 4096,
+    "gpt-35-turbo-16k": 16384,
+    "gpt-4": 8192,
+    "gpt-4-32k": 32768,
+}
+
+
+def context_window(model_name: Optional[str]) -> int:
+    model_name = (model_name or "").lower()
+    matches = [prefix for prefix in MODEL_CONTEXT_WINDOWS if model_name.startswith(prefix)]
+    if not matches:
+        return DEFAULT_CONTEXT_WINDOW
+    return MODEL_CONTEXT_WINDOWS[max(matches, key=len)]
+
+
+class TokenCounter(object):
+    def __init__(self, encoding_name: str = DEFAULT_ENCODING, cache_size: int = DEFAULT_CACHE_SIZE):
+        self.encoding_name = encoding_name
+        self._encoding = None
+        self._loaded = False
+        self._lock = threading.Lock()
+        self.cache_size = cache_size
+        # digest of a text -> its token count, least recently used first
+        self._cache = collections.OrderedDict()
+        self._cache_lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+
+    @property
+    def encoding(self):
+        """The tiktoken encoding, loaded on first use; None when it is not available."""
+        if not self._loaded:
+            with self._lock:
+                if not self._loaded:
+                    try:
+                        import tiktoken
+                        self._encoding = tiktoken.get_encoding(self.encoding_name)
+                    except Exception as e:
+                        logger.warning(f"TokenCounter: {self.encoding_name} not available, estimating tokens from characters: {e}")
+                    self._loaded = True
+        return self._encoding
+
+    def count_text(self, text: str) -> int:
+        if not text:
+            return 0
+        key = hashlib.blake2b(text.encode("utf-8"), digest_size=16).digest()
+        with self._cache_lock:
+            count = self._cache.get(key)
+            if count is not None:
+                self._cache.move_to_end(key)
+                self._hits += 1
+                return count
+            self._misses += 1
+        count = self._count_text(text)
+        with self._cache_lock:
+            self._cache[key] = count
+            if len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return count
+
+    def _count_text(self, text: str) -> int:
+        encoding = self.encoding
+        if encoding is None:
+            return len(text) // CHARS_PER_TOKEN + 1
+        return len(encoding.encode(text, disallowed_special=()))
+
+    def count_message(self, message: dict) -> int:
+        return TOKENS_PER_MESSAGE + self.count_text(message.get("content") or "")
+
+    def count_messages(self, messages: List[dict]) -> int:
+        return sum(self.count_message(message) for message in messages) + TOKENS_PER_REPLY
+
+    def truncate(self, text: str, tokens: int) -> str:
+        """The beginning of `text` that fits into `tokens` tokens."""
+        tokens = max(tokens, 0)
+        encoding = self.encoding
+        if encoding is None:
+            return text[:tokens * CHARS_PER_TOKEN]
+        return encoding.decode(encoding.encode(text, disallowed_special=())[:tokens])
+
+    def cache_stats(self) -> dict:
+        with self._cache_lock:
+            return {"encoding": self.encoding_name if self._encoding is not None else None, "cache_hits": self._hits,
+                    "cache_misses": self._misses, "cache_size": len(self._cache)}
+
+
+class ContextBudget(object):
+    """How many tokens of messages fit into a request to one model."""
+
+    def __init__(self, counter: TokenCounter, model_name: Optional[str], window: int, max_tokens: int,
+                 system_message: str, retrieval_tokens: int = DEFAULT_RETRIEVAL_TOKENS):
+        self.counter = counter
+        self.model_name = model_name
+        self.window = window
+        self.max_tokens = max_tokens
+        self.system_message = system_message
+        self.retrieval_tokens = retrieval_tokens
+
+    @property
+    def message_budget(self) -> int:
+        """Tokens left for the messages, the reply priming included (`count_messages` counts it)."""
+        system_tokens = TOKENS_PER_MESSAGE + self.counter.count_text(self.system_message)
+        return self.window - self.max_tokens - system_tokens - self.retrieval_tokens
+
+    def fit(self, messages: List[dict]) -> Tuple[List[dict], int, bool]:
+        """Returns the messages that fit the budget, how many were dropped and whether the last one was truncated."""
+        budget = self.message_budget
+        if self.counter.count_messages(messages) <= budget:
+            return messages, 0, False
+        turns = split_turns(messages)
+        turn_tokens = [sum(self.counter.count_message(message) for message in turn) for turn in turns]
+        while len(turns) > 1 and sum(turn_tokens) + TOKENS_PER_REPLY > budget:
+            turns.pop(0)
+            turn_tokens.pop(0)
+        fitted = [message for turn in turns for message in turn]
+        dropped = len(messages) - len(fitted)
+        overflow = self.counter.count_messages(fitted) - budget
+        if overflow <= 0:
+            return fitted, dropped, False
+        # only the last question is left and it is too long on its own
+        last = fitted[-1]
+        content = last.get("content") or ""
+        keep = self.counter.count_text(content) - overflow
+        truncated = self.counter.truncate(content, keep)
+        # decoding a token prefix can merge into tokens that count differently
+        while keep > 0 and self.counter.count_text(truncated) > self.counter.count_text(content) - overflow:
+            keep -= 1
+            truncated = self.counter.truncate(content, keep)
+        return fitted[:-1] + [dict(last, content=truncated)], dropped, True
+
+
+class RegionTokenBudgets(object):
+    """The context budget of every region, following the model name of its settings."""
+
+    def __init__(self, budgets: List[ContextBudget], enabled: bool = True):
+        self.budgets = budgets
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self.counters = collections.Counter()
+
+    @classmethod
+    def from_env(cls, settings: Settings, counter: TokenCounter):
+        retrieval_tokens = int(os.environ.get("AZURE_OPENAI_RETRIEVAL_TOKENS", DEFAULT_RETRIEVAL_TOKENS))
+        budgets = []
+        for suffix, region in zip(REGION_ENV_SUFFIXES, settings.regions):
+            # regions without their own model name run the model of the primary region
+            model_name = region.model_name or settings.regions[0].model_name
+            window = os.environ.get(f"AZURE_OPENAI_CONTEXT_WINDOW{suffix}")
+            budgets.append(ContextBudget(counter, model_name, int(window) if window else context_window(model_name),
+                                         settings.max_tokens, settings.system_message, retrieval_tokens))
+        enabled = os.environ.get("AZURE_OPENAI_TOKEN_BUDGET", "true").lower() == "true"
+        if enabled:
+            for suffix, region, budget in zip(REGION_ENV_SUFFIXES, settings.regions, budgets):
+                if region.configured and budget.message_budget < MIN_MESSAGE_BUDGET:
+                    raise ValueError(
+                        f"AZURE_OPENAI_MAX_TOKENS {settings.max_tokens}, the system message and AZURE_OPENAI_RETRIEVAL_TOKENS "
+                        f"{retrieval_tokens} leave {budget.message_budget} tokens of the {budget.window} token context "
+                        f"window of AZURE_OPENAI_MODEL{suffix} for the conversation, at least {MIN_MESSAGE_BUDGET} are "
+                        f"needed: lower them or set AZURE_OPENAI_CONTEXT_WINDOW{suffix}")
+        return cls(budgets, enabled=enabled)
+
+    def fit(self, ndx: int, messages: List[dict]) -> List[dict]:
+        if not self.enabled:
+            return messages
+        fitted, dropped, truncated = self.budgets[ndx].fit(messages)
+        if dropped or truncated:
+            logger.info(f"RegionTokenBudgets: region {ndx} dropped {dropped} messages" + (", truncated the question" if truncated else ""))
+            with self._lock:
+                self.counters["requests_trimmed"] += 1
+                self.counters["messages_dropped"] += dropped
+                self.counters["questions_truncated"] += int(truncated)
+        return fitted
+
+    def stats(self) -> dict:
+        with self._lock:
+            counters = dict(self.counters)
+        return {
+            "enabled": self.enabled,
+            "regions": [{"model_name": budget.model_name, "context_window": budget.window,
+                         "message_budget": budget.message_budget} for budget in self.budgets],
+            "requests_trimmed": counters.get("requests_trimmed", 0),
+            "messages_dropped": counters.get("messages_dropped", 0),
+            "questions_truncated": counters.get("questions_truncated", 0),
+            **(self.budgets[0].counter.cache_stats() if self.budgets else {})
+        }
@@ -0,0 +1,256 @@
+"""OpenTelemetry tracing of the /conversation requests.
+
+Every request gets a `conversation` span, child of the `traceparent` header of the browser
+when it sends one, with one child span per stage:
+
+- `prepare_body`: the request body of a region, the retrieved documents fitted to its context;
+- `upstream`: one request to a region, with the `traceparent` of this span sent along, and
+  its stages as children: `upstream.connect` until the response headers,
+  `upstream.retrieval` until the first chunk (the extension searches the index before it
+  sends anything) and `upstream.generation` from that first token to the end of the stream;
+- the time spent writing frames to the client is the `client_write_seconds` attribute of
+  the `conversation` span.
+
+The spans are written as JSON lines to TRACING_EXPORT_FILE (by a background thread, off the
+answer path) for offline analysis. TRACING_SAMPLE_RATIO keeps that fraction of the traces;
+a sampled `traceparent` from the browser keeps its trace whatever the ratio.
+
+Spans are passed explicitly rather than through the OpenTelemetry context: a stream lives in
+generators resumed by the server, hedged attempts run in other threads or tasks.
+opentelemetry-sdk is optional: without it, or without TRACING_EXPORT_FILE, no span is
+recorded.
+
+The same `RequestTrace` gathers the fields of the summary logged at the end of the request
+(see backend.logs), whether or not the request is traced: its attributes, the time to the
+first frame and one entry per request to a region.
+"""
+import contextlib
+import logging
+import os
+import threading
+import time
+import uuid
+from typing import Callable, Iterator, Mapping, Optional, Sequence
+
+try:
+    from opentelemetry import trace as trace_api
+    from opentelemetry.sdk.resources import Resource
+    from opentelemetry.sdk.trace import TracerProvider
+    from opentelemetry.sdk.trace.export import BatchSpanProcessor, SpanExporter, SpanExportResult
+    from opentelemetry.sdk.trace.sampling import ParentBased, TraceIdRatioBased
+    from opentelemetry.trace.propagation.tracecontext import TraceContextTextMapPropagator
+except ImportError:
+    trace_api = None
+    SpanExporter = object
+
+logger = logging.getLogger(__name__)
+
+SERVICE_NAME = "sample-app-aoai-chatgpt"
+DEFAULT_SAMPLE_RATIO = 1.0
+
+
+class FileSpanExporter(SpanExporter):
+    """Appends the finished spans to a file, one JSON object per line.
+
+    The worker processes of uwsgi share the file: every batch is one append-mode write.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def export(self, spans: Sequence) -> "SpanExportResult":
+        data = "".join(span.to_json(indent=None) + "\n" for span in spans)
+        try:
+            with self._lock, open(self.path, "a", encoding="utf-8") as f:
+                f.write(data)
+        except OSError as e:
+            logger.error(f"FileSpanExporter: cannot write to {self.path}: {e}")
+            return SpanExportResult.FAILURE
+        return SpanExportResult.SUCCESS
+
+    def shutdown(self):
+        pass
+
+
+class RequestTrace(object):
+    """The spans and the log summary of one request; what is not enabled is a no-op."""
+
+    def __init__(self, tracer=None, root=None, summarize: Optional[Callable[[dict], None]] = None, **fields):
+        self.tracer = tracer
+        self.root = root
+        self.client_write_time = 0.0
+        self.summarize = summarize
+        self.summary = dict(fields) if summarize is not None else None
+        self.start_time = time.perf_counter()
+
+    def start_span(self, name: str, parent=None, client: bool = False, **attributes):
+        """Starts a span, a child of `parent` or of the request's span; None when not traced.
+
+        `client` marks the span of a request to another service.
+        """
+        if self.tracer is None:
+            return None
+        context = trace_api.set_span_in_context(parent if parent is not None else self.root)
+        kind = trace_api.SpanKind.CLIENT if client else trace_api.SpanKind.INTERNAL
+        return self.tracer.start_span(name, context=context, kind=kind, attributes=attributes)
+
+    @staticmethod
+    def end_span(span, error: Optional[BaseException] = None, **attributes):
+        if span is None:
+            return
+        if attributes:
+            span.set_attributes(attributes)
+        if error is not None:
+            span.record_exception(error)
+            span.set_status(trace_api.Status(trace_api.StatusCode.ERROR, repr(error)))
+        span.end()
+
+    def set_attributes(self, **attributes):
+        """Adds attributes to the request's span and summary."""
+        if self.root is not None:
+            self.root.set_attributes(attributes)
+        if self.summary is not None:
+            self.summary.update(attributes)
+
+    def record_upstream(self, ndx: int, region: Optional[str], outcome: str, **fields):
+        """Adds a request to a region to the summary; the times are rounded to the millisecond."""
+        if self.summary is not None:
+            attempt = {"index": ndx, "region": region, "outcome": outcome}
+            attempt.update((k, round(v, 3) if isinstance(v, float) else v) for k, v in fields.items())
+            # list.append is atomic, the attempts of a hedged request run in other threads
+            self.summary.setdefault("upstream", []).append(attempt)
+
+    @contextlib.contextmanager
+    def span(self, name: str, parent=None, **attributes) -> Iterator:
+        span = self.start_span(name, parent, **attributes)
+        try:
+            yield span
+        except BaseException as e:
+            self.end_span(span, e)
+            raise
+        self.end_span(span)
+
+    def inject(self, headers: dict, span):
+        """Adds the `traceparent` of `span` to the headers of an upstream request."""
+        if span is not None:
+            TraceContextTextMapPropagator().inject(headers, context=trace_api.set_span_in_context(span))
+
+    def frames(self, frames: Iterator[bytes]) -> Iterator[bytes]:
+        """Passes the frames of a response through, timing the writes to the client, and ends the trace."""
+        return frames if self.root is None and self.summary is None else self._frames(frames)
+
+    def aframes(self, frames):
+        """`frames` for the async generators of the ASGI serving mode."""
+        return frames if self.root is None and self.summary is None else self._aframes(frames)
+
+    def _frames(self, frames):
+        error = None
+        count = 0
+        try:
+            # closed at once when the client leaves, it holds the upstream request
+            with contextlib.closing(frames):
+                for frame in frames:
+                    count += 1
+                    start = time.perf_counter()
+                    if count == 1 and self.summary is not None:
+                        self.summary["first_frame_seconds"] = round(start - self.start_time, 3)
+                    # resumed once the server has written the frame
+                    yield frame
+                    self.client_write_time += time.perf_counter() - start
+        except BaseException as e:
+            error = e
+            raise
+        finally:
+            self.end(error if isinstance(error, Exception) else None, frames=count,
+                     client_disconnected=error is not None and not isinstance(error, Exception))
+
+    async def _aframes(self, frames):
+        error = None
+        count = 0
+        try:
+            async with contextlib.aclosing(frames):
+                async for frame in frames:
+                    count += 1
+                    start = time.perf_counter()
+                    if count == 1 and self.summary is not None:
+                        self.summary["first_frame_seconds"] = round(start - self.start_time, 3)
+                    yield frame
+                    self.client_write_time += time.perf_counter() - start
+        except BaseException as e:
+            error = e
+            raise
+        finally:
+            self.end(error if isinstance(error, Exception) else None, frames=count,
+                     client_disconnected=error is not None and not isinstance(error, Exception))
+
+    def end(self, error: Optional[BaseException] = None, **attributes):
+        root, self.root = self.root, None
+        self.end_span(root, error, client_write_seconds=self.client_write_time, **attributes)
+        summary, self.summary = self.summary, None
+        if summary is not None:
+            summary.update(attributes, duration_seconds=round(time.perf_counter() - self.start_time, 3),
+                           client_write_seconds=round(self.client_write_time, 3))
+            if error is not None:
+                summary["error"] = repr(error)
+            self.summarize(summary)
+
+
+NO_TRACE = RequestTrace()
+
+
+class Tracing(object):
+    """The tracer of the process; `start` opens the trace of one request.
+
+    With `summarize`, every request's summary is passed to it when the request ends.
+    """
+
+    def __init__(self, export_file: Optional[str] = None, sample_ratio: float = DEFAULT_SAMPLE_RATIO,
+                 summarize: Optional[Callable[[dict], None]] = None):
+        self.export_file = export_file
+        self.sample_ratio = sample_ratio
+        self.summarize = summarize
+        self.tracer = None
+        if export_file is None:
+            return
+        if trace_api is None:
+            logger.warning("Tracing: opentelemetry-sdk is not installed, tracing is disabled")
+            return
+        provider = TracerProvider(resource=Resource.create({"service.name": SERVICE_NAME}),
+                                  sampler=ParentBased(TraceIdRatioBased(sample_ratio)))
+        provider.add_span_processor(BatchSpanProcessor(FileSpanExporter(export_file)))
+        self.provider = provider
+        self.tracer = provider.get_tracer(__name__)
+
+    @classmethod
+    def from_env(cls, summarize: Optional[Callable[[dict], None]] = None):
+        return cls(export_file=os.environ.get("TRACING_EXPORT_FILE") or None,
+                   sample_ratio=float(os.environ.get("TRACING_SAMPLE_RATIO", DEFAULT_SAMPLE_RATIO)),
+                   summarize=summarize)
+
+    @property
+    def enabled(self) -> bool:
+        return self.tracer is not None
+
+    def start(self, name: str, headers: Mapping[str, str], **attributes) -> RequestTrace:
+        """The trace of a request, continuing the trace of its `traceparent` header.
+
+        The request id of the summary is the `X-Request-Id` header, or else the trace id.
+        """
+        request_id = headers.get("X-Request-Id")
+        if self.tracer is None:
+            if self.summarize is None:
+                return NO_TRACE
+            return RequestTrace(summarize=self.summarize, request=name, request_id=request_id or uuid.uuid4().hex,
+                                **attributes)
+        context = TraceContextTextMapPropagator().extract({k.lower(): v for k, v in headers.items()})
+        root = self.tracer.start_span(name, context=context, kind=trace_api.SpanKind.SERVER, attributes=attributes)
+        if self.summarize is None:
+            # an unsampled span records nothing, but the upstream requests still carry the decision
+            return RequestTrace(self.tracer, root)
+        request_id = request_id or format(root.get_span_context().trace_id, "032x")
+        return RequestTrace(self.tracer, root, self.summarize, request=name, request_id=request_id, **attributes)
+
+    def stats(self) -> dict:
+        return {"enabled": self.enabled, "export_file": self.export_file, "sample_ratio": self.sample_ratio,
+                "request_summaries": self.summarize is not None}
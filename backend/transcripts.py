@@ -0,0 +1,273 @@
+"""Recording and replay of upstream answer streams.
+
+With UPSTREAM_RECORD_DIR set, the streams of the regions are saved to that directory, one
+JSON file per stream: the request body, the status and headers of the response, and every
+chunk of the body as read from the socket, with its time since the request was sent. Secrets
+(the search key of the data source, keys and authorization headers) are scrubbed; the
+questions and answers are kept, a corpus must be handled like the conversations it holds.
+UPSTREAM_RECORD_RATIO records only that fraction of the streams.
+
+`ReplayAdapter` (for the `requests` sessions of app.py) and `AsyncReplayTransport` (for the
+httpx client of app_asgi.py) answer the upstream requests from a set of transcripts,
+chunk for chunk, at the original pace, `speed` times faster, or as fast as possible with
+`speed=0`. A stream that broke off when it was recorded breaks off again at the same point.
+benchmarks.bench_replay uses them to run a recorded corpus through `stream_with_data`.
+"""
+import base64
+import itertools
+import json
+import logging
+import os
+import random
+import threading
+import time
+import uuid
+from typing import AsyncIterator, Iterator, List, Optional
+
+import requests
+from requests.adapters import BaseAdapter
+from requests.structures import CaseInsensitiveDict
+from urllib3.exceptions import ProtocolError
+
+from backend.balancer import OUTCOME_CANCELLED
+
+logger = logging.getLogger(__name__)
+
+TRANSCRIPT_VERSION = 1
+SCRUBBED = "***"
+# lower-cased names of the fields and headers whose values are never written
+SECRET_FIELDS = frozenset(("key", "api-key", "api_key", "apikey", "authorization", "embeddingkey", "connectionstring",
+                           "set-cookie", "cookie"))
+END_COMPLETE = "complete"
+
+
+def scrub(value):
+    """A copy of a decoded JSON value with the values of the secret fields replaced."""
+    if isinstance(value, dict):
+        return {k: SCRUBBED if k.lower() in SECRET_FIELDS else scrub(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [scrub(v) for v in value]
+    return value
+
+
+class Transcript(object):
+    """One upstream stream being recorded: `chunks` passes its body through, `finish` saves it."""
+
+    def __init__(self, path: str, region: str, body: bytes, status: int, headers, connect_time: float, start: float):
+        try:
+            request = scrub(json.loads(body))
+        except ValueError:
+            request = None
+        self.path = path
+        self.start = start
+        self.data = {
+            "version": TRANSCRIPT_VERSION,
+            "region": region,
+            "request": request,
+            "status": status,
+            "headers": scrub(dict(headers)),
+            "connect": connect_time,
+            "chunks": [],
+            "end": END_COMPLETE
+        }
+
+    def _add(self, chunk: bytes):
+        self.data["chunks"].append([round(time.time() - self.start, 6), base64.b64encode(chunk).decode("ascii")])
+
+    def chunks(self, chunks: Iterator[bytes]) -> Iterator[bytes]:
+        try:
+            for chunk in chunks:
+                self._add(chunk)
+                yield chunk
+        except Exception as e:
+            self.data["end"] = repr(e)
+            raise
+
+    async def achunks(self, chunks: AsyncIterator[bytes]) -> AsyncIterator[bytes]:
+        try:
+            async for chunk in chunks:
+                self._add(chunk)
+                yield chunk
+        except Exception as e:
+            self.data["end"] = repr(e)
+            raise
+
+    def finish(self, outcome: str):
+        """Saves the transcript, unless the stream was cancelled: closed because the client left or
+        another region answered first, it does not show how the region streams."""
+        if outcome != OUTCOME_CANCELLED:
+            self.save()
+
+    def save(self):
+        try:
+            with open(self.path, "w", encoding="utf-8") as f:
+                json.dump(self.data, f)
+        except OSError as e:
+            logger.error(f"Transcript: cannot write {self.path}: {e}")
+
+
+class TranscriptRecorder(object):
+    """Decides which upstream streams are recorded, and where."""
+
+    def __init__(self, directory: Optional[str] = None, ratio: float = 1.0):
+        self.directory = directory
+        self.ratio = ratio
+        self.recorded = 0
+        self._lock = threading.Lock()
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+
+    @classmethod
+    def from_env(cls):
+        return cls(directory=os.environ.get("UPSTREAM_RECORD_DIR") or None,
+                   ratio=float(os.environ.get("UPSTREAM_RECORD_RATIO", 1.0)))
+
+    @property
+    def enabled(self) -> bool:
+        return self.directory is not None
+
+    def start(self, region: str, body: bytes, status: int, headers, connect_time: float,
+              start: float) -> Optional[Transcript]:
+        """The transcript of a stream whose response headers arrived, None when it is not recorded."""
+        if self.directory is None or random.random() >= self.ratio:
+            return None
+        with self._lock:
+            self.recorded += 1
+        name = f"{time.strftime('%Y%m%d-%H%M%S')}-{region}-{uuid.uuid4().hex[:8]}.json"
+        return Transcript(os.path.join(self.directory, name), region, body, status, headers, connect_time, start)
+
+    def stats(self) -> dict:
+        return {"directory": self.directory, "ratio": self.ratio, "recorded": self.recorded}
+
+
+def load_transcripts(paths: List[str]) -> List[dict]:
+    """The transcripts in `paths`, files or directories of them, with their chunks decoded."""
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files += sorted(os.path.join(path, name) for name in os.listdir(path) if name.endswith(".json"))
+        else:
+            files.append(path)
+    transcripts = []
+    for file in files:
+        with open(file, encoding="utf-8") as f:
+            transcript = json.load(f)
+        transcript["chunks"] = [(offset, base64.b64decode(chunk)) for offset, chunk in transcript["chunks"]]
+        transcripts.append(transcript)
+    return transcripts
+
+
+class _Replay(object):
+    """Hands out the transcripts in turn, to any number of threads."""
+
+    def __init__(self, transcripts: List[dict], speed: float):
+        if not transcripts:
+            raise ValueError("no transcripts to replay")
+        self.speed = speed
+        self._transcripts = itertools.cycle(transcripts)
+        self._lock = threading.Lock()
+
+    def next(self) -> dict:
+        with self._lock:
+            return next(self._transcripts)
+
+    def delay(self, start: float, offset: float) -> float:
+        """Seconds to wait before what was recorded `offset` seconds after the request."""
+        if not self.speed:
+            return 0.0
+        return max(0.0, start + offset / self.speed - time.monotonic())
+
+
+class _ReplayBody(object):
+    """The `raw` of a replayed `requests.Response`."""
+
+    def __init__(self, replay: _Replay, transcript: dict, start: float):
+        self._replay = replay
+        self._transcript = transcript
+        self._start = start
+        self._closed = False
+
+    def stream(self, amt=None, decode_content=None):
+        for offset, chunk in self._transcript["chunks"]:
+            if self._closed:
+                return
+            delay = self._replay.delay(self._start, offset)
+            if delay:
+                # even a sleep(0) costs a system call, more than the loop spends on a chunk
+                time.sleep(delay)
+            yield chunk
+        if self._transcript["end"] != END_COMPLETE and not self._closed:
+            raise ProtocolError(f"replayed stream broke off: {self._transcript['end']}")
+
+    def read(self, amt=None, decode_content=None):
+        return b"".join(self.stream())
+
+    def close(self):
+        self._closed = True
+
+    def release_conn(self):
+        pass
+
+
+class ReplayAdapter(BaseAdapter):
+    """A `requests` transport adapter answering every request from the transcripts."""
+
+    def __init__(self, transcripts: List[dict], speed: float = 1.0):
+        super().__init__()
+        self.replay = _Replay(transcripts, speed)
+
+    def send(self, request, stream=False, timeout=None, verify=True, cert=None, proxies=None):
+        transcript = self.replay.next()
+        start = time.monotonic()
+        delay = self.replay.delay(start, transcript["connect"])
+        if delay:
+            time.sleep(delay)
+        response = requests.Response()
+        response.status_code = transcript["status"]
+        response.headers = CaseInsensitiveDict(transcript["headers"])
+        response.raw = _ReplayBody(self.replay, transcript, start)
+        response.url = request.url
+        response.request = request
+        response.connection = self
+        return response
+
+    def close(self):
+        pass
+
+
+try:
+    import asyncio
+
+    import httpx
+
+    class _AsyncReplayStream(httpx.AsyncByteStream):
+        def __init__(self, replay: _Replay, transcript: dict, start: float):
+            self._replay = replay
+            self._transcript = transcript
+            self._start = start
+
+        async def __aiter__(self):
+            for offset, chunk in self._transcript["chunks"]:
+                delay = self._replay.delay(self._start, offset)
+                if delay:
+                    await asyncio.sleep(delay)
+                yield chunk
+            if self._transcript["end"] != END_COMPLETE:
+                raise httpx.RemoteProtocolError(f"replayed stream broke off: {self._transcript['end']}")
+
+    class AsyncReplayTransport(httpx.AsyncBaseTransport):
+        """An httpx transport answering every request from the transcripts."""
+
+        def __init__(self, transcripts: List[dict], speed: float = 1.0):
+            self.replay = _Replay(transcripts, speed)
+
+        async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+            transcript = self.replay.next()
+            start = time.monotonic()
+            delay = self.replay.delay(start, transcript["connect"])
+            if delay:
+                await asyncio.sleep(delay)
+            return httpx.Response(transcript["status"], headers=transcript["headers"],
+                                  stream=_AsyncReplayStream(self.replay, transcript, start), request=request)
+except ImportError:
+    AsyncReplayTransport = None
@@ -0,0 +1,304 @@
+"""Keep-alive HTTP sessions to the Azure OpenAI regions.
+
+Every region gets one `requests.Session` per process, so consecutive questions reuse an
+already established TCP + TLS connection instead of paying DNS, TCP and TLS setup before
+the first token.
+
+Requests to a region have three independent timeouts (`UpstreamTimeouts`): connecting,
+waiting for the first byte of the answer, and waiting between two chunks of the answer once
+it streams. A region that accepts the connection and then stalls is given up on after the
+idle timeout, however long the answer has been streaming, while a long answer that keeps
+producing tokens is never cut.
+"""
+import collections
+import logging
+import os
+import socket
+import threading
+import time
+from typing import Dict, Iterator, Optional
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import BaseAdapter, HTTPAdapter
+from urllib3.exceptions import ReadTimeoutError
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_POOL_MAXSIZE = 10
+# Azure load balancers drop idle TCP connections after ~4 minutes, evict well before that
+DEFAULT_IDLE_TIMEOUT = 60
+DEFAULT_CONNECT_TIMEOUT = 5
+DEFAULT_FIRST_BYTE_TIMEOUT = 10
+DEFAULT_STREAM_IDLE_TIMEOUT = 10
+
+PHASE_CONNECT = "connect"
+PHASE_FIRST_BYTE = "first_byte"
+PHASE_IDLE = "idle"
+PHASES = (PHASE_CONNECT, PHASE_FIRST_BYTE, PHASE_IDLE)
+
+
+def default_pool_maxsize() -> int:
+    """Size the connection pool to the number of request threads of this uwsgi worker."""
+    try:
+        import uwsgi
+        threads = uwsgi.opt.get("threads")
+        if isinstance(threads, bytes):
+            threads = threads.decode("utf-8")
+        if threads:
+            return max(int(threads), 1)
+    except (ImportError, AttributeError, ValueError):
+        pass
+    return DEFAULT_POOL_MAXSIZE
+
+
+class _RegionSession(object):
+    def __init__(self, host: str, pool_maxsize: int, adapter: Optional[BaseAdapter] = None):
+        self.host = host
+        self.session = requests.Session()
+        if adapter is None:
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_maxsize, max_retries=0)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.adapter = adapter
+        self.created = time.monotonic()
+        self.last_used = self.created
+        self.requests = 0
+
+    def close(self):
+        self.session.close()
+
+    def connection_stats(self) -> Dict[str, int]:
+        opened = 0
+        served = 0
+        idle = 0
+        if not isinstance(self.adapter, HTTPAdapter):
+            return {"connections_opened": opened, "requests_served": served, "idle_connections": idle}
+        for key in self.adapter.poolmanager.pools.keys():
+            pool = self.adapter.poolmanager.pools.get(key)
+            if pool is None:
+                continue
+            opened += pool.num_connections
+            served += pool.num_requests
+            idle += sum(1 for conn in list(pool.pool.queue) if conn is not None)
+        return {"connections_opened": opened, "requests_served": served, "idle_connections": idle}
+
+
+class UpstreamSessionPool(object):
+    """Process-wide pool of keep-alive sessions, one per Azure OpenAI region (host).
+
+    Sessions are created lazily by the process that uses them, so a pool created before uwsgi
+    forks its workers never shares sockets between workers. A region session that has not been
+    used for `idle_timeout` seconds is closed and replaced, because its connections have most
+    likely been dropped by the server side already.
+    """
+
+    def __init__(self, pool_maxsize: Optional[int] = None, idle_timeout: float = DEFAULT_IDLE_TIMEOUT):
+        self.pool_maxsize = pool_maxsize or default_pool_maxsize()
+        self.idle_timeout = idle_timeout
+        self._lock = threading.Lock()
+        self._sessions: Dict[str, _RegionSession] = {}
+        self._pid = os.getpid()
+        self._evictions = 0
+        self._sessions_created = 0
+        self._adapter: Optional[BaseAdapter] = None
+
+    @classmethod
+    def from_env(cls):
+        pool_maxsize = os.environ.get("AZURE_OPENAI_POOL_MAXSIZE")
+        idle_timeout = os.environ.get("AZURE_OPENAI_POOL_IDLE_TIMEOUT", DEFAULT_IDLE_TIMEOUT)
+        return cls(pool_maxsize=int(pool_maxsize) if pool_maxsize else None, idle_timeout=float(idle_timeout))
+
+    def session_for(self, endpoint: str) -> requests.Session:
+        """Returns the keep-alive session for the region serving `endpoint`."""
+        host = urlparse(endpoint).netloc
+        now = time.monotonic()
+        with self._lock:
+            if os.getpid() != self._pid:
+                # forked into a new worker: the inherited sockets belong to the parent
+                self._sessions = {}
+                self._pid = os.getpid()
+            self._evict_idle(now)
+            region = self._sessions.get(host)
+            if region is None:
+                logger.info(f"UpstreamSessionPool: opening session for {host} (pool size {self.pool_maxsize})")
+                region = _RegionSession(host, self.pool_maxsize, self._adapter)
+                self._sessions[host] = region
+                self._sessions_created += 1
+            region.last_used = now
+            region.requests += 1
+            return region.session
+
+    def _evict_idle(self, now: float):
+        for host, region in list(self._sessions.items()):
+            if now - region.last_used > self.idle_timeout:
+                logger.info(f"UpstreamSessionPool: evicting session for {host}, idle for {round(now - region.last_used)} seconds")
+                del self._sessions[host]
+                self._evictions += 1
+                region.close()
+
+    def mount(self, adapter: Optional[BaseAdapter]):
+        """Sends every upstream request through `adapter` instead of the network (None: the network
+        again), e.g. a `backend.transcripts.ReplayAdapter`. The open sessions are closed."""
+        self.close()
+        with self._lock:
+            self._adapter = adapter
+
+    def close(self):
+        with self._lock:
+            for region in self._sessions.values():
+                region.close()
+            self._sessions = {}
+
+    def stats(self) -> dict:
+        """Pool size and reuse numbers per region, for monitoring."""
+        now = time.monotonic()
+        with self._lock:
+            regions = {}
+            for host, region in self._sessions.items():
+                regions[host] = {
+                    "requests": region.requests,
+                    "idle_seconds": round(now - region.last_used, 3),
+                    **region.connection_stats()
+                }
+            return {
+                "pid": self._pid,
+                "pool_maxsize": self.pool_maxsize,
+                "idle_timeout": self.idle_timeout,
+                "sessions_created": self._sessions_created,
+                "sessions_evicted": self._evictions,
+                "regions": regions
+            }
+
+
+def close_response(response: requests.Response):
+    """Closes a streaming response, waking up any thread blocked reading from it."""
+    connection = getattr(response.raw, "_connection", None)
+    sock = getattr(connection, "sock", None)
+    if sock is not None:
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+    response.close()
+
+
+class UpstreamStalled(Exception):
+    """The upstream sent nothing within the timeout of the current phase of the response."""
+
+    def __init__(self, phase: str, timeout: float):
+        super().__init__(f"no data for {timeout} seconds while waiting for the {phase.replace('_', ' ')}")
+        self.phase = phase
+        self.timeout = timeout
+
+
+class UpstreamTimeouts(object):
+    """Connect, first-byte and inter-chunk idle timeouts of the upstream requests, and how often each one fired."""
+
+    def __init__(self, connect: float = DEFAULT_CONNECT_TIMEOUT, first_byte: float = DEFAULT_FIRST_BYTE_TIMEOUT,
+                 idle: float = DEFAULT_STREAM_IDLE_TIMEOUT):
+        self.connect = connect
+        self.first_byte = first_byte
+        self.idle = idle
+        self._lock = threading.Lock()
+        self.counters = collections.Counter()
+        self.region_counters = collections.defaultdict(collections.Counter)
+
+    @classmethod
+    def from_env(cls):
+        return cls(connect=float(os.environ.get("AZURE_OPENAI_CONNECT_TIMEOUT", DEFAULT_CONNECT_TIMEOUT)),
+                   first_byte=float(os.environ.get("AZURE_OPENAI_FIRST_BYTE_TIMEOUT", DEFAULT_FIRST_BYTE_TIMEOUT)),
+                   idle=float(os.environ.get("AZURE_OPENAI_STREAM_IDLE_TIMEOUT", DEFAULT_STREAM_IDLE_TIMEOUT)))
+
+    @property
+    def requests_timeout(self) -> tuple:
+        """The `timeout` of `requests`: its read timeout covers the wait for the response headers."""
+        return self.connect, self.first_byte
+
+    def record(self, ndx: int, phase: str):
+        with self._lock:
+            self.counters[phase] += 1
+            self.region_counters[ndx][phase] += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            counters = dict(self.counters)
+            regions = {ndx: dict(region) for ndx, region in self.region_counters.items()}
+        return {
+            "connect": self.connect,
+            "first_byte": self.first_byte,
+            "idle": self.idle,
+            "fired": {phase: counters.get(phase, 0) for phase in PHASES},
+            "fired_by_region": regions
+        }
+
+
+def timeout_phase(error: Exception) -> Optional[str]:
+    """The phase whose timeout a `requests` exception reports, None for other failures."""
+    if isinstance(error, requests.exceptions.ConnectTimeout):
+        return PHASE_CONNECT
+    if isinstance(error, requests.exceptions.ReadTimeout):
+        return PHASE_FIRST_BYTE
+    return None
+
+
+def set_read_timeout(response: requests.Response, seconds: float):
+    """Changes the timeout of the next reads of a streaming response."""
+    connection = getattr(response.raw, "_connection", None)
+    sock = getattr(connection, "sock", None)
+    if sock is not None:
+        sock.settimeout(seconds)
+
+
+def iter_chunks(response: requests.Response, timeouts: UpstreamTimeouts, chunk_size: int) -> Iterator[bytes]:
+    """The body of a streaming response. The first chunk may take `timeouts.first_byte` seconds,
+    every later one `timeouts.idle` seconds; past that, UpstreamStalled is raised."""
+    phase, timeout = PHASE_FIRST_BYTE, timeouts.first_byte
+    try:
+        for chunk in response.iter_content(chunk_size=chunk_size):
+            if phase == PHASE_FIRST_BYTE:
+                phase, timeout = PHASE_IDLE, timeouts.idle
+                set_read_timeout(response, timeout)
+            yield chunk
+    except requests.exceptions.ConnectionError as e:
+        # requests reports a read timeout of the body as a connection error
+        if e.args and isinstance(e.args[0], ReadTimeoutError):
+            raise UpstreamStalled(phase, timeout) from e
+        raise
+
+
+class Cancellation(object):
+    """Lets another thread abort an upstream request and close its connection."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._response = None
+        self.cancelled = False
+
+    def attach(self, response: requests.Response) -> bool:
+        """Registers the response to close on cancel; False when the request was already cancelled."""
+        with self._lock:
+            if self.cancelled:
+                return False
+            self._response = response
+            return True
+
+    def cancel(self):
+        with self._lock:
+            self.cancelled = True
+            response = self._response
+        if response is not None:
+            close_response(response)
+
+
+_session_pool: Optional[UpstreamSessionPool] = None
+_session_pool_lock = threading.Lock()
+
+
+def get_session_pool() -> UpstreamSessionPool:
+    """Returns the process-wide session pool, configured from the environment on first use."""
+    global _session_pool
+    with _session_pool_lock:
+        if _session_pool is None:
+            _session_pool = UpstreamSessionPool.from_env()
+        return _session_pool
@@ -0,0 +1 @@
+"""Local benchmarks and load-testing tools. Run them from the repository root with `python -m benchmarks.<name>`."""
@@ -0,0 +1,148 @@
+"""Benchmark of the cost of logging on the request threads.
+
+Several threads (the uwsgi request threads) each log many requests. Three set-ups are
+compared, all writing to a handler whose every write takes --write-latency milliseconds:
+- `sync` is the original set-up. The root handler of basicConfig and the app logger's own
+  handler are called on the request thread, so every line is written twice. Each request
+  logs its progress at INFO.
+- `queue` is backend.logs. The progress lines are at DEBUG, below the level, and each
+  request logs one summary record through the queue.
+- `sampled` is `queue` with LOG_SAMPLE_RATIO 0.1 and LOG_RATE_LIMIT 50. Every request also
+  logs an INFO line from one call site, like a region failing over and over.
+
+Reports the time the request threads spend logging, per request, and the records written.
+
+    python -m benchmarks.bench_logging --threads 8 --requests 2000 --write-latency 0.2
+"""
+import argparse
+import logging
+import threading
+import time
+
+from backend.logs import LOG_FORMAT, LogPipeline
+from backend.tracing import Tracing
+from benchmarks.bench_serving import percentile
+
+ENDPOINT = "https://region1.openai.azure.com/openai/deployments/turbo/extensions/chat/completions"
+
+
+class SlowStream(object):
+    """A stream whose writes take `latency` seconds, like a busy pipe or a remote collector."""
+
+    def __init__(self, latency: float):
+        self.latency = latency
+        self.writes = 0
+        self._lock = threading.Lock()
+
+    def write(self, data):
+        with self._lock:
+            self.writes += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def flush(self):
+        pass
+
+
+def reset_logging():
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    for name in ("app", "backend.logs"):
+        logger = logging.getLogger(name)
+        for handler in list(logger.handlers):
+            logger.removeHandler(handler)
+
+
+def sync_request(logger, tracing, ndx, sampled):
+    logger.info(f"####### Retry #0 Using index #{ndx}")
+    logger.info(f"stream_with_data: {ENDPOINT}")
+    logger.info("stream_with_data: starting POST")
+    logger.info(f"stream_with_data: status code of call: {200}")
+    logger.info(f"stream_with_data: POST completed in {0.512} seconds, processing response lines")
+    logger.info("Data stream received, sending response to client")
+    logger.info(f"stream_with_data: lines processed in {4.871} seconds")
+
+
+def queue_request(logger, tracing, ndx, sampled):
+    trace = tracing.start("conversation", {}, stream_format="delta")
+    logger.debug("####### Retry #%s Using index #%s", 0, ndx)
+    logger.debug("stream_with_data: %s", ENDPOINT)
+    logger.debug("stream_with_data: starting POST")
+    logger.debug("stream_with_data: status code of call: %s", 200)
+    logger.debug("stream_with_data: POST completed in %s seconds, processing response lines", 0.512)
+    if sampled:
+        logger.info(f"Endpoint {ENDPOINT} answered slowly")
+    logger.debug("Data stream received, sending response to client")
+    logger.debug("stream_with_data: lines processed in %s seconds", 4.871)
+    trace.record_upstream(ndx, "region1", "success", connect=0.012, first_token=0.512, duration=4.871, tokens=300)
+    trace.end(frames=80)
+
+
+def configure(mode, stream):
+    """The app logger, the tracing of the summaries and the pipeline (None for `sync`) of `mode`."""
+    reset_logging()
+    logger = logging.getLogger("app")
+    if mode == "sync":
+        logging.basicConfig(level=logging.DEBUG, format=LOG_FORMAT, stream=stream)
+        c_handler = logging.StreamHandler(stream)
+        c_handler.setLevel(logging.DEBUG)
+        logger.addHandler(c_handler)
+        return logger, Tracing(), None
+    pipeline = LogPipeline(sample_ratio=0.1 if mode == "sampled" else 1.0, rate_limit=50 if mode == "sampled" else 0)
+    handler = logging.StreamHandler(stream)
+    handler.setFormatter(logging.Formatter(LOG_FORMAT))
+    pipeline.install([handler], summary_logger=logger)
+    return logger, Tracing(summarize=pipeline.summarize), pipeline
+
+
+def run(mode, threads, requests, latency):
+    stream = SlowStream(latency)
+    logger, tracing, pipeline = configure(mode, stream)
+    log_request = sync_request if mode == "sync" else queue_request
+    times = []
+
+    def worker():
+        own = []
+        for i in range(requests):
+            start = time.perf_counter()
+            log_request(logger, tracing, i % 3, mode == "sampled")
+            own.append(time.perf_counter() - start)
+        times.extend(own)
+
+    workers = [threading.Thread(target=worker) for _ in range(threads)]
+    start = time.perf_counter()
+    for worker_thread in workers:
+        worker_thread.start()
+    for worker_thread in workers:
+        worker_thread.join()
+    elapsed = time.perf_counter() - start
+    stats = pipeline.stats() if pipeline is not None else {}
+    if pipeline is not None:
+        # waits for the queue to be written out
+        pipeline.stop()
+    reset_logging()
+    return times, elapsed, stream.writes, stats
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--threads", type=int, default=8)
+    parser.add_argument("--requests", type=int, default=2000, help="requests per thread")
+    parser.add_argument("--write-latency", type=float, default=0.05, help="milliseconds per write of the handler")
+    parser.add_argument("--modes", default="sync,queue,sampled")
+    args = parser.parse_args(argv)
+
+    total = args.threads * args.requests
+    print(f"{args.threads} threads x {args.requests} requests, {args.write_latency:g} ms per write")
+    for mode in args.modes.split(","):
+        times, elapsed, writes, stats = run(mode, args.threads, args.requests, args.write_latency / 1000)
+        dropped = f"  dropped {stats['dropped']}, sampled out {stats['sampled_out']}, " \
+                  f"rate limited {stats['rate_limited']}" if stats else ""
+        print(f"{mode:>8}  logging per request: mean {sum(times) / total * 1e6:8.1f} us  "
+              f"p99 {percentile(times, 99) * 1e6:8.1f} us  {total / elapsed:9.0f} req/s  "
+              f"{writes / total:5.2f} writes/request{dropped}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+"""Micro-benchmark of the per-request preparation of the upstream request.
+
+Compares the original `prepare_body_headers_with_data`, which converted the settings, built
+the whole body and headers and had `requests` serialize them on every request, with rendering
+the pre-built `RequestTemplate` of a region, which only serializes the messages.
+
+    python -m benchmarks.bench_prepare --number 20000
+"""
+import argparse
+import json
+import timeit
+
+from backend.settings import Settings, build_request_templates
+from benchmarks.bench_serving import FAKE_SETTINGS
+
+SETTINGS = dict(FAKE_SETTINGS, AZURE_SEARCH_TITLE_COLUMN="title", AZURE_SEARCH_URL_COLUMN="url",
+                AZURE_SEARCH_FILENAME_COLUMN="filepath", AZURE_OPENAI_STOP_SEQUENCE="###|<|im_end|>")
+
+
+def legacy_prepare(request_messages, ndx, env=SETTINGS):
+    """The original per-request preparation, settings kept as the raw strings of the environment."""
+    openai_key = [env["AZURE_OPENAI_KEY"], env["AZURE_OPENAI_KEY_NC"], env["AZURE_OPENAI_KEY_US2"]][ndx]
+    openai_resource = [env["AZURE_OPENAI_RESOURCE"], env["AZURE_OPENAI_RESOURCE_NC"], env["AZURE_OPENAI_RESOURCE_US2"]][ndx]
+    openai_model = [env["AZURE_OPENAI_MODEL"], env["AZURE_OPENAI_MODEL_NC"], env["AZURE_OPENAI_MODEL_US2"]][ndx]
+    model_name = env["AZURE_OPENAI_MODEL_NAME"]
+    stop = env.get("AZURE_OPENAI_STOP_SEQUENCE")
+    content_columns = env.get("AZURE_SEARCH_CONTENT_COLUMNS")
+    use_semantic_search = env.get("AZURE_SEARCH_USE_SEMANTIC_SEARCH", "false")
+    semantic_search_config = env.get("AZURE_SEARCH_SEMANTIC_SEARCH_CONFIG", "default")
+    body = {
+        "messages": request_messages,
+        "temperature": float(env.get("AZURE_OPENAI_TEMPERATURE", 0)),
+        "max_tokens": int(env.get("AZURE_OPENAI_MAX_TOKENS", 1000)),
+        "top_p": float(env.get("AZURE_OPENAI_TOP_P", 1.0)),
+        "stop": stop.split("|") if stop else None,
+        "stream": True if env.get("AZURE_OPENAI_STREAM", "true").lower() == "true" else False,
+        "dataSources": [
+            {
+                "type": "AzureCognitiveSearch",
+                "parameters": {
+                    "endpoint": f"https://{env['AZURE_SEARCH_SERVICE']}.search.windows.net",
+                    "key": env["AZURE_SEARCH_KEY"],
+                    "indexName": env["AZURE_SEARCH_INDEX"],
+                    "fieldsMapping": {
+                        "contentField": content_columns.split("|") if content_columns else [],
+                        "titleField": env.get("AZURE_SEARCH_TITLE_COLUMN") or None,
+                        "urlField": env.get("AZURE_SEARCH_URL_COLUMN") or None,
+                        "filepathField": env.get("AZURE_SEARCH_FILENAME_COLUMN") or None
+                    },
+                    "inScope": True if env.get("AZURE_SEARCH_ENABLE_IN_DOMAIN", "true").lower() == "true" else False,
+                    "topNDocuments": env.get("AZURE_SEARCH_TOP_K", 5),
+                    "queryType": "semantic" if use_semantic_search.lower() == "true" else "simple",
+                    "semanticConfiguration": semantic_search_config if use_semantic_search.lower() == "true" and semantic_search_config else "",
+                    "roleInformation": env.get("AZURE_OPENAI_SYSTEM_MESSAGE", "You are an AI assistant that helps people find information.")
+                }
+            }
+        ]
+    }
+    chatgpt_url = f"https://{openai_resource}.openai.azure.com/openai/deployments/{openai_model}"
+    if 'gpt-4' in model_name.lower() or model_name.lower() in ['gpt-35-turbo-4k', 'gpt-35-turbo-16k']:
+        chatgpt_url += "/chat/completions?api-version=2023-03-15-preview"
+    else:
+        chatgpt_url += "/completions?api-version=2023-03-15-preview"
+    headers = {
+        'Content-Type': 'application/json',
+        'api-key': openai_key,
+        'chatgpt_url': chatgpt_url,
+        'chatgpt_key': openai_key,
+        "x-ms-useragent": "GitHubSampleWebApp/PublicAPI/1.0.0"
+    }
+    endpoint = (f"https://{openai_resource}.openai.azure.com/openai/deployments/{openai_model}/extensions/chat/completions"
+                f"?api-version={env.get('AZURE_OPENAI_PREVIEW_API_VERSION', '2023-06-01-preview')}")
+    # requests serializes the json= body like this before sending it
+    return json.dumps(body).encode("utf-8"), headers, endpoint
+
+
+def conversation(turns):
+    messages = []
+    for turn in range(turns):
+        messages.append({"role": "user", "content": f"Question {turn} about a food vendor license?"})
+        messages.append({"role": "assistant", "content": "You need to apply with the city clerk. " * 5})
+    messages.append({"role": "user", "content": "And how much does it cost?"})
+    return messages
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--number", type=int, default=20000, help="preparations per measurement")
+    args = parser.parse_args(argv)
+
+    templates = build_request_templates(Settings.from_env(SETTINGS))
+    for turns in (0, 5):
+        messages = conversation(turns)
+        legacy_body, _, legacy_endpoint = legacy_prepare(messages, 1)
+        template_body, _ = templates[1].render(messages)
+        assert json.loads(legacy_body)["messages"] == json.loads(template_body)["messages"]
+        assert legacy_endpoint == templates[1].endpoint
+
+        legacy = min(timeit.repeat(lambda: legacy_prepare(messages, 1), number=args.number, repeat=3)) / args.number
+        template = min(timeit.repeat(lambda: templates[1].render(messages), number=args.number, repeat=3)) / args.number
+        print(f"{len(messages):2} messages  legacy {legacy * 1e6:7.2f} us  template {template * 1e6:7.2f} us  "
+              f"speedup {legacy / template:5.1f}x")
+
+
+if __name__ == "__main__":
+    main()
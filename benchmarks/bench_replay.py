@@ -0,0 +1,165 @@
+"""Regression benchmark of the streaming loop, replaying upstream transcripts.
+
+Runs a corpus of upstream streams through `stream_with_data` of both serving modes, with the
+network replaced by `backend.transcripts`: the `ReplayAdapter` for app.py, the
+`AsyncReplayTransport` for app_asgi.py. The corpus is a set of transcripts recorded with
+UPSTREAM_RECORD_DIR, or synthesized from the options of benchmarks.mock_upstream (of its
+faults, only --drop-rate applies: the dropped streams exercise the resume path). The same
+corpus gives the same work on every run, so the CPU time and memory per stream can be
+compared between two versions of the code.
+
+At the default --speed 0 the chunks are replayed without any delay and the run measures the
+cost of the loop itself; --speed 1 replays them at their original pace, --speed 10 ten
+times faster. Reports wall and CPU time, CPU time per stream and frames per second, then
+the peak traced memory and the memory still held at the end of a second, traced pass.
+
+    python -m benchmarks.bench_replay --synthesize 200 --tokens 300
+    python -m benchmarks.bench_replay recordings/ --streams 1000 --stream-format delta
+"""
+import argparse
+import asyncio
+import concurrent.futures
+import contextlib
+import logging
+import os
+import random
+import time
+import tracemalloc
+
+from benchmarks.bench_serving import FAKE_SETTINGS
+from benchmarks.mock_upstream import add_config_arguments, build_chunk, build_tool_message, config_from_args, sample_delay
+
+QUESTION = [{"role": "user", "content": "How do I get a food vendor license?"}]
+
+
+def synthesize(config, count):
+    """`count` transcripts of the streams the mock upstream would send with `config`."""
+    rng = random.Random(config.seed if config.seed is not None else 0)
+    transcripts = []
+    for _ in range(count):
+        connect = sample_delay(config.header_delay, config.distribution, config.spread, rng)
+        offset = connect + sample_delay(config.first_token_delay, config.distribution, config.spread, rng)
+        token_delay = sample_delay(config.token_delay, config.distribution, config.spread, rng)
+        drop_after = rng.randrange(config.tokens) if rng.random() < config.drop_rate and config.tokens else None
+        chunks = [(offset, build_chunk(build_tool_message(config))), (offset, build_chunk({"role": "assistant"}))]
+        for i in range(config.tokens if drop_after is None else drop_after):
+            offset += token_delay
+            chunks.append((offset, build_chunk({"content": f"token{i} "})))
+        if drop_after is None:
+            chunks.append((offset, build_chunk({"content": "[DONE]"})))
+        transcripts.append({"region": "mock", "status": 200, "headers": {"Content-Type": "text/event-stream"},
+                            "connect": connect, "chunks": chunks,
+                            "end": "complete" if drop_after is None else "dropped"})
+    return transcripts
+
+
+def run_wsgi(app, transcripts, streams, concurrency, stream_format, speed):
+    from backend.transcripts import ReplayAdapter
+
+    app.get_session_pool().mount(ReplayAdapter(transcripts, speed))
+
+    def one(i):
+        ndx = i % len(app.openai_resources)
+        body, headers = app.prepare_body_headers_with_data(QUESTION, ndx)
+        frames = 0
+        with contextlib.closing(app.stream_with_data(body, headers, app.generate_endpoint(ndx), ndx, stream_format,
+                                                     request_messages=QUESTION)) as data_stream:
+            for _ in data_stream:
+                frames += 1
+        return frames
+
+    try:
+        with concurrent.futures.ThreadPoolExecutor(concurrency) as pool:
+            return sum(pool.map(one, range(streams)))
+    finally:
+        app.get_session_pool().mount(None)
+
+
+def run_asgi(app, app_asgi, transcripts, streams, concurrency, stream_format, speed):
+    from backend.async_upstream import AsyncUpstreamClient
+    from backend.transcripts import AsyncReplayTransport
+
+    async def run():
+        client = AsyncUpstreamClient(timeouts=app.upstream_timeouts,
+                                     transport=AsyncReplayTransport(transcripts, speed))
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def one(i):
+            ndx = i % len(app.openai_resources)
+            body, headers = app.prepare_body_headers_with_data(QUESTION, ndx)
+            frames = 0
+            async with semaphore:
+                async with contextlib.aclosing(app_asgi.stream_with_data(
+                        client, body, headers, app.generate_endpoint(ndx), ndx, stream_format,
+                        request_messages=QUESTION)) as data_stream:
+                    async for _ in data_stream:
+                        frames += 1
+            return frames
+
+        try:
+            return sum(await asyncio.gather(*(one(i) for i in range(streams))))
+        finally:
+            await client.aclose()
+
+    return asyncio.run(run())
+
+
+def measure(run):
+    wall, cpu = time.perf_counter(), time.process_time()
+    frames = run()
+    return frames, time.perf_counter() - wall, time.process_time() - cpu
+
+
+def measure_memory(run):
+    tracemalloc.start()
+    try:
+        run()
+        current, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return current, peak
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("paths", nargs="*", help="transcript files or directories of them")
+    parser.add_argument("--synthesize", type=int, default=100, metavar="N",
+                        help="without paths, synthesize N transcripts from the mock upstream options")
+    parser.add_argument("--streams", type=int, help="streams to run, the corpus is cycled (default: its size)")
+    parser.add_argument("--concurrency", type=int, default=1)
+    parser.add_argument("--speed", type=float, default=0.0, help="replay speed, 0 for no delays")
+    parser.add_argument("--stream-format", choices=("delta", "snapshot"), default="delta")
+    parser.add_argument("--modes", default="wsgi,asgi")
+    add_config_arguments(parser)
+    args = parser.parse_args(argv)
+
+    # the settings of the app are read when it is imported
+    for key, value in FAKE_SETTINGS.items():
+        os.environ.setdefault(key, value)
+    os.environ.setdefault("AZURE_OPENAI_SEMANTIC_CACHE", "false")
+    import app
+    import app_asgi
+    from backend.transcripts import load_transcripts
+    # the app logs every stream, and every dropped one as an error: most of the measured work otherwise
+    logging.disable(logging.ERROR)
+
+    transcripts = load_transcripts(args.paths) if args.paths else synthesize(config_from_args(args), args.synthesize)
+    streams = args.streams or len(transcripts)
+    chunks = sum(len(t["chunks"]) for t in transcripts)
+    print(f"{streams} streams from {len(transcripts)} transcripts ({chunks} chunks), {args.concurrency} concurrent, "
+          f"speed {args.speed:g}, {args.stream_format} frames")
+    for mode in args.modes.split(","):
+        if mode == "wsgi":
+            run = lambda: run_wsgi(app, transcripts, streams, args.concurrency, args.stream_format, args.speed)
+        else:
+            run = lambda: run_asgi(app, app_asgi, transcripts, streams, args.concurrency, args.stream_format,
+                                   args.speed)
+        frames, wall, cpu = measure(run)
+        current, peak = measure_memory(run)
+        print(f"{mode:>6}  wall {wall:7.3f} s  cpu {cpu:7.3f} s  cpu/stream {cpu / streams * 1000:7.3f} ms  "
+              f"{frames / wall:9.0f} frames/s  peak mem {peak / 1024:8.0f} KiB  "
+              f"retained {current / 1024:6.0f} KiB")
+
+
+if __name__ == "__main__":
+    main()
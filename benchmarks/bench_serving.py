@@ -0,0 +1,206 @@
+"""Side-by-side benchmark of the uwsgi/Flask (app.py) and ASGI (app_asgi.py) serving modes.
+
+Starts the local mock upstream, then each serving mode pointed at it, and drives both with
+the same number of concurrent conversations. Reports throughput, time-to-first-byte and
+time-to-first-token percentiles and the error rate per mode, and the faults the mock
+injected. Every option of benchmarks.mock_upstream applies, so the modes can be compared
+under slow, throttled or failing regions too. With --target, an app that is already running
+is driven instead (the mock is not started and the app keeps its own upstream).
+
+    python -m benchmarks.bench_serving --concurrency 200 --requests 600
+    python -m benchmarks.bench_serving --distribution lognormal --throttle-rate 0.05 --drop-rate 0.02
+    python -m benchmarks.bench_serving --target http://127.0.0.1:5000 --concurrency 20 --requests 100
+"""
+import argparse
+import asyncio
+import collections
+import json
+import os
+import shutil
+import subprocess
+import sys
+import time
+
+import httpx
+
+from benchmarks.mock_upstream import add_config_arguments, config_arguments
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+FAKE_SETTINGS = {
+    "AZURE_OPENAI_MODEL_NAME": "gpt-35-turbo",
+    "AZURE_OPENAI_RESOURCE": "region1", "AZURE_OPENAI_MODEL": "turbo", "AZURE_OPENAI_KEY": "mock-key",
+    "AZURE_OPENAI_RESOURCE_NC": "region2", "AZURE_OPENAI_MODEL_NC": "turbo", "AZURE_OPENAI_KEY_NC": "mock-key",
+    "AZURE_OPENAI_RESOURCE_US2": "region3", "AZURE_OPENAI_MODEL_US2": "turbo", "AZURE_OPENAI_KEY_US2": "mock-key",
+    "AZURE_SEARCH_SERVICE": "search", "AZURE_SEARCH_INDEX": "index", "AZURE_SEARCH_KEY": "mock-key",
+    "AZURE_SEARCH_CONTENT_COLUMNS": "content",
+}
+
+
+def percentile(values, pct):
+    if not values:
+        return float("nan")
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(pct / 100 * len(ordered))) - 1))
+    return ordered[index]
+
+
+def app_env(upstream_port):
+    env = dict(os.environ)
+    env.update(FAKE_SETTINGS)
+    env["AZURE_OPENAI_BASE_URL_TEMPLATE"] = f"http://127.0.0.1:{upstream_port}/{{resource}}"
+    env["PYTHONPATH"] = REPO_ROOT
+    return env
+
+
+def server_command(mode, port, args):
+    if mode == "wsgi":
+        if shutil.which("uwsgi") is None:
+            return None
+        return ["uwsgi", "--http", f":{port}", "--wsgi-file", "app.py", "--callable", "app", "-b", "32768",
+                "--processes", str(args.processes), "--threads", str(args.threads), "--listen", "1024",
+                "--master", "--die-on-term", "--disable-logging"]
+    return [sys.executable, "-m", "uvicorn", "--factory", "app_asgi:create_app", "--host", "127.0.0.1",
+            "--port", str(port), "--log-level", "warning", "--backlog", "4096"]
+
+
+async def wait_until_ready(url, timeout=30):
+    deadline = time.monotonic() + timeout
+    async with httpx.AsyncClient() as client:
+        while time.monotonic() < deadline:
+            try:
+                r = await client.get(url)
+                if r.status_code == 200:
+                    return
+            except httpx.TransportError:
+                pass
+            await asyncio.sleep(0.2)
+    raise RuntimeError(f"{url} did not become ready in {timeout} seconds")
+
+
+def is_token_frame(frame):
+    """Whether a frame of either stream format carries answer text."""
+    if "delta" in frame:
+        return bool(frame["delta"])
+    messages = frame.get("choices", [{}])[0].get("messages", [])
+    return bool(messages) and messages[-1].get("role") == "assistant" and bool(messages[-1].get("content"))
+
+
+async def run_conversation(client, url, stream_format, results):
+    body = {"messages": [{"role": "user", "content": "How do I get a food vendor license?"}]}
+    start = time.perf_counter()
+    first_byte = first_token = None
+    try:
+        async with client.stream("POST", url, json=body, headers={"X-Stream-Format": stream_format}) as r:
+            if r.status_code != 200:
+                results["errors"][f"status_{r.status_code}"] += 1
+                return
+            async for line in r.aiter_lines():
+                if first_byte is None:
+                    first_byte = time.perf_counter() - start
+                if not line:
+                    continue
+                frame = json.loads(line)
+                if "error" in frame:
+                    results["errors"]["error_frame"] += 1
+                    return
+                if first_token is None and is_token_frame(frame):
+                    first_token = time.perf_counter() - start
+        results["ttfb"].append(first_byte)
+        if first_token is not None:
+            results["ttft"].append(first_token)
+        results["duration"].append(time.perf_counter() - start)
+    except Exception as e:
+        results["errors"][type(e).__name__] += 1
+
+
+async def drive(base_url, concurrency, total, stream_format="delta"):
+    results = {"ttfb": [], "ttft": [], "duration": [], "errors": collections.Counter()}
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(limits=limits, timeout=httpx.Timeout(300)) as client:
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def one():
+            async with semaphore:
+                await run_conversation(client, f"{base_url}/conversation", stream_format, results)
+
+        start = time.perf_counter()
+        await asyncio.gather(*(one() for _ in range(total)))
+        results["elapsed"] = time.perf_counter() - start
+    return results
+
+
+async def fetch_json(url):
+    async with httpx.AsyncClient() as client:
+        return (await client.get(url)).json()
+
+
+def report(mode, results, total, upstream_faults=None):
+    ttfb, ttft = results["ttfb"], results["ttft"]
+    errors = sum(results["errors"].values())
+    print(f"{mode:>6}  {total / results['elapsed']:8.1f} req/s  "
+          f"ttfb p50 {percentile(ttfb, 50) * 1000:6.0f} ms  p95 {percentile(ttfb, 95) * 1000:6.0f} ms  "
+          f"ttft p50 {percentile(ttft, 50) * 1000:6.0f} ms  p95 {percentile(ttft, 95) * 1000:6.0f} ms  "
+          f"p99 {percentile(ttft, 99) * 1000:6.0f} ms  "
+          f"duration p50 {percentile(results['duration'], 50):6.2f} s  errors {errors / total:6.1%}")
+    if errors:
+        print(f"{'':>6}  errors: {', '.join(f'{kind} {count}' for kind, count in sorted(results['errors'].items()))}")
+    if upstream_faults:
+        print(f"{'':>6}  upstream: {', '.join(f'{kind} {count}' for kind, count in sorted(upstream_faults.items()))}")
+
+
+def counter_delta(after, before):
+    return {key: value - before.get(key, 0) for key, value in after.items() if value - before.get(key, 0)}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--concurrency", type=int, default=200)
+    parser.add_argument("--requests", type=int, default=600)
+    parser.add_argument("--stream-format", choices=("delta", "snapshot"), default="delta")
+    parser.add_argument("--target", help="base URL of a running app to drive instead of starting the modes")
+    add_config_arguments(parser)
+    parser.set_defaults(tokens=100)
+    parser.add_argument("--processes", type=int, default=4, help="uwsgi worker processes")
+    parser.add_argument("--threads", type=int, default=8, help="threads per uwsgi worker")
+    parser.add_argument("--modes", default="wsgi,asgi")
+    parser.add_argument("--upstream-port", type=int, default=18181)
+    parser.add_argument("--port", type=int, default=18180)
+    args = parser.parse_args(argv)
+
+    if args.target:
+        print(f"{args.requests} conversations, {args.concurrency} concurrent, against {args.target}")
+        results = asyncio.run(drive(args.target.rstrip("/"), args.concurrency, args.requests, args.stream_format))
+        report("target", results, args.requests)
+        return
+
+    upstream = subprocess.Popen([sys.executable, "-m", "benchmarks.mock_upstream", "--port", str(args.upstream_port)]
+                                + config_arguments(args), cwd=REPO_ROOT, stdout=subprocess.DEVNULL)
+    upstream_stats = f"http://127.0.0.1:{args.upstream_port}/mock/stats"
+    try:
+        asyncio.run(wait_until_ready(upstream_stats))
+        print(f"{args.requests} conversations, {args.concurrency} concurrent, {args.tokens} tokens each")
+        for mode in args.modes.split(","):
+            command = server_command(mode, args.port, args)
+            if command is None:
+                print(f"{mode:>6}  skipped, uwsgi is not installed")
+                continue
+            server = subprocess.Popen(command, cwd=REPO_ROOT, env=app_env(args.upstream_port),
+                                      stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            try:
+                base_url = f"http://127.0.0.1:{args.port}"
+                asyncio.run(wait_until_ready(f"{base_url}/upstream/status"))
+                before = asyncio.run(fetch_json(upstream_stats))
+                results = asyncio.run(drive(base_url, args.concurrency, args.requests, args.stream_format))
+                after = asyncio.run(fetch_json(upstream_stats))
+                report(mode, results, args.requests, counter_delta(after, before))
+            finally:
+                server.terminate()
+                server.wait()
+    finally:
+        upstream.terminate()
+        upstream.wait()
+
+
+if __name__ == "__main__":
+    main()
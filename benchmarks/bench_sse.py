@@ -0,0 +1,81 @@
+"""Throughput benchmark of reading the upstream event stream.
+
+Compares the original loop, `iter_lines(chunk_size=10)` plus stripping the `data:` prefix of
+every line, with `backend.sse.iter_events` over `iter_content(READ_SIZE)`. Both read the same
+mock upstream transcript through a `requests` response backed by an in-memory body, so only
+the reading and the framing are measured, not the network or the JSON decoding.
+
+    python -m benchmarks.bench_sse --tokens 400 --number 20
+"""
+import argparse
+import io
+import time
+
+import requests
+
+from backend.sse import READ_SIZE, is_done, iter_events
+from benchmarks.mock_upstream import MockUpstreamConfig, build_chunk, build_tool_message
+
+
+def mock_body(tokens):
+    config = MockUpstreamConfig(tokens=tokens)
+    chunks = [build_chunk(build_tool_message(config)), build_chunk({"role": "assistant"})]
+    chunks += [build_chunk({"content": f"token{i} "}) for i in range(tokens)]
+    chunks.append(build_chunk({"content": "[DONE]"}))
+    return b"".join(chunks)
+
+
+def response_for(body):
+    response = requests.models.Response()
+    response.raw = io.BytesIO(body)
+    response.status_code = 200
+    return response
+
+
+def legacy_loop(body):
+    payloads = 0
+    for line in response_for(body).iter_lines(chunk_size=10):
+        if line:
+            line.lstrip(b'data:')
+            payloads += 1
+    return payloads
+
+
+def sse_loop(body):
+    payloads = 0
+    for event in iter_events(response_for(body).iter_content(chunk_size=READ_SIZE)):
+        if is_done(event):
+            break
+        payloads += 1
+    return payloads
+
+
+def measure(loop, body, number, repeat):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(number):
+            loop(body)
+        best = min(best, (time.perf_counter() - start) / number)
+    return best
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--tokens", type=int, default=400, help="content chunks of the mock transcript")
+    parser.add_argument("--number", type=int, default=20, help="passes over the transcript per measurement")
+    parser.add_argument("--repeat", type=int, default=5, help="measurements per loop, the best one is reported")
+    args = parser.parse_args(argv)
+
+    body = mock_body(args.tokens)
+    events = sse_loop(body)
+    assert legacy_loop(body) == events
+    print(f"{events} events, {len(body)} bytes")
+    results = {name: measure(loop, body, args.number, args.repeat) for name, loop in (("legacy", legacy_loop), ("sse", sse_loop))}
+    for name, seconds in results.items():
+        print(f"{name:7} {events / seconds:12,.0f} events/s  {len(body) / seconds / 1e6:8.1f} MB/s  "
+              f"{results['legacy'] / seconds:5.2f}x")
+
+
+if __name__ == "__main__":
+    main()
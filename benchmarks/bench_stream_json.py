@@ -0,0 +1,106 @@
+"""Micro-benchmark of the per-line JSON work of the /conversation stream loop.
+
+Runs the loop of `stream_with_data` (decode an upstream `data:` line, feed the assembler,
+encode the frame) over an upstream transcript, once as it was originally written
+(`lstrip`, `decode`, `json.loads`, `json.dumps(...).replace`) and once per installed
+`backend.jsonutil` codec. Reports upstream lines per second on one core, for both stream formats.
+
+The transcript is the one the mock upstream streams, or a recorded one: a file of the
+`data: {...}` lines of an upstream response, e.g. captured with `curl -N`.
+
+    python -m benchmarks.bench_stream_json --tokens 400 --number 20
+    python -m benchmarks.bench_stream_json --transcript recorded.txt
+"""
+import argparse
+import json
+import time
+
+from backend import jsonutil, streaming
+from backend.streaming import FORMAT_DELTA, FORMAT_SNAPSHOT, create_assembler
+from benchmarks.mock_upstream import MockUpstreamConfig, build_chunk, build_tool_message
+
+
+def mock_transcript(tokens):
+    config = MockUpstreamConfig(tokens=tokens)
+    chunks = [build_chunk(build_tool_message(config)), build_chunk({"role": "assistant"})]
+    chunks += [build_chunk({"content": f"token{i} "}) for i in range(tokens)]
+    chunks.append(build_chunk({"content": "[DONE]"}))
+    # iter_lines yields the lines without their line breaks
+    return [chunk.strip() for chunk in chunks]
+
+
+def load_transcript(path):
+    with open(path, "rb") as f:
+        return [line.strip() for line in f if line.strip()]
+
+
+def legacy_frame(obj):
+    # the server encodes the str frames before writing them
+    return (json.dumps(obj).replace("\n", "\\n") + "\n").encode("utf-8")
+
+
+def legacy_parse(line):
+    return json.loads(line.lstrip(b'data:').decode('utf-8'))
+
+
+def data_line_parser(loads):
+    """Decodes a `data: {...}` line like the stream loop: the SSE parser drops the field name and
+    the space after it, `loads` decodes the event's data."""
+    def parse(line):
+        value = line[5:] if line.startswith(b"data:") else line
+        return loads(value[1:] if value.startswith(b" ") else value)
+    return parse
+
+
+def run_loop(transcript, stream_format, parse):
+    assembler = create_assembler(stream_format)
+    for line in transcript:
+        if line:
+            frame = assembler.feed(parse(line))
+    frame = assembler.finish()
+    return frame
+
+
+def measure(transcript, stream_format, parse, frame, number):
+    original = streaming.format_frame
+    streaming.format_frame = frame
+    try:
+        start = time.perf_counter()
+        for _ in range(number):
+            run_loop(transcript, stream_format, parse)
+        return len(transcript) * number / (time.perf_counter() - start)
+    finally:
+        streaming.format_frame = original
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--transcript", help="file of recorded upstream data: lines, instead of the mock transcript")
+    parser.add_argument("--tokens", type=int, default=400, help="content chunks of the mock transcript")
+    parser.add_argument("--number", type=int, default=20, help="passes over the transcript per measurement")
+    parser.add_argument("--repeat", type=int, default=5, help="measurements per variant, the best one is reported")
+    args = parser.parse_args(argv)
+
+    transcript = load_transcript(args.transcript) if args.transcript else mock_transcript(args.tokens)
+    variants = [("legacy", legacy_parse, legacy_frame)]
+    for name in jsonutil.BACKENDS:
+        try:
+            codec = jsonutil.get_codec(name)
+        except RuntimeError:
+            print(f"{name:8} not installed, skipped")
+            continue
+        variants.append((name, data_line_parser(codec.loads), lambda obj, dumps=codec.dumps: dumps(obj) + b"\n"))
+
+    print(f"{len(transcript)} upstream lines, {sum(len(line) for line in transcript)} bytes")
+    for stream_format in (FORMAT_DELTA, FORMAT_SNAPSHOT):
+        # best of interleaved rounds, so every variant sees the same machine noise
+        rates = {name: 0 for name, _, _ in variants}
+        for _ in range(args.repeat):
+            for name, parse, frame in variants:
+                rates[name] = max(rates[name], measure(transcript, stream_format, parse, frame, args.number))
+        for name, rate in rates.items():
+            print(f"{stream_format:8} {name:8} {rate:12,.0f} lines/s  {rate / rates['legacy']:5.2f}x")
+
+
+if __name__ == "__main__":
+    main()
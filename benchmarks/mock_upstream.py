@@ -0,0 +1,245 @@
+"""Local mock of the Azure OpenAI "on your data" streaming endpoint.
+
+Answers every POST to `.../extensions/chat/completions` with the stream `stream_with_data`
+consumes: a tool (citations) message, the assistant role, one content delta per token and a
+final "[DONE]" delta, as `data:` lines over a chunked keep-alive HTTP/1.1 response. Built on
+asyncio streams so it can serve thousands of concurrent streams without becoming the
+bottleneck of a benchmark.
+
+The delays before the response headers and before the first chunk (the retrieval) and the
+token rate of every stream can be drawn from a distribution, and faults injected at given
+rates: 429 answers with a Retry-After header, 500/503 answers and streams dropped after a
+random number of tokens. GET /mock/stats returns what was served.
+
+    python -m benchmarks.mock_upstream --port 8081 --tokens 200 --token-delay 0.02
+    python -m benchmarks.mock_upstream --port 8081 --distribution lognormal --spread 0.5 \
+        --throttle-rate 0.05 --error-rate 0.02 --drop-rate 0.02
+"""
+import argparse
+import asyncio
+import collections
+import json
+import math
+import random
+import time
+from dataclasses import dataclass
+from typing import Optional
+
+CHUNK_META = {
+    "id": "mock-completion",
+    "model": "gpt-35-turbo",
+    "object": "extensions.chat.completion.chunk"
+}
+
+
+CHAT_PATH = "/extensions/chat/completions"
+DISTRIBUTIONS = ("fixed", "uniform", "exponential", "lognormal")
+
+
+@dataclass
+class MockUpstreamConfig:
+    tokens: int = 200
+    # seconds before the response headers
+    header_delay: float = 0.0
+    # seconds from the headers to the first chunk, the retrieval of the extension
+    first_token_delay: float = 0.5
+    token_delay: float = 0.02
+    citations: int = 5
+    citation_chars: int = 1500
+    # how the delays of every request vary around the values above, see `sample_delay`
+    distribution: str = "fixed"
+    spread: float = 0.5
+    # fractions of the requests answered with a 429, a 500/503, or dropped mid-stream
+    throttle_rate: float = 0.0
+    error_rate: float = 0.0
+    drop_rate: float = 0.0
+    retry_after: float = 1.0
+    seed: Optional[int] = None
+
+
+def sample_delay(mean: float, distribution: str, spread: float, rng: random.Random) -> float:
+    """One delay of mean (median for lognormal) `mean`; `spread` is the relative width of
+    uniform and the sigma of lognormal."""
+    if mean <= 0 or distribution == "fixed":
+        return max(mean, 0.0)
+    if distribution == "uniform":
+        return rng.uniform(mean * max(0.0, 1 - spread), mean * (1 + spread))
+    if distribution == "exponential":
+        return rng.expovariate(1 / mean)
+    if distribution == "lognormal":
+        return mean * math.exp(rng.gauss(0, spread))
+    raise ValueError(f"unknown distribution {distribution!r}, expected one of {', '.join(DISTRIBUTIONS)}")
+
+
+def build_chunk(delta: dict) -> bytes:
+    chunk = {**CHUNK_META, "created": int(time.time()), "choices": [{"index": 0, "messages": [{"delta": delta}]}]}
+    return b"data: " + json.dumps(chunk).encode("utf-8") + b"\n\n"
+
+
+def build_tool_message(config: MockUpstreamConfig) -> dict:
+    citations = [{
+        "content": ("Lorem ipsum dolor sit amet. " * (config.citation_chars // 28 + 1))[:config.citation_chars],
+        "id": None,
+        "title": f"Document {i}",
+        "filepath": f"doc-{i}.pdf",
+        "url": f"https://example.com/doc-{i}.pdf",
+        "metadata": {"chunking": f"orignal document size=2048. Scores=3.1 and None.Org Highlight count=4."},
+        "chunk_id": str(i)
+    } for i in range(config.citations)]
+    return {"role": "tool", "content": json.dumps({"citations": citations, "intent": "[\"mock question\"]"})}
+
+
+class MockUpstream(object):
+    def __init__(self, config: MockUpstreamConfig):
+        self.config = config
+        self.requests = 0
+        self.rng = random.Random(config.seed)
+        self.counters = collections.Counter()
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, path = (request_line.decode("latin-1").split(" ") + ["", ""])[:2]
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                content_length = int(headers.get("content-length", 0))
+                if content_length:
+                    await reader.readexactly(content_length)
+                if method == "GET" and path == "/mock/stats":
+                    await self.write_response(writer, 200, json.dumps(self.stats()).encode("utf-8"))
+                    continue
+                if method != "POST" or CHAT_PATH not in path:
+                    await self.write_response(writer, 404, b'{"error": {"code": "404", "message": "Resource not found"}}')
+                    continue
+                self.requests += 1
+                if not await self.answer(writer):
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def write_response(self, writer: asyncio.StreamWriter, status: int, body: bytes, headers: str = ""):
+        reason = {200: "OK", 404: "Not Found", 429: "Too Many Requests", 500: "Internal Server Error",
+                  503: "Service Unavailable"}[status]
+        writer.write(f"HTTP/1.1 {status} {reason}\r\nContent-Type: application/json\r\n"
+                     f"Content-Length: {len(body)}\r\n{headers}\r\n".encode("latin-1") + body)
+        await writer.drain()
+
+    async def answer(self, writer: asyncio.StreamWriter) -> bool:
+        """Serves one request, or injects a fault; False when the connection was dropped."""
+        config = self.config
+        await asyncio.sleep(sample_delay(config.header_delay, config.distribution, config.spread, self.rng))
+        fault = self.rng.random()
+        if fault < config.throttle_rate:
+            self.counters["throttled"] += 1
+            await self.write_response(writer, 429, b'{"error": {"code": "429", "message": "Rate limit reached"}}',
+                                      f"Retry-After: {config.retry_after:g}\r\n")
+            return True
+        fault -= config.throttle_rate
+        if fault < config.error_rate:
+            status = self.rng.choice((500, 503))
+            self.counters[f"status_{status}"] += 1
+            await self.write_response(writer, status, b'{"error": {"code": "InternalServerError"}}')
+            return True
+        fault -= config.error_rate
+        drop_after = self.rng.randrange(config.tokens) if fault < config.drop_rate and config.tokens else None
+        completed = await self.stream_answer(writer, drop_after)
+        self.counters["completed" if completed else "dropped"] += 1
+        return completed
+
+    def stats(self) -> dict:
+        return {"requests": self.requests, **self.counters}
+
+    async def write_chunk(self, writer: asyncio.StreamWriter, data: bytes):
+        writer.write(b"%x\r\n%s\r\n" % (len(data), data))
+        await writer.drain()
+
+    async def stream_answer(self, writer: asyncio.StreamWriter, drop_after: Optional[int] = None) -> bool:
+        """Streams one answer; with `drop_after`, the connection is cut after that many tokens."""
+        config = self.config
+        writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\nTransfer-Encoding: chunked\r\n\r\n")
+        await asyncio.sleep(sample_delay(config.first_token_delay, config.distribution, config.spread, self.rng))
+        token_delay = sample_delay(config.token_delay, config.distribution, config.spread, self.rng)
+        await self.write_chunk(writer, build_chunk(build_tool_message(config)))
+        await self.write_chunk(writer, build_chunk({"role": "assistant"}))
+        for i in range(config.tokens):
+            if i == drop_after:
+                writer.transport.abort()
+                return False
+            if token_delay:
+                await asyncio.sleep(token_delay)
+            await self.write_chunk(writer, build_chunk({"content": f"token{i} "}))
+        await self.write_chunk(writer, build_chunk({"content": "[DONE]"}))
+        writer.write(b"0\r\n\r\n")
+        await writer.drain()
+        return True
+
+    async def serve(self, host: str, port: int):
+        server = await asyncio.start_server(self.handle, host, port, backlog=4096)
+        async with server:
+            await server.serve_forever()
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Mock Azure OpenAI on-your-data streaming upstream.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081)
+    add_config_arguments(parser)
+    return parser.parse_args(argv)
+
+
+def add_config_arguments(parser: argparse.ArgumentParser):
+    """The MockUpstreamConfig options, shared with the benchmarks that start the mock."""
+    parser.add_argument("--tokens", type=int, default=MockUpstreamConfig.tokens)
+    parser.add_argument("--header-delay", type=float, default=MockUpstreamConfig.header_delay)
+    parser.add_argument("--first-token-delay", type=float, default=MockUpstreamConfig.first_token_delay)
+    parser.add_argument("--token-delay", type=float, default=MockUpstreamConfig.token_delay)
+    parser.add_argument("--token-rate", type=float, help="tokens per second, instead of --token-delay")
+    parser.add_argument("--citations", type=int, default=MockUpstreamConfig.citations)
+    parser.add_argument("--distribution", choices=DISTRIBUTIONS, default=MockUpstreamConfig.distribution)
+    parser.add_argument("--spread", type=float, default=MockUpstreamConfig.spread)
+    parser.add_argument("--throttle-rate", type=float, default=MockUpstreamConfig.throttle_rate)
+    parser.add_argument("--error-rate", type=float, default=MockUpstreamConfig.error_rate)
+    parser.add_argument("--drop-rate", type=float, default=MockUpstreamConfig.drop_rate)
+    parser.add_argument("--retry-after", type=float, default=MockUpstreamConfig.retry_after)
+    parser.add_argument("--seed", type=int)
+
+
+def config_arguments(args) -> list:
+    """The command-line arguments that give a mock started as a subprocess the config of `args`."""
+    argv = []
+    for name in ("tokens", "header_delay", "first_token_delay", "token_delay", "token_rate", "citations",
+                 "distribution", "spread", "throttle_rate", "error_rate", "drop_rate", "retry_after", "seed"):
+        value = getattr(args, name)
+        if value is not None:
+            argv += ["--" + name.replace("_", "-"), str(value)]
+    return argv
+
+
+def config_from_args(args) -> MockUpstreamConfig:
+    return MockUpstreamConfig(tokens=args.tokens, header_delay=args.header_delay,
+                              first_token_delay=args.first_token_delay,
+                              token_delay=1 / args.token_rate if args.token_rate else args.token_delay,
+                              citations=args.citations, distribution=args.distribution, spread=args.spread,
+                              throttle_rate=args.throttle_rate, error_rate=args.error_rate,
+                              drop_rate=args.drop_rate, retry_after=args.retry_after, seed=args.seed)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    config = config_from_args(args)
+    print(f"Mock upstream listening on http://{args.host}:{args.port}")
+    asyncio.run(MockUpstream(config).serve(args.host, args.port))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,20 +1,79 @@
-import { UserInfo, ConversationRequest } from "./models";
+import { UserInfo, ConversationRequest, ChatResponse, DeltaStreamFrame } from "./models";
 
-export async function conversationApi(options: ConversationRequest, abortSignal: AbortSignal): Promise<Response> {
+export const STREAM_FORMAT_HEADER = "X-Stream-Format";
+export const DELTA_STREAM_FORMAT = "delta";
+export const CONVERSATION_STORE_HEADER = "X-Conversation-Store";
+
+// set once a response shows that the server keeps the history of the conversations
+let serverStoresConversations = false;
+
+export function newConversationId(): string {
+    if (typeof crypto !== "undefined" && crypto.randomUUID) {
+        return crypto.randomUUID();
+    }
+    return Array.from({ length: 4 }, () => Math.random().toString(36).slice(2, 10)).join("-");
+}
+
+async function postConversation(body: object, abortSignal: AbortSignal): Promise<Response> {
     const response = await fetch("/conversation", {
         method: "POST",
         headers: {
-            "Content-Type": "application/json"
+            "Content-Type": "application/json",
+            [STREAM_FORMAT_HEADER]: DELTA_STREAM_FORMAT
         },
-        body: JSON.stringify({
-            messages: options.messages
-        }),
+        body: JSON.stringify(body),
         signal: abortSignal
     });
-
+    serverStoresConversations = response.headers.get(CONVERSATION_STORE_HEADER) === "true";
     return response;
 }
 
+export async function conversationApi(options: ConversationRequest, abortSignal: AbortSignal): Promise<Response> {
+    if (!options.conversationId) {
+        return await postConversation({ messages: options.messages }, abortSignal);
+    }
+
+    // only send the new turn to a server that stores conversations; it answers 409 when it does
+    // not hold the history before it
+    const historyLength = options.messages.length - 1;
+    if (historyLength > 0 && serverStoresConversations) {
+        const response = await postConversation({
+            conversation_id: options.conversationId,
+            history_length: historyLength,
+            messages: options.messages.slice(historyLength)
+        }, abortSignal);
+        if (response.status !== 409) {
+            return response;
+        }
+    }
+
+    return await postConversation({
+        conversation_id: options.conversationId,
+        full_history: true,
+        messages: options.messages
+    }, abortSignal);
+}
+
+export function isProgressFrame(frame: DeltaStreamFrame): boolean {
+    return frame.accepted !== undefined || frame.heartbeat !== undefined;
+}
+
+export function applyDeltaFrame(result: ChatResponse, frame: DeltaStreamFrame): ChatResponse {
+    if (frame.error !== undefined) {
+        return frame as ChatResponse;
+    }
+
+    const messages = [...(result.choices?.[0]?.messages ?? [])];
+    if (frame.message) {
+        messages.push({ ...frame.message });
+    } else if (frame.delta !== undefined && messages.length > 0) {
+        const last = messages[messages.length - 1];
+        messages[messages.length - 1] = { ...last, content: last.content + frame.delta };
+    }
+
+    return { ...result, ...frame.done, choices: [{ messages }] };
+}
+
 export async function getUserInfo(): Promise<UserInfo[]> {
     const response = await fetch('/.auth/me');
     if (!response.ok) {
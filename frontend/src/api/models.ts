@@ -44,8 +44,23 @@ export type ChatResponse = {
     error?: any;
 }
 
+export type DeltaStreamFrame = {
+    accepted?: boolean;
+    heartbeat?: boolean;
+    message?: ChatMessage;
+    delta?: string;
+    done?: {
+        id: string;
+        model: string;
+        created: number;
+        object: ChatCompletionType;
+    };
+    error?: any;
+};
+
 export type ConversationRequest = {
     messages: ChatMessage[];
+    conversationId?: string;
 };
 
 export type UserInfo = {
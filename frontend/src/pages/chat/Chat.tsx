@@ -25,6 +25,11 @@ import {
   ToolMessageContent,
   ChatResponse,
   getUserInfo,
+  applyDeltaFrame,
+  isProgressFrame,
+  newConversationId,
+  STREAM_FORMAT_HEADER,
+  DELTA_STREAM_FORMAT,
 } from "../../api";
 import { Answer } from "../../components/Answer";
 import { QuestionInput } from "../../components/QuestionInput";
@@ -32,6 +37,7 @@ import { InfoCardList } from "../../components/InfoCardList";
 
 const Chat = () => {
   const lastQuestionRef = useRef<string>("");
+  const conversationIdRef = useRef<string>(newConversationId());
   const chatMessageStreamEnd = useRef<HTMLDivElement | null>(null);
   const [isLoading, setIsLoading] = useState<boolean>(false);
   const [showLoadingMessage, setShowLoadingMessage] = useState<boolean>(false);
@@ -79,6 +85,7 @@ const Chat = () => {
         ...answers.filter((answer) => answer.role !== "error"),
         userMessage,
       ],
+      conversationId: conversationIdRef.current,
     };
 
     let result = {} as ChatResponse;
@@ -86,17 +93,26 @@ const Chat = () => {
       const response = await conversationApi(request, abortController.signal);
       if (response?.body) {
         const reader = response.body.getReader();
+        const decoder = new TextDecoder("utf-8");
+        const isDeltaStream =
+          response.headers.get(STREAM_FORMAT_HEADER) === DELTA_STREAM_FORMAT;
         let runningText = "";
         while (true) {
           const { done, value } = await reader.read();
           if (done) break;
 
-          var text = new TextDecoder("utf-8").decode(value);
+          var text = decoder.decode(value, { stream: true });
           const objects = text.split("\n");
           objects.forEach((obj) => {
             try {
               runningText += obj;
-              result = JSON.parse(runningText);
+              const frame = JSON.parse(runningText);
+              if (isDeltaStream && isProgressFrame(frame)) {
+                // the server is still connecting upstream, keep the loading message
+                runningText = "";
+                return;
+              }
+              result = isDeltaStream ? applyDeltaFrame(result, frame) : frame;
               setShowLoadingMessage(false);
               setAnswers([
                 ...answers,
@@ -143,6 +159,7 @@ const Chat = () => {
 
   const clearChat = () => {
     lastQuestionRef.current = "";
+    conversationIdRef.current = newConversationId();
     setActiveCitation(undefined);
     setAnswers([]);
   };
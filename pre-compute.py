@@ -10,6 +10,10 @@ from flask import Flask, Response, request, jsonify, send_from_directory
 from dotenv import load_dotenv
 from opencensus.ext.azure.log_exporter import AzureLogHandler
 
+from backend.settings import Settings, build_request_templates
+from backend.sse import READ_SIZE as SSE_READ_SIZE, is_done, iter_events
+from backend.upstream import get_session_pool
+
 load_dotenv()
 
 app = Flask(__name__, static_folder="static")
@@ -104,6 +108,9 @@ openai_resources = [AZURE_OPENAI_RESOURCE, AZURE_OPENAI_RESOURCE_NC, AZURE_OPENA
 openai_models = [AZURE_OPENAI_MODEL, AZURE_OPENAI_MODEL_NC, AZURE_OPENAI_MODEL_US2]
 openai_model_names = [AZURE_OPENAI_MODEL_NAME, AZURE_OPENAI_MODEL_NAME_NC, AZURE_OPENAI_MODEL_NAME_US2]
 
+# request body, headers and endpoint of every region, rendered once at startup
+request_templates = build_request_templates(Settings.from_env())
+
 # -----------------------------------------------------------------------------
 # Endpoint randomization stuff
 # -----------------------------------------------------------------------------
@@ -111,10 +118,7 @@ total_endpoints = 3
 
 
 def generate_endpoint(ndx):
-    resource = openai_resources[ndx]
-    model = openai_models[ndx]
-    api_version = AZURE_OPENAI_PREVIEW_API_VERSION
-    return f"https://{resource}.openai.azure.com/openai/deployments/{model}/extensions/chat/completions?api-version={api_version}"
+    return request_templates[ndx].endpoint
 
 
 def next_index(ndx):
@@ -124,69 +128,13 @@ def next_index(ndx):
 # -----------------------------------------------------------------------------
 # Everything else
 # -----------------------------------------------------------------------------
-def is_chat_model():
-    if 'gpt-4' in AZURE_OPENAI_MODEL_NAME.lower() or AZURE_OPENAI_MODEL_NAME.lower() in ['gpt-35-turbo-4k',
-                                                                                         'gpt-35-turbo-16k']:
-        return True
-    return False
-
-
 def prepare_body_headers_with_data(r, ndx):
-    request_messages = r.json["messages"]
-    openai_key = openai_keys[ndx]
-    openai_resource = openai_resources[ndx]
-    openai_model = openai_models[ndx]
-
-    body = {
-        "messages": request_messages,
-        "temperature": float(AZURE_OPENAI_TEMPERATURE),
-        "max_tokens": int(AZURE_OPENAI_MAX_TOKENS),
-        "top_p": float(AZURE_OPENAI_TOP_P),
-        "stop": AZURE_OPENAI_STOP_SEQUENCE.split("|") if AZURE_OPENAI_STOP_SEQUENCE else None,
-        "stream": SHOULD_STREAM,
-        "dataSources": [
-            {
-                "type": "AzureCognitiveSearch",
-                "parameters": {
-                    "endpoint": f"https://{AZURE_SEARCH_SERVICE}.search.windows.net",
-                    "key": AZURE_SEARCH_KEY,
-                    "indexName": AZURE_SEARCH_INDEX,
-                    "fieldsMapping": {
-                        "contentField": AZURE_SEARCH_CONTENT_COLUMNS.split("|") if AZURE_SEARCH_CONTENT_COLUMNS else [],
-                        "titleField": AZURE_SEARCH_TITLE_COLUMN if AZURE_SEARCH_TITLE_COLUMN else None,
-                        "urlField": AZURE_SEARCH_URL_COLUMN if AZURE_SEARCH_URL_COLUMN else None,
-                        "filepathField": AZURE_SEARCH_FILENAME_COLUMN if AZURE_SEARCH_FILENAME_COLUMN else None
-                    },
-                    "inScope": True if AZURE_SEARCH_ENABLE_IN_DOMAIN.lower() == "true" else False,
-                    "topNDocuments": AZURE_SEARCH_TOP_K,
-                    "queryType": "semantic" if AZURE_SEARCH_USE_SEMANTIC_SEARCH.lower() == "true" else "simple",
-                    "semanticConfiguration": AZURE_SEARCH_SEMANTIC_SEARCH_CONFIG if AZURE_SEARCH_USE_SEMANTIC_SEARCH.lower() == "true" and AZURE_SEARCH_SEMANTIC_SEARCH_CONFIG else "",
-                    "roleInformation": AZURE_OPENAI_SYSTEM_MESSAGE
-                }
-            }
-        ]
-    }
-
-    chatgpt_url = f"https://{openai_resource}.openai.azure.com/openai/deployments/{openai_model}"
-    if is_chat_model():
-        chatgpt_url += "/chat/completions?api-version=2023-03-15-preview"
-    else:
-        chatgpt_url += "/completions?api-version=2023-03-15-preview"
-
-    headers = {
-        'Content-Type': 'application/json',
-        'api-key': openai_key,
-        'chatgpt_url': chatgpt_url,
-        'chatgpt_key': openai_key,
-        "x-ms-useragent": "GitHubSampleWebApp/PublicAPI/1.0.0"
-    }
-
-    return body, headers
+    return request_templates[ndx].render(r.json["messages"])
 
 
 def stream_with_data(body, headers, endpoint):
     logger.info(f"stream_with_data: {endpoint}")
-    s = requests.Session()
+    s = get_session_pool().session_for(endpoint)
     response = {
         "id": "",
         "model": "",
@@ -200,34 +148,35 @@ def stream_with_data(body, headers, endpoint):
     logger.info("stream_with_data: starting POST with retries")
     start_time = time.time()
     try:
-        with s.post(endpoint, json=body, headers=headers, stream=True, timeout=5) as r:
+        with s.post(endpoint, data=body, headers=headers, stream=True, timeout=5) as r:
             total_time = round(time.time() - start_time, 3)
             logger.info(f"stream_with_data: POST completed in {total_time} seconds, processing response lines")
             start_time = time.time()
-            for line in r.iter_lines(chunk_size=10):
-                if line:
-                    line_json = json.loads(line.lstrip(b'data:').decode('utf-8'))
-                    if 'error' in line_json:
-                        yield json.dumps(line_json).replace("\n", "\\n") + "\n"
-                    response["id"] = line_json["id"]
-                    response["model"] = line_json["model"]
-                    response["created"] = line_json["created"]
-                    response["object"] = line_json["object"]
-
-                    role = line_json["choices"][0]["messages"][0]["delta"].get("role")
-                    if role == "tool":
-                        response["choices"][0]["messages"].append(line_json["choices"][0]["messages"][0]["delta"])
-                    elif role == "assistant":
-                        response["choices"][0]["messages"].append({
-                            "role": "assistant",
-                            "content": ""
-                        })
-                    else:
-                        deltaText = line_json["choices"][0]["messages"][0]["delta"]["content"]
-                        if deltaText != "[DONE]":
-                            response["choices"][0]["messages"][1]["content"] += deltaText
-
-                    yield json.dumps(response).replace("\n", "\\n") + "\n"
+            for event in iter_events(r.iter_content(chunk_size=SSE_READ_SIZE)):
+                if is_done(event):
+                    break
+                line_json = json.loads(event.data)
+                if 'error' in line_json:
+                    yield json.dumps(line_json).replace("\n", "\\n") + "\n"
+                response["id"] = line_json["id"]
+                response["model"] = line_json["model"]
+                response["created"] = line_json["created"]
+                response["object"] = line_json["object"]
+
+                role = line_json["choices"][0]["messages"][0]["delta"].get("role")
+                if role == "tool":
+                    response["choices"][0]["messages"].append(line_json["choices"][0]["messages"][0]["delta"])
+                elif role == "assistant":
+                    response["choices"][0]["messages"].append({
+                        "role": "assistant",
+                        "content": ""
+                    })
+                else:
+                    deltaText = line_json["choices"][0]["messages"][0]["delta"]["content"]
+                    if deltaText != "[DONE]":
+                        response["choices"][0]["messages"][1]["content"] += deltaText
+
+                yield json.dumps(response).replace("\n", "\\n") + "\n"
             total_time = round(time.time() - start_time, 3)
             logger.info(f"stream_with_data: lines processed in {total_time} seconds")
     except Exception as e:
@@ -235,13 +184,13 @@ def stream_with_data(body, headers, endpoint):
         yield json.dumps({"error": "Sorry, I could not answer that. Please try asking a different question"}) + "\n"
 
 
-def conversation_with_data(headers_arr, body_arr, endpoint_arr):
+def conversation_with_data(request_messages):
     current_index = 0 # random.randint(0, total_endpoints - 1)
     for retry in range(total_endpoints):
         try:
-            headers = headers_arr[current_index]
-            body = body_arr[current_index]
-            endpoint = endpoint_arr[current_index]
+            # only the region that is actually used gets its request rendered
+            body, headers = request_templates[current_index].render(request_messages)
+            endpoint = request_templates[current_index].endpoint
             # return geez(headers_arr, body_arr, endpoint_arr)
             return Response(stream_with_data(body, headers, endpoint), mimetype='text/event-stream')
 
@@ -270,7 +219,7 @@ def blah(request):
     endpoint = f"https://{AZURE_OPENAI_RESOURCE}.openai.azure.com/openai/deployments/{AZURE_OPENAI_MODEL}/extensions/chat/completions?api-version={AZURE_OPENAI_PREVIEW_API_VERSION}"
 
     if SHOULD_STREAM:
-        r = requests.post(endpoint, headers=headers, json=body)
+        r = requests.post(endpoint, headers=headers, data=body)
         status_code = r.status_code
         r = r.json()
 
@@ -289,24 +238,11 @@ def geez(headers_arr, body_arr, endpoint_arr):
     endpoint = endpoint_arr[current_index]
     return Response(stream_with_data(body, headers, endpoint), mimetype='text/event-stream')
 
-def compute_endpoints():
-    headers_arr = []
-    body_arr = []
-    endpoint_arr = []
-    for i in range(total_endpoints):
-        body, headers = prepare_body_headers_with_data(request, i)
-        endpoint = generate_endpoint(i)
-        headers_arr.append(headers)
-        body_arr.append(body)
-        endpoint_arr.append(endpoint)
-    return headers_arr, body_arr, endpoint_arr
-
 @app.route("/conversation", methods=["GET", "POST"])
 def conversation():
     try:
         logger.info(f"conversation: start of conversation")
-        headers_arr, body_arr, endpoint_arr = compute_endpoints()
-        return conversation_with_data(headers_arr, body_arr, endpoint_arr)
+        return conversation_with_data(request.json["messages"])
         # return geez(headers_arr, body_arr, endpoint_arr)
         # return blah(request)
     except Exception as e:
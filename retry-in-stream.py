@@ -10,6 +10,9 @@ from flask import Flask, Response, request, jsonify, send_from_directory, copy_c
 from dotenv import load_dotenv
 from opencensus.ext.azure.log_exporter import AzureLogHandler
 
+from backend.sse import READ_SIZE as SSE_READ_SIZE, is_done, iter_events
+from backend.upstream import get_session_pool
+
 load_dotenv()
 
 app = Flask(__name__, static_folder="static")
@@ -193,7 +196,6 @@ def prepare_body_headers_with_data(request_messages, ndx):
 
 
 def stream_with_data(request):
-    s = requests.Session()
     response = {
         "id": "",
         "model": "",
@@ -212,7 +214,7 @@ def stream_with_data(request):
                 logger.info(f"stream_with_data: starting POST with retries, index = {current_index}")
                 endpoint = generate_endpoint(current_index)
                 body, headers = prepare_body_headers_with_data(request.json["messages"], current_index)
-                r = s.post(endpoint, json=body, headers=headers, stream=True, timeout=5)
+                r = get_session_pool().session_for(endpoint).post(endpoint, json=body, headers=headers, stream=True, timeout=5)
                 r.raise_for_status()
                 break
             except requests.exceptions.Timeout:
@@ -233,30 +235,31 @@ def stream_with_data(request):
             total_time = round(time.time() - start_time, 3)
             logger.info(f"stream_with_data: POST completed in {total_time} seconds, processing response lines")
             start_time = time.time()
-            for line in r.iter_lines(chunk_size=10):
-                if line:
-                    line_json = json.loads(line.lstrip(b'data:').decode('utf-8'))
-                    if 'error' in line_json:
-                        yield json.dumps(line_json).replace("\n", "\\n") + "\n"
-                    response["id"] = line_json["id"]
-                    response["model"] = line_json["model"]
-                    response["created"] = line_json["created"]
-                    response["object"] = line_json["object"]
-
-                    role = line_json["choices"][0]["messages"][0]["delta"].get("role")
-                    if role == "tool":
-                        response["choices"][0]["messages"].append(line_json["choices"][0]["messages"][0]["delta"])
-                    elif role == "assistant":
-                        response["choices"][0]["messages"].append({
-                            "role": "assistant",
-                            "content": ""
-                        })
-                    else:
-                        deltaText = line_json["choices"][0]["messages"][0]["delta"]["content"]
-                        if deltaText != "[DONE]":
-                            response["choices"][0]["messages"][1]["content"] += deltaText
-
-                    yield json.dumps(response).replace("\n", "\\n") + "\n"
+            for event in iter_events(r.iter_content(chunk_size=SSE_READ_SIZE)):
+                if is_done(event):
+                    break
+                line_json = json.loads(event.data)
+                if 'error' in line_json:
+                    yield json.dumps(line_json).replace("\n", "\\n") + "\n"
+                response["id"] = line_json["id"]
+                response["model"] = line_json["model"]
+                response["created"] = line_json["created"]
+                response["object"] = line_json["object"]
+
+                role = line_json["choices"][0]["messages"][0]["delta"].get("role")
+                if role == "tool":
+                    response["choices"][0]["messages"].append(line_json["choices"][0]["messages"][0]["delta"])
+                elif role == "assistant":
+                    response["choices"][0]["messages"].append({
+                        "role": "assistant",
+                        "content": ""
+                    })
+                else:
+                    deltaText = line_json["choices"][0]["messages"][0]["delta"]["content"]
+                    if deltaText != "[DONE]":
+                        response["choices"][0]["messages"][1]["content"] += deltaText
+
+                yield json.dumps(response).replace("\n", "\\n") + "\n"
             total_time = round(time.time() - start_time, 3)
             logger.info(f"stream_with_data: lines processed in {total_time} seconds")
     except Exception as e:
@@ -269,7 +272,7 @@ def conversation_with_data(request):
         body, headers = prepare_body_headers_with_data(request.json["messages"], 0)
         endpoint = generate_endpoint(0)
         logger.info(f"Not streaming, using endpoint: {endpoint}")
-        r = requests.post(endpoint, headers=headers, json=body)
+        r = get_session_pool().session_for(endpoint).post(endpoint, headers=headers, json=body)
         status_code = r.status_code
         r = r.json()
         return Response(json.dumps(r).replace("\n", "\\n"), status=status_code)
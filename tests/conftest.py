@@ -0,0 +1,10 @@
+import os
+
+from benchmarks.bench_serving import FAKE_SETTINGS
+
+# the app reads its settings from the environment when it is imported
+for key, value in FAKE_SETTINGS.items():
+    os.environ.setdefault(key, value)
+os.environ.setdefault("AZURE_OPENAI_SEMANTIC_CACHE", "false")
+# the tests break upstream streams on purpose, the breakers must not take the regions out
+os.environ.setdefault("AZURE_OPENAI_BREAKER_FAILURE_THRESHOLD", "1000000")
@@ -0,0 +1,39 @@
+import random
+
+import pytest
+
+from backend.balancer import OUTCOME_ERROR, STRATEGIES, PowerOfTwoChoices, RegionBalancer, SelectionStrategy
+
+
+@pytest.mark.parametrize("name", sorted(STRATEGIES))
+def test_strategies_choose_a_candidate(name):
+    random.seed(0)
+    strategy = STRATEGIES[name]()
+    assert {strategy.select({1: 0.5, 3: 1.0}) for _ in range(50)} <= {1, 3}
+    assert strategy.select({2: 1.0}) == 2
+
+
+def test_power_of_two_choices_never_picks_the_worst_of_two():
+    random.seed(0)
+    assert {PowerOfTwoChoices().select({0: 0.1, 1: 5.0}) for _ in range(50)} == {0}
+
+
+def test_choose_skips_excluded_regions():
+    balancer = RegionBalancer(3)
+    assert balancer.choose(exclude=[0, 2]) == 1
+    assert balancer.choose(exclude=[0, 1, 2]) is None
+
+
+def test_errors_raise_the_score():
+    balancer = RegionBalancer(2)
+    balancer.start(1)
+    balancer.finish(1, OUTCOME_ERROR)
+    assert balancer.score(1) > balancer.score(0)
+
+
+def test_strategy_without_select_cannot_be_created():
+    class Named(SelectionStrategy):
+        name = "named"
+
+    with pytest.raises(TypeError, match="select"):
+        Named()
@@ -0,0 +1,79 @@
+import pytest
+
+from backend.breaker import STATE_CLOSED, STATE_HALF_OPEN, STATE_OPEN, CircuitBreaker, RegionBreakers
+
+
+@pytest.fixture
+def breaker():
+    return CircuitBreaker("region", failure_threshold=3, open_seconds=30, half_open_probes=1)
+
+
+def test_opens_after_consecutive_failures(breaker):
+    breaker.record_failure(0)
+    breaker.record_failure(1)
+    assert breaker.state == STATE_CLOSED and breaker.acquire(1)
+    breaker.record_failure(2)
+    assert breaker.state == STATE_OPEN
+    assert not breaker.acquire(3)
+    assert breaker.rejected == 1
+
+
+def test_success_resets_the_failure_count(breaker):
+    breaker.record_failure(0)
+    breaker.record_failure(1)
+    breaker.record_success(2)
+    breaker.record_failure(3)
+    breaker.record_failure(4)
+    assert breaker.state == STATE_CLOSED
+
+
+def test_half_open_after_open_seconds(breaker):
+    for now in range(3):
+        breaker.record_failure(now)
+    assert not breaker.available(31.9)
+    assert breaker.available(32)
+    assert breaker.state == STATE_HALF_OPEN
+
+
+def test_half_open_lets_a_limited_number_of_probes_through(breaker):
+    for now in range(3):
+        breaker.record_failure(now)
+    assert breaker.acquire(40)
+    assert not breaker.acquire(40)
+    # a probe that ended without an outcome gives its slot back
+    breaker.release()
+    assert breaker.acquire(41)
+
+
+def test_successful_probe_closes(breaker):
+    for now in range(3):
+        breaker.record_failure(now)
+    assert breaker.acquire(40)
+    breaker.record_success(41)
+    assert breaker.state == STATE_CLOSED
+    assert breaker.consecutive_failures == 0 and breaker.probes_in_flight == 0
+    assert breaker.transition_counts == {"closed->open": 1, "open->half_open": 1, "half_open->closed": 1}
+
+
+def test_failed_probe_reopens(breaker):
+    for now in range(3):
+        breaker.record_failure(now)
+    assert breaker.acquire(40)
+    breaker.record_failure(41)
+    assert breaker.state == STATE_OPEN
+    # the open period starts over from the failed probe
+    assert not breaker.available(70)
+    assert breaker.available(71)
+
+
+def test_release_is_ignored_when_closed(breaker):
+    breaker.release()
+    assert breaker.probes_in_flight == 0
+
+
+def test_region_breakers():
+    breakers = RegionBreakers(["a", "b"], failure_threshold=1, open_seconds=3600)
+    breakers.record_failure(1)
+    assert breakers.unavailable() == [1]
+    assert breakers.acquire(0) and not breakers.acquire(1)
+    assert [(stats["region"], stats["state"]) for stats in breakers.stats()] == [("a", STATE_CLOSED), ("b", STATE_OPEN)]
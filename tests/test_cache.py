@@ -0,0 +1,108 @@
+import pytest
+
+from backend import cache
+from backend.cache import AnswerCache, CacheBackend, MemoryCacheBackend, cache_key
+
+QUESTION = [{"role": "user", "content": "How do I get a food vendor license?"}]
+SETTINGS = {"deployment": "gpt-35-turbo", "temperature": 0, "top_n_documents": 5}
+LINES = [{"choices": [{"messages": [{"role": "assistant", "content": "Apply online."}]}]}]
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(cache.time, "monotonic", lambda: now[0])
+    return now
+
+
+@pytest.mark.parametrize("content", [
+    "How do I get a food vendor license?",
+    "  how do I get a FOOD vendor\nlicense?  ",
+    "How  do I get a food vendor license?",
+])
+def test_key_ignores_case_and_whitespace(content):
+    assert cache_key([{"role": "user", "content": content}], SETTINGS) == cache_key(QUESTION, SETTINGS)
+
+
+def test_key_depends_on_the_history_and_settings():
+    key = cache_key(QUESTION, SETTINGS)
+    assert cache_key([{"role": "user", "content": "How do I renew a food vendor license?"}], SETTINGS) != key
+    assert cache_key([{"role": "assistant", "content": "Hello"}] + QUESTION, SETTINGS) != key
+    assert cache_key(QUESTION, dict(SETTINGS, top_n_documents=3)) != key
+    # the order of the settings does not matter
+    assert cache_key(QUESTION, dict(reversed(list(SETTINGS.items())))) == key
+
+
+def test_entry_expires_after_its_ttl(clock):
+    backend = MemoryCacheBackend()
+    backend.set("key", LINES, 60)
+    clock[0] += 59
+    assert backend.get("key") == LINES
+    clock[0] += 1
+    assert backend.get("key") is None
+    assert backend.stats()["expirations"] == 1 and backend.stats()["entries"] == 0
+
+
+def test_least_recently_used_entry_is_evicted(clock):
+    backend = MemoryCacheBackend(max_entries=2)
+    backend.set("a", LINES, 60)
+    backend.set("b", LINES, 60)
+    assert backend.get("a") == LINES
+    backend.set("c", LINES, 60)
+    assert backend.get("b") is None
+    assert backend.get("a") == LINES and backend.get("c") == LINES
+    assert backend.stats()["evictions"] == 1
+
+
+def test_answer_cache_counts_hits_and_misses(clock):
+    answers = AnswerCache(MemoryCacheBackend(), ttl=60)
+    key = cache_key(QUESTION, SETTINGS)
+    assert answers.get(key) is None
+    answers.set(key, LINES)
+    assert answers.get(key) == LINES
+    clock[0] += 60
+    assert answers.get(key) is None
+    stats = answers.stats()
+    assert (stats["hits"], stats["misses"], stats["stores"], stats["hit_rate"]) == (1, 2, 1, 0.3333)
+
+
+class BrokenBackend(CacheBackend):
+    def get(self, key):
+        raise ConnectionError("cache down")
+
+    def set(self, key, lines, ttl):
+        raise ConnectionError("cache down")
+
+    def clear(self):
+        raise ConnectionError("cache down")
+
+
+def test_backend_errors_are_misses():
+    answers = AnswerCache(BrokenBackend())
+    answers.set("key", LINES)
+    assert answers.get("key") is None
+    answers.clear()
+    assert answers.stats()["errors"] == 3
+
+
+def test_backend_without_every_method_cannot_be_created():
+    class ReadOnlyBackend(CacheBackend):
+        def get(self, key):
+            return None
+
+    with pytest.raises(TypeError, match="clear"):
+        ReadOnlyBackend()
+
+
+@pytest.mark.parametrize("name, backend", [("none", type(None)), ("memory", MemoryCacheBackend)])
+def test_from_env(monkeypatch, name, backend):
+    monkeypatch.setenv("ANSWER_CACHE_BACKEND", name)
+    monkeypatch.setenv("ANSWER_CACHE_TTL", "60")
+    answers = AnswerCache.from_env()
+    assert isinstance(answers.backend, backend) and answers.ttl == 60
+
+
+def test_from_env_unknown_backend(monkeypatch):
+    monkeypatch.setenv("ANSWER_CACHE_BACKEND", "memcached")
+    with pytest.raises(ValueError, match="memcached"):
+        AnswerCache.from_env()
@@ -0,0 +1,114 @@
+import json
+
+import pytest
+
+import app
+from backend.cache import MemoryCacheBackend
+from backend.conversations import CONVERSATION_STORE_HEADER, ConversationConflict, ConversationStore, answer_messages
+from backend.transcripts import ReplayAdapter
+from benchmarks.mock_upstream import MockUpstreamConfig, build_chunk, build_tool_message
+
+QUESTION = {"role": "user", "content": "How do I get a food vendor license?"}
+FOLLOW_UP = {"role": "user", "content": "How long does it take?"}
+TOOL_MESSAGE = build_tool_message(MockUpstreamConfig(citations=1))
+DELTAS = [TOOL_MESSAGE, {"role": "assistant"}, {"content": "Apply "}, {"content": "online."}]
+# the upstream lines of the answer, as the recorder collects them
+ANSWER_LINES = [json.loads(build_chunk(delta)[len(b"data: "):]) for delta in DELTAS]
+ANSWER = [TOOL_MESSAGE, {"role": "assistant", "content": "Apply online."}]
+
+
+@pytest.fixture
+def store():
+    return ConversationStore(MemoryCacheBackend())
+
+
+def test_answer_messages():
+    assert answer_messages(ANSWER_LINES) == ANSWER
+
+
+def test_full_history_is_used_as_is(store):
+    messages = [QUESTION] + ANSWER + [FOLLOW_UP]
+    assert store.resolve("key", {"messages": messages, "history_length": 3, "full_history": True}) == messages
+    assert store.resolve("key", {"messages": [QUESTION]}) == [QUESTION]
+    assert store.stats()["full_requests"] == 2
+
+
+def test_new_turn_is_appended_to_the_stored_history(store):
+    store.save("key", [QUESTION], ANSWER_LINES)
+    assert store.resolve("key", {"messages": [FOLLOW_UP], "history_length": 3}) == [QUESTION] + ANSWER + [FOLLOW_UP]
+    assert store.stats()["hits"] == 1
+
+
+def test_conflict_when_the_store_is_disabled():
+    with pytest.raises(ConversationConflict, match="does not store"):
+        ConversationStore().resolve("key", {"messages": [FOLLOW_UP], "history_length": 3})
+
+
+def test_conflict_when_the_history_is_missing(store):
+    with pytest.raises(ConversationConflict, match="not found"):
+        store.resolve("key", {"messages": [FOLLOW_UP], "history_length": 3})
+    assert store.stats()["misses"] == 1
+
+
+def test_conflict_when_the_client_is_out_of_step(store):
+    store.save("key", [QUESTION], ANSWER_LINES)
+    # e.g. the client stopped the answer and never received the assistant message
+    with pytest.raises(ConversationConflict, match="holds 3 messages, the client 2"):
+        store.resolve("key", {"messages": [FOLLOW_UP], "history_length": 2})
+    assert store.stats()["conflicts"] == 1
+
+
+def test_oldest_turns_are_pruned_beyond_max_bytes(store):
+    store.max_bytes = 1500
+    history = [QUESTION] + ANSWER + [FOLLOW_UP]
+    store.save("key", history, ANSWER_LINES)
+    entry = store.backend.get("key")
+    # the length is what the client holds, the pruned turn included
+    assert entry == {"messages": [FOLLOW_UP] + ANSWER, "length": len(history) + 2}
+    assert store.stats()["turns_pruned"] == 1
+
+
+def test_save_is_skipped_when_disabled():
+    ConversationStore().save("key", [QUESTION], ANSWER_LINES)
+
+
+@pytest.fixture
+def client(monkeypatch):
+    monkeypatch.setattr(app, "conversation_store", ConversationStore(MemoryCacheBackend()))
+    body = b"".join(build_chunk(delta) for delta in DELTAS) + build_chunk({"content": "[DONE]"})
+    transcript = {"region": "mock", "status": 200, "headers": {"Content-Type": "text/event-stream"}, "connect": 0.0,
+                  "chunks": [(0.0, body)], "end": "complete"}
+    app.get_session_pool().mount(ReplayAdapter([transcript], speed=0))
+    try:
+        yield app.app.test_client()
+    finally:
+        app.get_session_pool().mount(None)
+
+
+def post(client, **body):
+    return client.post("/conversation", json=dict(conversation_id="conversation-1", **body))
+
+
+def test_client_falls_back_to_the_full_history(client):
+    response = post(client, messages=[FOLLOW_UP], history_length=3)
+    assert response.status_code == 409
+    assert response.json["error"] == "conversation_history_required"
+    assert response.headers[CONVERSATION_STORE_HEADER] == "true"
+
+    # the full history seeds the store again, the next turn only carries the new message
+    response = post(client, messages=[QUESTION] + ANSWER + [FOLLOW_UP], history_length=3, full_history=True)
+    assert response.status_code == 200
+    assert response.get_data()
+    response = post(client, messages=[{"role": "user", "content": "Where do I apply?"}], history_length=6)
+    assert response.status_code == 200
+    response.get_data()
+    assert app.conversation_store.stats()["hits"] == 1
+    assert app.conversation_store.backend.get(app.conversation_key("conversation-1", {}))["length"] == 9
+
+
+def test_conversation_ids_are_scoped_to_the_user(client):
+    post(client, messages=[QUESTION]).get_data()
+    response = client.post("/conversation", json={"conversation_id": "conversation-1", "messages": [FOLLOW_UP],
+                                                   "history_length": 3},
+                           headers={"X-Ms-Client-Principal-Id": "someone-else"})
+    assert response.status_code == 409
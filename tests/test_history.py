@@ -0,0 +1,101 @@
+import copy
+import json
+
+import pytest
+
+from backend.history import TOOL_DROP, TOOL_KEEP, TOOL_SUMMARIZE, HistoryCompactor, split_turns
+
+CITATIONS = {"citations": [{"title": "Food vendors", "url": "https://example.org/vendors", "filepath": "vendors.pdf",
+                            "content": "x" * 2000, "chunk_id": "0"}], "intent": "[\"food vendor license\"]"}
+
+
+def turn(question, answer="An answer."):
+    return [{"role": "user", "content": question}, {"role": "tool", "content": json.dumps(CITATIONS)},
+            {"role": "assistant", "content": answer}]
+
+
+HISTORY = turn("first?") + turn("second?") + turn("third?") + [{"role": "user", "content": "fourth?"}]
+
+
+def test_split_turns():
+    assert split_turns(HISTORY) == [turn("first?"), turn("second?"), turn("third?"), [HISTORY[-1]]]
+    # messages before the first user message make a turn of their own
+    assert split_turns([{"role": "assistant", "content": "Hello"}] + HISTORY[:3]) == [
+        [{"role": "assistant", "content": "Hello"}], turn("first?")]
+    assert split_turns([]) == []
+
+
+def test_disabled_by_default():
+    compactor = HistoryCompactor()
+    assert not compactor.enabled
+    assert compactor.compact(HISTORY) == (HISTORY, None)
+
+
+def test_drop_tool_messages_of_earlier_turns():
+    messages, report = HistoryCompactor(tool_policy=TOOL_DROP).compact(HISTORY)
+    assert [message["role"] for message in messages] == ["user", "assistant"] * 3 + ["user"]
+    assert report.messages_before - report.messages_after == 3
+    assert report.bytes_saved > 6000 and report.tokens_saved > 1500
+
+
+def test_summarize_tool_messages_keeps_the_sources():
+    messages, _ = HistoryCompactor(tool_policy=TOOL_SUMMARIZE).compact(HISTORY)
+    assert json.loads(messages[1]["content"]) == {
+        "citations": [{"title": "Food vendors", "url": "https://example.org/vendors", "filepath": "vendors.pdf"}],
+        "intent": CITATIONS["intent"]}
+    assert len(messages) == len(HISTORY)
+
+
+def test_tool_message_of_the_last_turn_is_kept():
+    history = HISTORY[:-1]
+    messages, _ = HistoryCompactor(tool_policy=TOOL_DROP).compact(history)
+    assert messages[-3:] == history[-3:]
+
+
+def test_tool_message_that_is_not_json_is_kept():
+    history = [{"role": "user", "content": "a?"}, {"role": "tool", "content": "plain text"},
+               {"role": "user", "content": "b?"}]
+    assert HistoryCompactor(tool_policy=TOOL_SUMMARIZE).compact(history)[0] == history
+
+
+def test_max_turns():
+    messages, _ = HistoryCompactor(max_turns=2).compact(HISTORY)
+    assert messages == turn("third?") + [HISTORY[-1]]
+
+
+def test_max_tokens_drops_the_oldest_turns():
+    compactor = HistoryCompactor(max_tokens=25, count_tokens=lambda message: 5)
+    messages, report = compactor.compact(HISTORY)
+    # each turn is 15 tokens, the question 5
+    assert messages == turn("third?") + [HISTORY[-1]]
+    assert report.tokens_after == 20
+
+
+def test_last_question_is_kept_over_the_budget():
+    messages, _ = HistoryCompactor(max_tokens=1, count_tokens=lambda message: 5).compact(HISTORY)
+    assert messages == [HISTORY[-1]]
+
+
+def test_input_is_not_modified():
+    history = copy.deepcopy(HISTORY)
+    HistoryCompactor(tool_policy=TOOL_SUMMARIZE, max_turns=2).compact(history)
+    assert history == HISTORY
+
+
+def test_stats_add_up():
+    compactor = HistoryCompactor(tool_policy=TOOL_DROP, max_turns=2)
+    for _ in range(2):
+        compactor.compact(HISTORY)
+    stats = compactor.stats()
+    assert (stats["requests"], stats["messages_dropped"]) == (2, 2 * (len(HISTORY) - 3))
+
+
+def test_from_env(monkeypatch):
+    monkeypatch.setenv("HISTORY_TOOL_MESSAGES", "Summarize")
+    monkeypatch.setenv("HISTORY_MAX_TURNS", "4")
+    compactor = HistoryCompactor.from_env()
+    assert (compactor.tool_policy, compactor.max_turns, compactor.max_tokens) == (TOOL_SUMMARIZE, 4, 0)
+    monkeypatch.setenv("HISTORY_TOOL_MESSAGES", "truncate")
+    with pytest.raises(ValueError, match="truncate"):
+        HistoryCompactor.from_env()
+    assert HistoryCompactor(tool_policy=TOOL_KEEP, max_tokens=100).enabled
@@ -0,0 +1,121 @@
+import pytest
+
+from backend import ratelimit
+from backend.ratelimit import DEFAULT_RETRY_AFTER, DeploymentLimiters, TokenBucket, parse_retry_after
+
+
+class Clock(object):
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(ratelimit.time, "monotonic", clock)
+    return clock
+
+
+def test_bucket_holds_ten_seconds_of_quota(clock):
+    bucket = TokenBucket(600)
+    assert bucket.capacity == 100
+    assert bucket.wait_time(100, clock.now) == 0
+
+
+def test_bucket_refills_at_the_per_minute_rate(clock):
+    bucket = TokenBucket(600)
+    bucket.take(100)
+    assert bucket.wait_time(50, clock.now) == pytest.approx(5)
+    assert bucket.wait_time(50, clock.now + 2) == pytest.approx(3)
+    # it never fills past its capacity
+    assert bucket.wait_time(0, clock.now + 3600) == 0
+    assert bucket.tokens == 100
+
+
+def test_request_larger_than_the_bucket_waits_for_a_full_bucket(clock):
+    bucket = TokenBucket(600)
+    bucket.take(30)
+    assert bucket.wait_time(500, clock.now) == pytest.approx(3)
+
+
+def test_give_back(clock):
+    bucket = TokenBucket(600)
+    bucket.take(80)
+    bucket.give_back(50)
+    assert bucket.tokens == 70
+    bucket.give_back(50)
+    assert bucket.tokens == 100
+
+
+def test_acquire_takes_from_the_token_quota(clock):
+    limiters = DeploymentLimiters(["a"], [600], [None], workers=1)
+    assert limiters.acquire(0, 60)
+    assert not limiters.acquire(0, 60)
+    assert limiters.unavailable(60) == [0]
+    assert limiters.wait_time([0], 60) == pytest.approx(2)
+    clock.now += 2
+    assert limiters.acquire(0, 60)
+
+
+def test_acquire_takes_from_the_request_quota(clock):
+    # one request per 10 seconds
+    limiters = DeploymentLimiters(["a"], [600], [6], workers=1)
+    assert limiters.acquire(0, 10)
+    clock.now += 6
+    assert not limiters.acquire(0, 10)
+    clock.now += 4
+    assert limiters.acquire(0, 10)
+
+
+def test_give_back_returns_an_unsent_request(clock):
+    limiters = DeploymentLimiters(["a"], [600], [6], workers=1)
+    assert limiters.acquire(0, 100)
+    limiters.give_back(0, 100)
+    assert limiters.acquire(0, 100)
+    assert limiters.stats()[0]["admitted"] == 1
+
+
+def test_quota_is_shared_between_workers(clock):
+    limiters = DeploymentLimiters(["a"], [1200], [None], workers=2)
+    assert limiters.acquire(0, 60)
+    assert not limiters.acquire(0, 60)
+
+
+def test_retry_after_blocks_the_deployment(clock):
+    limiters = DeploymentLimiters(["a", "b"], [600, None], [None, None], workers=1)
+    limiters.record_throttled(0, 7)
+    limiters.record_throttled(1, 3)
+    assert limiters.unavailable(1) == [0, 1]
+    assert limiters.wait_time([0, 1], 1) == pytest.approx(3)
+    clock.now += 3
+    assert limiters.unavailable(1) == [0]
+    # the token bucket was emptied too, it has refilled by the time the block passed
+    clock.now += 4
+    assert limiters.unavailable(1) == []
+    assert limiters.stats()[0]["throttled"] == 1
+
+
+def test_shorter_retry_after_does_not_shorten_the_block(clock):
+    limiters = DeploymentLimiters(["a"], [None], [None], workers=1)
+    limiters.record_throttled(0, 10)
+    limiters.record_throttled(0, 1)
+    clock.now += 5
+    assert limiters.unavailable(1) == [0]
+
+
+def test_wait_time_without_candidates(clock):
+    assert DeploymentLimiters(["a"], [600], [None], workers=1).wait_time([], 1) is None
+
+
+@pytest.mark.parametrize("headers, expected", [
+    ({"retry-after-ms": "1500", "Retry-After": "2"}, 1.5),
+    ({"Retry-After": "2"}, 2),
+    ({"retry-after-ms": "soon", "Retry-After": "2"}, 2),
+    ({"Retry-After": "Wed, 21 Oct 2026 07:28:00 GMT"}, DEFAULT_RETRY_AFTER),
+    ({}, DEFAULT_RETRY_AFTER),
+])
+def test_parse_retry_after(headers, expected):
+    assert parse_retry_after(headers) == expected
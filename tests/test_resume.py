@@ -0,0 +1,193 @@
+import asyncio
+import contextlib
+import json
+import random
+
+import pytest
+
+import app
+import app_asgi
+from backend.async_upstream import AsyncUpstreamClient
+from backend.resume import MIN_OVERLAP, RESUME_INSTRUCTION, SPLICE_WINDOW
+from backend.streaming import FORMAT_DELTA
+from backend.transcripts import AsyncReplayTransport, ReplayAdapter
+from benchmarks.mock_upstream import MockUpstreamConfig, build_chunk, build_tool_message
+
+QUESTION = [{"role": "user", "content": "How do I get a food vendor license?"}]
+ANSWER = "".join(f"token{i} " for i in range(60))
+EVENT_END = b"\n\n"
+
+
+def transcript(contents, complete=True, cut_at=None):
+    """A replayed upstream stream answering `contents`; it breaks off after `cut_at` bytes of its body."""
+    body = build_chunk(build_tool_message(MockUpstreamConfig(citations=1))) + build_chunk({"role": "assistant"})
+    body += b"".join(build_chunk({"content": content}) for content in contents)
+    if complete:
+        body += build_chunk({"content": "[DONE]"})
+    if cut_at is not None:
+        body, complete = body[:cut_at], False
+    return {"region": "mock", "status": 200, "headers": {"Content-Type": "text/event-stream"}, "connect": 0.0,
+            "chunks": [(0.0, body)], "end": "complete" if complete else "dropped"}
+
+
+def pieces(text, rng):
+    """`text` cut into model tokens of random sizes."""
+    cuts = sorted(rng.sample(range(1, len(text)), len(text) // 4)) if len(text) > 1 else []
+    return [text[start:end] for start, end in zip([0] + cuts, cuts + [len(text)])]
+
+
+def interrupted(rng):
+    """A stream of ANSWER dropped at a random byte after its first token, and the text it delivered."""
+    tokens = [f"token{i} " for i in range(60)]
+    full = transcript(tokens)["chunks"][0][1]
+    # the ends of the tool message, the assistant message and the first token
+    first_token_end = [i for i in range(len(full)) if full.startswith(EVENT_END, i)][2] + len(EVENT_END)
+    cut_at = rng.randrange(first_token_end, len(full) - len(build_chunk({"content": "[DONE]"})))
+    delivered = "".join(tokens[:full[:cut_at].count(EVENT_END) - 2])
+    return transcript(tokens, cut_at=cut_at), delivered
+
+
+def continuation(delivered, rng):
+    """The continuation a model could send: from where the answer stopped, or restarting a bit before."""
+    starts = [len(delivered)] + list(range(max(len(delivered) - SPLICE_WINDOW, 0), len(delivered) - MIN_OVERLAP + 1))
+    if len(delivered) <= SPLICE_WINDOW:
+        starts.append(0)
+    return transcript(pieces(ANSWER[rng.choice(starts):], rng))
+
+
+class RecordingAdapter(ReplayAdapter):
+    def __init__(self, transcripts, sent):
+        super().__init__(transcripts, speed=0)
+        self.sent = sent
+
+    def send(self, request, **kwargs):
+        self.sent.append(json.loads(request.body))
+        return super().send(request, **kwargs)
+
+
+class RecordingTransport(AsyncReplayTransport):
+    def __init__(self, transcripts, sent):
+        super().__init__(transcripts, speed=0)
+        self.sent = sent
+
+    async def handle_async_request(self, request):
+        self.sent.append(json.loads(request.content))
+        return await super().handle_async_request(request)
+
+
+def run_wsgi(transcripts, sent=None):
+    app.get_session_pool().mount(RecordingAdapter(transcripts, [] if sent is None else sent))
+    try:
+        body, headers = app.prepare_body_headers_with_data(QUESTION, 0)
+        with contextlib.closing(app.stream_with_data(body, headers, app.generate_endpoint(0), 0, FORMAT_DELTA,
+                                                     request_messages=QUESTION)) as data_stream:
+            return list(data_stream)
+    finally:
+        app.get_session_pool().mount(None)
+
+
+def run_asgi(transcripts, sent=None):
+    async def run():
+        transport = RecordingTransport(transcripts, [] if sent is None else sent)
+        client = AsyncUpstreamClient(timeouts=app.upstream_timeouts, transport=transport)
+        try:
+            body, headers = app.prepare_body_headers_with_data(QUESTION, 0)
+            async with contextlib.aclosing(app_asgi.stream_with_data(
+                    client, body, headers, app.generate_endpoint(0), 0, FORMAT_DELTA,
+                    request_messages=QUESTION)) as data_stream:
+                return [frame async for frame in data_stream]
+        finally:
+            await client.aclose()
+
+    return asyncio.run(run())
+
+
+def answer_of(frames):
+    """The text of the answer the delta frames build, and the last frame."""
+    frames = [json.loads(line) for frame in frames for line in frame.splitlines() if line]
+    return "".join(frame.get("delta", "") for frame in frames), frames[-1]
+
+
+@pytest.fixture(params=["wsgi", "asgi"])
+def serve(request):
+    return run_wsgi if request.param == "wsgi" else run_asgi
+
+
+@pytest.fixture
+def resume(monkeypatch):
+    def configure(enabled, attempts=2):
+        monkeypatch.setattr(app.stream_resume, "enabled", enabled)
+        monkeypatch.setattr(app.stream_resume, "attempts", attempts)
+    return configure
+
+
+@pytest.mark.parametrize("seed", range(20))
+def test_resumed_answer_is_spliced(serve, resume, seed):
+    resume(True)
+    rng = random.Random(seed)
+    dropped, delivered = interrupted(rng)
+    content, last = answer_of(serve([dropped, continuation(delivered, rng)]))
+    assert content == ANSWER
+    assert "done" in last
+
+
+def search_query(body):
+    """What the "on your data" extension searches the index with: the last user turn."""
+    return [message for message in body["messages"] if message["role"] == "user"][-1]["content"]
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_continuation_searches_with_the_question(serve, resume, seed):
+    resume(True)
+    rng = random.Random(seed)
+    dropped, delivered = interrupted(rng)
+    sent = []
+    serve([dropped, continuation(delivered, rng)], sent)
+    first, resumed = sent
+    assert search_query(resumed) == search_query(first) == QUESTION[-1]["content"]
+    assert resumed["messages"] == QUESTION + [{"role": "assistant", "content": delivered}]
+    role_information = resumed["dataSources"][0]["parameters"]["roleInformation"]
+    assert role_information.endswith(RESUME_INSTRUCTION)
+    assert RESUME_INSTRUCTION not in first["dataSources"][0]["parameters"]["roleInformation"]
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_resumed_after_continuation_breaks_off(serve, resume, seed):
+    resume(True)
+    rng = random.Random(seed)
+    dropped, delivered = interrupted(rng)
+    # the first continuation breaks off before it said anything, the second one completes
+    broken = transcript([], complete=False)
+    content, last = answer_of(serve([dropped, broken, continuation(delivered, rng)]))
+    assert content == ANSWER
+    assert "done" in last
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_error_frame_without_resume(serve, resume, seed):
+    resume(False)
+    dropped, delivered = interrupted(random.Random(seed))
+    content, last = answer_of(serve([dropped]))
+    assert content == delivered
+    assert last == {"error": app.STALLED_ERROR}
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_error_frame_when_attempts_are_exhausted(serve, resume, seed):
+    resume(True, attempts=2)
+    dropped, delivered = interrupted(random.Random(seed))
+    # every continuation breaks off again before it said anything
+    broken = transcript([], complete=False)
+    content, last = answer_of(serve([dropped, broken, broken]))
+    assert content == delivered
+    assert last == {"error": app.STALLED_ERROR}
+
+
+def test_throttled_region_sends_no_frame(serve, resume):
+    resume(True)
+    throttled = {"region": "mock", "status": 429, "headers": {"retry-after-ms": "1"}, "connect": 0.0, "chunks": [],
+                 "end": "complete"}
+    before = app.region_limiters.stats()[0]["throttled"]
+    # the caller tries another region, the answer is not resumed
+    assert serve([throttled]) == []
+    assert app.region_limiters.stats()[0]["throttled"] == before + 1
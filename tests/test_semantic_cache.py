@@ -0,0 +1,22 @@
+import pytest
+
+from backend.semantic_cache import Embedder, HashingEmbedder, SemanticCache
+
+
+def test_default_threshold_of_the_embedder():
+    assert SemanticCache(HashingEmbedder()).threshold == HashingEmbedder.default_threshold
+
+
+@pytest.mark.parametrize("value", ["0", "0.0"])
+def test_zero_threshold_from_env(monkeypatch, value):
+    monkeypatch.setenv("SEMANTIC_CACHE_EMBEDDER", "hashing")
+    monkeypatch.setenv("SEMANTIC_CACHE_THRESHOLD", value)
+    assert SemanticCache.from_env("https://region1.openai.azure.com", "key").threshold == 0.0
+
+
+def test_embedder_without_embed_cannot_be_created():
+    class ThresholdOnly(Embedder):
+        default_threshold = 0.8
+
+    with pytest.raises(TypeError, match="embed"):
+        ThresholdOnly()
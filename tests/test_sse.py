@@ -0,0 +1,129 @@
+import asyncio
+import random
+
+import pytest
+
+from backend.sse import DONE, SSEParser, aiter_events, is_done, iter_events
+
+# the shapes of the upstream answer stream: a tool message, content deltas, comments and [DONE]
+STREAM = (
+    b": keep-alive\r\n"
+    b"\r\n"
+    b"data: {\"choices\": [{\"messages\": [{\"role\": \"tool\", \"content\": \"docs\"}]}]}\r\n"
+    b"\r\n"
+    b"event: delta\r\n"
+    b"id: 7\r\n"
+    b"retry: 1500\r\n"
+    b"data: {\"content\": \"Hello\"}\r\n"
+    b"\r\n"
+    b": ping\n"
+    b"data: first line\n"
+    b"data: second line\n"
+    b"data:no space\n"
+    b"\n"
+    b"event: no-data\r"
+    b"id: 8\r"
+    b"\r"
+    b"data:  two spaces\r\n"
+    b"\r\n"
+    b"data: [DONE]\r\n"
+    b"\r\n"
+)
+
+EXPECTED = [
+    ("message", b"{\"choices\": [{\"messages\": [{\"role\": \"tool\", \"content\": \"docs\"}]}]}", "", None),
+    ("delta", b"{\"content\": \"Hello\"}", "7", 1500),
+    ("message", b"first line\nsecond line\nno space", "7", 1500),
+    ("message", b" two spaces", "8", 1500),
+    ("message", DONE, "8", 1500),
+]
+
+
+def parse(chunks):
+    parser = SSEParser()
+    events = []
+    for chunk in chunks:
+        events += parser.feed(chunk)
+    events += parser.finish()
+    return [tuple(event) for event in events], parser
+
+
+def cut(data, offsets):
+    offsets = [0] + sorted(offsets) + [len(data)]
+    return [data[start:end] for start, end in zip(offsets, offsets[1:])]
+
+
+def test_whole_stream():
+    events, parser = parse([STREAM])
+    assert events == EXPECTED
+    assert parser.comments == 2
+    assert parser.last_event_id == "8"
+    assert parser.retry == 1500
+
+
+@pytest.mark.parametrize("seed", range(50))
+def test_random_chunk_cuts(seed):
+    rng = random.Random(seed)
+    chunks = cut(STREAM, rng.sample(range(1, len(STREAM)), rng.randint(1, 40)))
+    assert parse(chunks)[0] == EXPECTED
+
+
+def test_byte_at_a_time():
+    assert parse([STREAM[i:i + 1] for i in range(len(STREAM))])[0] == EXPECTED
+
+
+def test_crlf_split_across_chunks():
+    parser = SSEParser()
+    assert parser.feed(b"data: a\r") == []
+    # the \n completes the \r\n of the line, it is not a blank line ending the event
+    assert parser.feed(b"\ndata: b\r") == []
+    assert [event.data for event in parser.feed(b"\n\r\n")] == [b"a\nb"]
+    assert parser.finish() == []
+
+
+def test_trailing_lone_cr():
+    parser = SSEParser()
+    assert parser.feed(b"data: a\r\r") == []
+    # the stream ends: the held back \r was a line break of its own
+    assert [event.data for event in parser.finish()] == [b"a"]
+
+
+def test_last_event_without_blank_line():
+    assert [event.data for event in iter_events([b"data: a\n\ndata: b"])] == [b"a", b"b"]
+
+
+def test_comments_only():
+    events, parser = parse([b": one\n:two\n\n: three\n\n"])
+    assert events == []
+    assert parser.comments == 3
+
+
+def test_events_without_data_are_not_emitted():
+    events, parser = parse([b"event: ping\nid: 3\n\nretry: 10\n\ndata\n\n"])
+    # a `data` field without a colon is an empty value: the event has data
+    assert events == [("message", b"", "3", 10)]
+
+
+def test_done():
+    events = list(iter_events([b"data: {\"content\": \"x\"}\n\n", b"data: [DONE]\n\n"]))
+    assert [is_done(event) for event in events] == [False, True]
+
+
+def test_iter_events_random_cuts():
+    rng = random.Random(1)
+    chunks = cut(STREAM, rng.sample(range(1, len(STREAM)), 25))
+    assert [tuple(event) for event in iter_events(chunks)] == EXPECTED
+
+
+@pytest.mark.parametrize("seed", range(10))
+def test_aiter_events_random_cuts(seed):
+    rng = random.Random(seed)
+    chunks = cut(STREAM, rng.sample(range(1, len(STREAM)), rng.randint(1, 40)))
+
+    async def read():
+        async def source():
+            for chunk in chunks:
+                yield chunk
+        return [tuple(event) async for event in aiter_events(source())]
+
+    assert asyncio.run(read()) == EXPECTED
@@ -0,0 +1,43 @@
+import json
+
+import pytest
+
+from backend.streaming import FORMAT_DELTA, FORMAT_SNAPSHOT, StreamAssembler, create_assembler
+from benchmarks.mock_upstream import build_chunk
+
+DELTAS = [{"role": "tool", "content": "{}"}, {"role": "assistant"}, {"content": "Apply "}, {"content": "online."},
+          {"content": "[DONE]"}]
+
+
+def assemble(stream_format):
+    assembler = create_assembler(stream_format)
+    frames = [assembler.feed(json.loads(build_chunk(delta)[len(b"data: "):])) for delta in DELTAS]
+    frames.append(assembler.finish())
+    return [json.loads(frame) for frame in frames if frame is not None], assembler
+
+
+@pytest.mark.parametrize("stream_format", [FORMAT_SNAPSHOT, FORMAT_DELTA])
+def test_formats_build_the_same_messages(stream_format):
+    _, assembler = assemble(stream_format)
+    assert assembler.messages == [DELTAS[0], {"role": "assistant", "content": "Apply online."}]
+
+
+def test_delta_frames():
+    frames, _ = assemble(FORMAT_DELTA)
+    assert [frame.get("delta") for frame in frames[2:4]] == ["Apply ", "online."]
+    assert "done" in frames[-1]
+
+
+def test_snapshot_frames_resend_the_answer():
+    frames, _ = assemble(FORMAT_SNAPSHOT)
+    assert [frame["choices"][0]["messages"][-1].get("content") for frame in frames[1:]] == [
+        "", "Apply ", "Apply online.", "Apply online."]
+
+
+def test_assembler_without_every_hook_cannot_be_created():
+    class PlainTextAssembler(StreamAssembler):
+        def on_content(self, delta_text):
+            return delta_text.encode("utf-8")
+
+    with pytest.raises(TypeError, match="on_done"):
+        PlainTextAssembler()
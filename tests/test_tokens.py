@@ -0,0 +1,59 @@
+import pytest
+
+from backend.settings import Settings
+from backend.tokens import (MIN_MESSAGE_BUDGET, TOKENS_PER_MESSAGE, TOKENS_PER_REPLY, ContextBudget, RegionTokenBudgets,
+                            TokenCounter)
+from benchmarks.bench_serving import FAKE_SETTINGS
+
+
+@pytest.fixture(scope="module")
+def counter():
+    # no such encoding: tokens are estimated from characters, the same with or without tiktoken
+    return TokenCounter(encoding_name="test-estimate")
+
+
+def question(tokens):
+    """A user message of `tokens` tokens, its overhead included."""
+    return {"role": "user", "content": "x" * ((tokens - TOKENS_PER_MESSAGE - 1) * 4)}
+
+
+def test_conversation_filling_the_budget_is_kept(counter):
+    budget = ContextBudget(counter, "gpt-35-turbo", 4096, 1000, "", retrieval_tokens=1000)
+    messages = [question(budget.message_budget - TOKENS_PER_REPLY)]
+    assert counter.count_messages(messages) == budget.message_budget
+    assert budget.fit(messages) == (messages, 0, False)
+
+
+def test_oldest_turns_are_dropped_first(counter):
+    budget = ContextBudget(counter, "gpt-35-turbo", 4096, 1000, "", retrieval_tokens=1000)
+    turn = [question(800), {"role": "assistant", "content": "y" * 400}]
+    fitted, dropped, truncated = budget.fit(turn * 3 + [question(100)])
+    assert (dropped, truncated) == (2, False)
+    assert fitted == turn * 2 + [question(100)]
+
+
+def test_long_question_is_truncated_to_the_budget(counter):
+    budget = ContextBudget(counter, "gpt-35-turbo", 4096, 1000, "", retrieval_tokens=1000)
+    fitted, dropped, truncated = budget.fit([question(5000)])
+    assert truncated and dropped == 0
+    assert 0 < counter.count_messages(fitted) <= budget.message_budget
+
+
+def settings(**environ):
+    return Settings.from_env({**FAKE_SETTINGS, **environ})
+
+
+def test_budget_too_small_fails_at_startup(counter, monkeypatch):
+    monkeypatch.delenv("AZURE_OPENAI_RETRIEVAL_TOKENS", raising=False)
+    monkeypatch.delenv("AZURE_OPENAI_TOKEN_BUDGET", raising=False)
+    with pytest.raises(ValueError, match="AZURE_OPENAI_MAX_TOKENS 3000"):
+        RegionTokenBudgets.from_env(settings(AZURE_OPENAI_MAX_TOKENS="3000"), counter)
+    for suffix in ("", "_NC", "_US2"):
+        monkeypatch.setenv(f"AZURE_OPENAI_CONTEXT_WINDOW{suffix}", "8192")
+    budgets = RegionTokenBudgets.from_env(settings(AZURE_OPENAI_MAX_TOKENS="3000"), counter)
+    assert all(budget.message_budget >= MIN_MESSAGE_BUDGET for budget in budgets.budgets)
+
+
+def test_budget_is_not_checked_when_disabled(counter, monkeypatch):
+    monkeypatch.setenv("AZURE_OPENAI_TOKEN_BUDGET", "false")
+    assert not RegionTokenBudgets.from_env(settings(AZURE_OPENAI_MAX_TOKENS="3000"), counter).enabled